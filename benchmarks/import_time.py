@@ -0,0 +1,58 @@
+"""
+Startup benchmark: time of `import users_db.users` in a fresh interpreter, and
+of the engine creation that used to happen at import time, measured in the
+same interpreter right after the import.
+
+    python benchmarks/import_time.py [--runs 20]
+
+No database connection is made, create_engine only loads the dialect and
+the DBAPI driver. The import must not load them, see
+tests/test_db.py::test_import_does_not_load_the_dialect.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+IMPORT_AND_ENGINE = """
+import sys, time
+started = time.perf_counter()
+import users_db.users
+imported = time.perf_counter()
+loaded = any(name.startswith("sqlalchemy.dialects.postgresql") for name in sys.modules)
+users_db.db.get_engine()
+print(imported - started, time.perf_counter() - imported, loaded)
+"""
+
+
+def measure(runs):
+    imports, engines, loaded = [], [], False
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_AND_ENGINE],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.split()
+        imports.append(float(output[0]))
+        engines.append(float(output[1]))
+        loaded = loaded or output[2] == "True"
+    return statistics.median(imports), statistics.median(engines), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    imported, engine, loaded = measure(args.runs)
+
+    print(f"import users_db.users (lazy engine):    {imported * 1000:8.2f} ms")
+    print(f"create_engine, saved at import time:    {engine * 1000:8.2f} ms")
+    if loaded:
+        print("the import loads the postgresql dialect, the saving is lost")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
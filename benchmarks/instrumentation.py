@@ -0,0 +1,63 @@
+"""
+Instrumentation overhead benchmark: nested db_transaction calls and get_user
+with the instrumentation disabled, and enabled with a PrometheusSink.
+
+    python benchmarks/instrumentation.py [--calls 100000] [--queries 2000]
+
+Needs the database of config.get_postgres_uri().
+"""
+import argparse
+import time
+
+from users_db import instrumentation
+from users_db.db import db_transaction
+from users_db.users import get_user
+
+
+@db_transaction
+def nested(db_conn=None):
+    return db_conn
+
+
+@db_transaction
+def outer(calls, db_conn=None):
+    started = time.perf_counter()
+    for _ in range(calls):
+        nested()
+    return (time.perf_counter() - started) / calls
+
+
+def queries(calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        get_user(-1)
+    return (time.perf_counter() - started) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    # warm up the pool and the compiled statement cache
+    queries(100)
+
+    for name, sink in (
+        ("disabled", None),
+        ("prometheus", instrumentation.PrometheusSink()),
+    ):
+        instrumentation.enable(sink)
+        try:
+            nested_call = outer(args.calls)
+            query = queries(args.queries)
+        finally:
+            instrumentation.disable()
+        print(
+            f"{name:12} nested db_transaction {nested_call * 1e9:6.0f} ns, "
+            f"get_user {query * 1e6:6.1f} us"
+        )
+
+
+if __name__ == "__main__":
+    main()
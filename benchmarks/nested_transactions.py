@@ -0,0 +1,63 @@
+"""
+Nested transaction benchmark: the overhead of calling a db_transaction
+decorated function from inside another one, which reuses the connection of
+the outermost call, compared with calling the undecorated function.
+
+    python benchmarks/nested_transactions.py [--calls 100000] [--threads 4]
+
+Needs the database of config.get_postgres_uri() for the outermost connection,
+the nested calls run no statement. With --threads the same benchmark runs in
+that many threads at once, each with its own transaction.
+"""
+import argparse
+import threading
+import time
+
+from users_db.db import db_transaction
+
+
+def plain(db_conn=None):
+    return db_conn
+
+
+nested = db_transaction(plain)
+
+
+@db_transaction
+def outer(func, calls, db_conn=None):
+    started = time.perf_counter()
+    for _ in range(calls):
+        func(db_conn=db_conn) if func is plain else func()
+    return time.perf_counter() - started
+
+
+def per_call(func, calls):
+    return outer(func, calls) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=100_000)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    results = {}
+
+    def run(name, func):
+        results.setdefault(name, []).append(per_call(func, args.calls))
+
+    for name, func in (("plain function", plain), ("nested db_transaction", nested)):
+        threads = [
+            threading.Thread(target=run, args=(name, func)) for _ in range(args.threads)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    for name, timings in results.items():
+        print(f"{name:24} {max(timings) * 1e9:8.0f} ns per call")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Row post-processing benchmark: a 10k-row select of users turned into dicts
+by the compiled row transformer of db_execute, compared with the former
+dict(row._mapping) + serialize_enums + secure_result passes, and turned into
+the named tuples of db_execute(typed=True).
+
+    python benchmarks/row_transform.py [--rows 10000] [--runs 20]
+
+Needs the database of config.get_postgres_uri(), the rows are inserted in a
+transaction that is rolled back. Only the post-processing is timed, the
+rows are fetched once.
+"""
+import argparse
+import statistics
+import sys
+import time
+
+from sqlalchemy import insert, select
+
+from users_db.db import (
+    dict_or_list,
+    get_engine,
+    secure_result,
+    serialize_enums,
+    transform_rows,
+)
+from users_db.schema import users
+
+
+class FetchedResult:
+    """the keys and rows of a CursorResult, iterable more than once"""
+
+    def __init__(self, cursor_result):
+        self._keys = tuple(cursor_result.keys())
+        self.rows = cursor_result.all()
+
+    def keys(self):
+        return self._keys
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+def before(statement, result):
+    return secure_result(serialize_enums(dict_or_list(result.rows)))
+
+
+def after(statement, result):
+    return transform_rows(statement, result)
+
+
+def typed(statement, result):
+    return transform_rows(statement, result, typed=True)
+
+
+def measure(func, statement, result, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        func(statement, result)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    with get_engine().connect() as conn:
+        conn.execute(
+            insert(users),
+            [
+                {
+                    "first_name": f"John{i}",
+                    "middle_name": "E.",
+                    "last_name": f"Doe{i}",
+                    "email": f"row_transform_{i}@example.com",
+                    "password": "password",
+                    "role": "USER",
+                }
+                for i in range(args.rows)
+            ],
+        )
+        statement = select(users)
+        result = FetchedResult(conn.execute(statement))
+        conn.rollback()
+
+    assert before(statement, result) == after(statement, result)
+    old = measure(before, statement, result, args.runs)
+    new = measure(after, statement, result, args.runs)
+    new_typed = measure(typed, statement, result, args.runs)
+    dict_size = sys.getsizeof(after(statement, result)[0])
+    typed_size = sys.getsizeof(typed(statement, result)[0])
+
+    print(f"{len(result.rows)} rows")
+    print(f"dict + serialize_enums + secure_result: {old * 1000:8.2f} ms")
+    print(f"compiled row transformer:               {new * 1000:8.2f} ms")
+    print(f"speedup:                                {old / new:8.2f}x")
+    print(f"compiled row transformer, typed:        {new_typed * 1000:8.2f} ms")
+    print(f"bytes per row, dict / typed:            {dict_size:4d} / {typed_size}")
+
+
+if __name__ == "__main__":
+    main()
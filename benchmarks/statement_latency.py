@@ -0,0 +1,96 @@
+"""
+Per-call latency benchmark of get_user and get_hashed_password_by_email: the
+select built on every call, as the functions used to do, compared with the
+prebuilt statements of users_db.statements executed with bind parameters.
+
+    python benchmarks/statement_latency.py [--calls 5000]
+
+Needs the database of config.get_postgres_uri(), the user is inserted in a
+transaction that is rolled back. Both variants share one connection, so the
+timings include the round trip but not the pool checkout.
+"""
+import argparse
+import statistics
+import time
+
+from sqlalchemy import insert, select
+
+from users_db import statements
+from users_db.db import db_execute, get_engine
+from users_db.schema import public_columns, users
+
+EMAIL = "statement_latency@example.com"
+
+
+def rebuilt_get_user(db_conn, user_id):
+    stmt = select(*public_columns(users)).where(users.c.id == user_id)
+    return db_execute(stmt, db_conn=db_conn)
+
+
+def prebuilt_get_user(db_conn, user_id):
+    return db_execute(
+        statements.GET_USER_STMT, db_conn=db_conn, parameters={"user_id": user_id}
+    )
+
+
+def rebuilt_get_hashed_password(db_conn, user_id):
+    stmt = select(
+        users.c.id, users.c.email, users.c.password.label("hashed_password")
+    ).where(users.c.email == EMAIL)
+    return db_execute(stmt, db_conn=db_conn)
+
+
+def prebuilt_get_hashed_password(db_conn, user_id):
+    return db_execute(
+        statements.GET_HASHED_PASSWORD_BY_EMAIL_STMT,
+        db_conn=db_conn,
+        parameters={"email": EMAIL},
+    )
+
+
+VARIANTS = [
+    ("get_user, rebuilt", rebuilt_get_user),
+    ("get_user, prebuilt", prebuilt_get_user),
+    ("get_hashed_password_by_email, rebuilt", rebuilt_get_hashed_password),
+    ("get_hashed_password_by_email, prebuilt", prebuilt_get_hashed_password),
+]
+
+
+def measure(func, db_conn, user_id, calls):
+    func(db_conn, user_id)  # warm up the compiled cache
+    timings = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        func(db_conn, user_id)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=5000)
+    args = parser.parse_args()
+
+    with get_engine().connect() as conn:
+        user_id = conn.execute(
+            insert(users)
+            .values(
+                first_name="John",
+                last_name="Doe",
+                email=EMAIL,
+                password="hashed",
+                role="USER",
+            )
+            .returning(users.c.id)
+        ).scalar()
+
+        print(f"{'':40} {'p50 us':>9} {'p99 us':>9}")
+        for name, func in VARIANTS:
+            p50, p99 = measure(func, conn, user_id, args.calls)
+            print(f"{name:40} {p50 * 1e6:9.1f} {p99 * 1e6:9.1f}")
+        conn.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -26,22 +26,14 @@ def users_data(db_connection):
         for i in range(101)
     ]
 
-    user_ids = []
+    # one multi-row insert, the returned emails map the ids back to the rows
+    result = db_connection.execute(
+        insert(users).values(users_data).returning(users.c.id, users.c.email)
+    )
+    ids_by_email = {email: user_id for user_id, email in result.all()}
     for user_data in users_data:
-        result = db_connection.execute(
-            insert(users)
-            .values(
-                first_name=user_data["first_name"],
-                middle_name=user_data["middle_name"],
-                last_name=user_data["last_name"],
-                email=user_data["email"],
-                password=user_data["password"],
-                role=user_data["role"],
-            )
-            .returning(users.c.id)
-        )
-        user_data["id"] = result.one()[0]
-        user_ids.append(user_data["id"])
+        user_data["id"] = ids_by_email[user_data["email"]]
+    user_ids = list(ids_by_email.values())
     db_connection.commit()
 
     yield users_data
@@ -0,0 +1,401 @@
+import asyncio
+import logging
+
+import pytest
+from sqlalchemy import NullPool, delete, select, text
+
+import users_db.aio
+from users_db import config, instrumentation, slow_queries
+from users_db.aio import role_permissions as aio_role_permissions
+from users_db.aio import users as aio_users
+from users_db.aio.db import (
+    configure_engine,
+    configure_replicas,
+    current_connection,
+    db_read_transaction,
+    db_savepoint,
+    db_transaction,
+    dispose_engine,
+    get_engine,
+    get_replicas,
+)
+from users_db.db import pool_metrics
+from users_db.errors import DatabaseError
+from users_db.instrumentation import (
+    COMMIT_SECONDS,
+    FUNCTION_SECONDS,
+    STATEMENT_ROWS,
+    PrometheusSink,
+)
+from users_db.role_permissions import ROLE_ADMIN, permissions_cache
+from users_db.schema import Role, role_permission, users
+
+
+def run(coro):
+    # asyncpg connections are bound to their event loop, every test runs in a
+    # new loop, so the pool is disposed at the end
+    async def main():
+        try:
+            return await coro
+        finally:
+            await dispose_engine()
+
+    return asyncio.run(main())
+
+
+USER_DATA = {
+    "first_name": "John",
+    "middle_name": "E.",
+    "last_name": "Doe",
+    "email": "aio@email.com",
+    "password": "password",
+    "role": "USER",
+}
+
+
+def test_aio_user_crud(db_connection):
+    async def scenario():
+        user_id = await aio_users.create_user(**USER_DATA)
+        user = await aio_users.get_user(user_id)
+        hashed = await aio_users.get_hashed_password_by_email(USER_DATA["email"])
+        updated = await aio_users.update_user(user_id, middle_name="Emmanuel")
+        deleted = await aio_users.delete_user(user_id)
+        return user_id, user, hashed, updated, deleted
+
+    user_id, user, hashed, updated, deleted = run(scenario())
+
+    assert user["id"] == user_id
+    assert "password" not in user
+    for key in ("first_name", "middle_name", "last_name", "email", "role"):
+        assert user[key] == USER_DATA[key]
+    assert hashed == {
+        "id": user_id,
+        "email": USER_DATA["email"],
+        "hashed_password": USER_DATA["password"],
+    }
+    assert updated["middle_name"] == "Emmanuel"
+    assert deleted == 1
+
+
+def test_aio_get_users_paginated(users_data):
+    user_ids = [user["id"] for user in users_data]
+
+    async def scenario():
+        plain = await aio_users.get_users(user_ids=user_ids)
+        offset = await aio_users.get_users(
+            user_ids=user_ids, is_paginated=True, page=2, page_size=10
+        )
+        keyset = await aio_users.get_users(
+            user_ids=user_ids, is_paginated=True, pagination="keyset", page_size=10
+        )
+        return plain, offset, keyset
+
+    plain, offset, keyset = run(scenario())
+
+    assert len(plain) == len(user_ids)
+    assert offset["items_count"] == len(user_ids)
+    assert offset["page"] == 2
+    assert len(offset["items"]) == 10
+    assert [item["id"] for item in keyset["items"]] == sorted(user_ids)[:10]
+
+
+def test_aio_nested_transaction_rollback(db_connection):
+    @db_transaction
+    async def create_and_fail(db_conn=None):
+        await aio_users.create_user(**USER_DATA)
+        # nested calls share the connection of the outermost call
+        assert current_connection.get() is db_conn
+        await aio_users.create_user(**USER_DATA)
+
+    with pytest.raises(DatabaseError):
+        run(create_and_fail())
+
+    assert current_connection.get() is None
+    rows = db_connection.execute(
+        select(users).where(users.c.email == USER_DATA["email"])
+    ).all()
+    assert rows == []
+
+
+def test_aio_savepoint(db_connection):
+    @db_savepoint
+    async def create_duplicate(db_conn=None):
+        await aio_users.create_user(**USER_DATA)
+
+    @db_transaction
+    async def create(db_conn=None):
+        user_id = await aio_users.create_user(**USER_DATA)
+        with pytest.raises(DatabaseError):
+            await create_duplicate()
+        # the transaction goes on after the savepoint is rolled back
+        return user_id, await aio_users.get_user(user_id)
+
+    user_id, user = run(create())
+    try:
+        assert user["email"] == USER_DATA["email"]
+    finally:
+        db_connection.execute(delete(users).where(users.c.id == user_id))
+        db_connection.commit()
+
+
+def test_aio_role_permissions(db_connection):
+    async def scenario():
+        permission_ids = await aio_role_permissions.create_permissions_for_role(
+            Role.ADMIN.name, ["read_test", "write_test"]
+        )
+        row = await aio_role_permissions.get_permissions_for_role(Role.ADMIN.name)
+        diff = await aio_role_permissions.update_role_permission_table_with_csv(
+            [
+                {"role": Role.ADMIN.name, "permission": "read_test"},
+                {"role": Role.USER.name, "permission": "read_test"},
+            ]
+        )
+        rows = await aio_role_permissions.get_role_permissions()
+        return permission_ids, row, diff, rows
+
+    permission_ids, row, diff, rows = run(scenario())
+
+    assert row["role"] == Role.ADMIN.name
+    assert [p["id"] for p in row["permissions"]] == permission_ids
+    assert diff["to_create_role_permissions"] == [(Role.USER.name, "read_test")]
+    assert diff["to_delete_role_permissions"] == [(Role.ADMIN.name, "write_test")]
+    assert {(r["role"], r["permission"]) for r in rows} == {
+        (Role.ADMIN.name, "read_test"),
+        (Role.USER.name, "read_test"),
+    }
+
+    db_connection.execute(delete(role_permission))
+    db_connection.commit()
+
+
+def test_aio_bulk_create_users(db_connection):
+    users_data = [
+        {**USER_DATA, "email": f"aio{i}@email.com", "first_name": f"John{i}"}
+        for i in range(5)
+    ]
+    user_ids = run(aio_users.bulk_create_users(users_data, batch_size=2))
+
+    rows = db_connection.execute(
+        select(users.c.id, users.c.first_name).where(users.c.id.in_(user_ids))
+    ).all()
+    assert dict(rows) == {
+        user_id: user_data["first_name"]
+        for user_id, user_data in zip(user_ids, users_data)
+    }
+
+    db_connection.execute(delete(users).where(users.c.id.in_(user_ids)))
+    db_connection.commit()
+
+
+def test_aio_permission_set_cache(db_connection):
+    permissions_cache.clear()
+
+    async def scenario():
+        before = await aio_role_permissions.get_permission_set(Role.ADMIN)
+        permission_id = await aio_role_permissions.create_permission_for_role(
+            Role.ADMIN.name, "aio_cached_test"
+        )
+        after = await aio_role_permissions.get_permission_set(Role.ADMIN)
+        await aio_role_permissions.delete_role_permissions(id=permission_id)
+        return before, after
+
+    before, after = run(scenario())
+
+    assert before == frozenset()
+    assert after == {"aio_cached_test"}
+    assert permissions_cache.get(ROLE_ADMIN) is None
+
+
+def test_aio_permission_set_in_write_transaction(db_connection):
+    permissions_cache.clear()
+
+    async def scenario():
+        with pytest.raises(ValueError):
+            async with users_db.aio.transaction():
+                await aio_role_permissions.create_permission_for_role(
+                    ROLE_ADMIN, "aio_uncommitted_test"
+                )
+                inside = await aio_role_permissions.get_permission_set(ROLE_ADMIN)
+                cached = permissions_cache.get(ROLE_ADMIN)
+                raise ValueError()
+        return inside, cached, await aio_role_permissions.get_permission_set(ROLE_ADMIN)
+
+    inside, cached, after = run(scenario())
+    # the uncommitted grant is seen by its transaction only, never cached
+    assert inside == {"aio_uncommitted_test"}
+    assert cached is None
+    assert after == frozenset()
+    permissions_cache.clear()
+
+
+def test_aio_has_permission(db_connection):
+    permissions_cache.clear()
+
+    async def scenario():
+        permission_id = await aio_role_permissions.create_permission_for_role(
+            ROLE_ADMIN, "aio_has_test"
+        )
+        try:
+            return (
+                await aio_role_permissions.has_permission(Role.ADMIN, "aio_has_test"),
+                await aio_role_permissions.has_permissions(
+                    ROLE_ADMIN, ["aio_has_test", "other"], use_cache=False
+                ),
+            )
+        finally:
+            await aio_role_permissions.delete_role_permissions(id=permission_id)
+
+    assert run(scenario()) == (True, [True, False])
+
+
+def test_aio_get_users_typed(users_data):
+    user_ids = [user["id"] for user in users_data]
+
+    rows = run(aio_users.get_users(user_ids=user_ids, typed=True))
+    assert sorted(row.id for row in rows) == sorted(user_ids)
+    assert run(aio_users.get_user(-1, typed=True)) == []
+
+
+def test_aio_iter_users(users_data):
+    user_ids = [user["id"] for user in users_data]
+
+    async def scenario():
+        ids = [row["id"] async for row in aio_users.iter_users(user_ids=user_ids)]
+
+        rows = aio_users.iter_users(user_ids=user_ids, chunk_size=7, batches=True)
+        first = await rows.__anext__()
+        await rows.aclose()
+        return ids, first
+
+    ids, first = run(scenario())
+    assert sorted(ids) == sorted(user_ids)
+    assert len(first) == 7
+
+
+def test_aio_search_users_bad_arguments():
+    with pytest.raises(ValueError):
+        run(aio_users.search_users(" "))
+
+
+def test_aio_transaction(users_data):
+    user_id = users_data[0]["id"]
+
+    async def scenario():
+        async with users_db.aio.transaction(isolation_level="REPEATABLE READ") as tx:
+            await aio_users.update_user(user_id, middle_name="aio unit of work")
+            isolation = await tx.connection.execute(text("SHOW transaction_isolation"))
+            async with users_db.aio.transaction(savepoint=True):
+                await aio_users.update_user(user_id, middle_name="kept")
+        return isolation.scalar(), await aio_users.get_user(user_id)
+
+    isolation, user = run(scenario())
+    assert isolation == "repeatable read"
+    assert user["middle_name"] == "kept"
+
+
+def test_aio_transaction_bad_options():
+    async def scenario():
+        with pytest.raises(DatabaseError):
+            async with users_db.aio.transaction(isolation_level="BOGUS"):
+                pass
+        # the connection is returned to the pool, not left to the garbage collector
+        return pool_metrics.in_use
+
+    assert run(scenario()) == 0
+
+
+def test_aio_read_transaction_routing(users_data, monkeypatch):
+    uri = config.get_postgres_uri()
+    monkeypatch.setenv("DB_REPLICA_URIS", f"{uri},{uri}")
+    monkeypatch.setenv("DB_READ_YOUR_WRITES_WINDOW", "60")
+
+    @db_read_transaction
+    async def read_engine(db_conn=None):
+        return db_conn.engine
+
+    async def scenario():
+        replicas = get_replicas().engines
+        user = await aio_users.get_user(users_data[0]["id"])
+        reads = [await read_engine(), await read_engine()]
+        await aio_users.update_user(users_data[0]["id"], middle_name="primary")
+        # read-your-writes: the reads of this task go to the primary
+        read_after_write = await read_engine()
+        return replicas, user, reads, read_after_write is get_engine()
+
+    replicas, user, reads, on_primary = run(scenario())
+    assert user["id"] == users_data[0]["id"]
+    assert set(reads) == set(replicas)
+    assert on_primary
+
+
+def test_aio_configure_engine_and_replicas(users_data):
+    @db_read_transaction
+    async def read_engine(db_conn=None):
+        return db_conn.engine
+
+    async def scenario():
+        engine = await configure_engine(pool_size=2, max_overflow=1)
+        uri = config.get_postgres_async_uri()
+        replicas = await configure_replicas(uris=[uri], read_your_writes_window=60)
+        try:
+            sizes = [e.sync_engine.pool.size() for e in (engine, *replicas.engines)]
+            reads = [await read_engine()]
+            # a transaction that wrote nothing starts no read-your-writes window
+            async with users_db.aio.transaction():
+                await aio_users.get_user(users_data[0]["id"])
+            reads.append(await read_engine())
+            await aio_users.update_user(users_data[0]["id"], middle_name="primary")
+            reads.append(await read_engine())
+            return sizes, reads, replicas.engines[0], get_engine()
+        finally:
+            await configure_replicas()
+            await configure_engine()
+
+    sizes, reads, replica, primary = run(scenario())
+    assert sizes == [2, 2]
+    assert reads == [replica, replica, primary]
+
+
+def test_aio_configure_engine_poolclass(users_data):
+    async def scenario():
+        engine = await configure_engine(poolclass=NullPool)
+        try:
+            with pytest.raises(TypeError):
+                await configure_engine(no_such_option=True)
+            user = await aio_users.get_user(users_data[0]["id"])
+            return engine, get_engine(), user
+        finally:
+            await configure_engine()
+
+    engine, current, user = run(scenario())
+    assert isinstance(engine.sync_engine.pool, NullPool)
+    assert current is engine
+    assert user["id"] == users_data[0]["id"]
+
+
+def test_aio_instrumentation(users_data):
+    sink = PrometheusSink()
+    instrumentation.enable(sink)
+    try:
+        run(aio_users.get_user(users_data[0]["id"]))
+    finally:
+        instrumentation.disable()
+
+    function = "users_db.aio.users.get_user"
+    assert sink.get(FUNCTION_SECONDS, function=function, status="ok").count == 1
+    assert sink.get(STATEMENT_ROWS, statement="select").sum == 1
+    assert sink.get(COMMIT_SECONDS).count == 1
+
+
+def test_aio_slow_query_log(users_data, caplog):
+    caplog.set_level(logging.WARNING, logger="users_db.slow_queries")
+    slow_queries.enable(threshold=0, explain_sample=1)
+    try:
+        run(aio_users.get_user(users_data[0]["id"]))
+    finally:
+        slow_queries.disable()
+
+    (record,) = caplog.records
+    assert record.slow_query["function"] == "users_db.aio.users.get_user"
+    assert record.slow_query["parameters"] == ["?"]
+    assert "actual time" in record.slow_query["plan"]
@@ -0,0 +1,126 @@
+import json
+import threading
+
+from click.testing import CliRunner
+from sqlalchemy import delete, func, insert, select
+
+from users_db import bench, db
+from users_db.bench import (
+    BENCH_USERS,
+    ConnectionOwners,
+    LoadAnomaly,
+    bench_cmd,
+    compare_results,
+)
+from users_db.schema import role_permission, users
+
+
+def test_bench_run_and_compare(db_connection, tmp_path):
+    db_connection.execute(
+        insert(role_permission).values(role="ADMIN", permission="kept_by_bench")
+    )
+    db_connection.commit()
+    output = tmp_path / "results.json"
+    try:
+        runner = CliRunner()
+        result = runner.invoke(
+            bench_cmd,
+            ["run", "--sizes", "300,600", "--calls", "3", "--output", str(output)],
+        )
+        assert result.exit_code == 0, result.output
+
+        results = json.loads(output.read_text())
+        assert list(results["results"]) == ["300", "600"]
+        stats = results["results"]["600"]["get_users[keyset, deep page]"]
+        assert stats["calls"] == 3
+        assert stats["p99_ms"] >= stats["p50_ms"] > 0
+
+        # the bench users are deleted and role_permissions restored
+        bench_users = select(func.count()).select_from(users).where(BENCH_USERS)
+        assert db_connection.execute(bench_users).scalar() == 0
+        permissions = db_connection.execute(select(role_permission.c.permission))
+        assert permissions.scalars().all() == ["kept_by_bench"]
+
+        result = runner.invoke(bench_cmd, ["compare", str(output), str(output)])
+        assert result.exit_code == 0, result.output
+        assert "+0.0%" in result.output
+    finally:
+        db_connection.execute(delete(role_permission))
+        db_connection.commit()
+
+
+def test_bench_load(db_connection, tmp_path):
+    output = tmp_path / "load.json"
+    args = ["--threads", "4", "--duration", "1", "--users", "200", "--mix", "1:1"]
+    result = CliRunner().invoke(bench_cmd, ["load", *args, "--output", str(output)])
+    assert result.exit_code == 0, result.output
+    assert "no connection or transaction leak detected" in result.output
+
+    report = json.loads(output.read_text())
+    assert report["anomalies"] == []
+    assert report["ops"]["write_commit"]["calls"] > 0
+    assert report["ops"]["get_user"]["errors"] == 0
+
+    bench_users = select(func.count()).select_from(users).where(BENCH_USERS)
+    assert db_connection.execute(bench_users).scalar() == 0
+
+
+def test_bench_load_reports_anomalies(monkeypatch):
+    # a transaction whose nested calls run on another connection
+    monkeypatch.setattr(bench, "current_connection", lambda: None)
+    result = CliRunner().invoke(
+        bench_cmd, ["load", "--threads", "2", "--duration", "0.2", "--users", "10"]
+    )
+    assert result.exit_code != 0
+    assert "nested call left the transaction connection" in result.output
+
+
+def test_connection_owners():
+    owners = ConnectionOwners()
+    connection = object()
+    owners.claim(connection)
+    owners.claim(connection)
+
+    errors = []
+
+    def claim():
+        try:
+            owners.claim(connection)
+        except LoadAnomaly as err:
+            errors.append(err)
+
+    thread = threading.Thread(target=claim)
+    thread.start()
+    thread.join()
+    assert len(errors) == 1
+
+    owners.release(connection)
+    thread = threading.Thread(target=claim)
+    thread.start()
+    thread.join()
+    assert len(errors) == 1
+
+
+def test_role_permissions_snapshot_reads_the_primary(monkeypatch):
+    def read_engine():
+        raise AssertionError("the snapshot was read on a replica")
+
+    monkeypatch.setattr(db, "get_read_engine", read_engine)
+    assert bench.snapshot_role_permissions() == []
+
+
+def test_bench_refuses_a_database_with_users(users_data):
+    result = CliRunner().invoke(bench_cmd, ["run", "--sizes", "10"])
+    assert result.exit_code != 0
+    assert "scratch database" in result.output
+
+
+def test_compare_results():
+    baseline = {"results": {"10": {"get_user": {"p50_ms": 1.0}}}}
+    current = {
+        "results": {"10": {"get_user": {"p50_ms": 1.5}, "new_case": {"p50_ms": 1.0}}}
+    }
+    assert compare_results(baseline, current, 0.1) == [
+        ("10", "get_user", 1.0, 1.5, 1.5, True)
+    ]
+    assert compare_results(baseline, current, 0.6)[0][-1] is False
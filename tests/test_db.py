@@ -1,39 +1,53 @@
+import os
+import subprocess
+import sys
+import threading
+
 import pytest
-from users_db.db import base_transaction, thread_local
+from sqlalchemy import NullPool, event, select, text
+
+import users_db
+from users_db import config, db, routing
+from users_db.db import (
+    base_transaction,
+    current_scope,
+    db_read_transaction,
+    db_savepoint,
+    db_stream,
+    db_transaction,
+)
 from users_db.errors import DatabaseError, UserDatabaseError
+from users_db.routing import ReplicaSet, mark_write
+from users_db.schema import users
+from users_db.users import create_user, get_user, get_users, update_user
 
 
 class fake_transaction(base_transaction):
-    def __init__(self, func):
-        super().__init__(func)
-        self.func = func
-        self.connection = None
-
-    def get_connection(self):
-        transaction = (
-            thread_local.transaction_stack[-1]
-            if thread_local.transaction_stack
-            else None
-        )
-        return transaction.connection if transaction else None
-
     def open_connection(self):
-        if self.connection is None:
-            print("Opening connection...")
-            self.connection = "opened"
+        print("Opening connection...")
+        return "opened"
+
+    def close_connection(self, connection):
+        print("Closing connection...")
+
+    def commit(self, connection):
+        print("Committing...")
+
+    def rollback(self, connection):
+        print("Rolling back...")
 
-    def close_connection(self):
-        if self.connection and self.connection != "closed":
-            self.connection = "closed"
-            print("Closing connection...")
+    def configure(self, connection, **options):
+        pass
 
-    def commit(self):
-        if self.connection and self.connection != "closed":
-            print("Committing...")
+    def begin_savepoint(self, connection):
+        print("Savepoint...")
+        return connection
 
-    def rollback(self):
-        if self.connection and self.connection != "closed":
-            print("Rolling back...")
+    def rollback_savepoint(self, savepoint):
+        print("Rolling back to savepoint...")
+
+    def release_savepoint(self, savepoint):
+        print("Releasing savepoint...")
 
 
 def test_transaction_decorator(capsys):
@@ -60,8 +74,8 @@ def test_transaction_decorator(capsys):
     captured = capsys.readouterr()
     assert captured.out == expected_output, "Test failed"
 
-    # Check that the transaction stack was cleared
-    assert not thread_local.transaction_stack, "Test failed"
+    # Check that the transaction scope was cleared
+    assert current_scope.get() is None, "Test failed"
 
 
 def test_transaction_decorator_failed(capsys):
@@ -91,5 +105,356 @@ def test_transaction_decorator_failed(capsys):
     captured = capsys.readouterr()
     assert captured.out == expected_output, "Test failed"
 
-    # Check that the transaction stack was cleared
-    assert not thread_local.transaction_stack, "Test failed"
+    # Check that the transaction scope was cleared
+    assert current_scope.get() is None, "Test failed"
+
+
+def test_transaction_decorator_rolls_back_any_exception(capsys):
+    @fake_transaction
+    def func1(db_conn=None):
+        raise ValueError("not a database error")
+
+    with pytest.raises(ValueError):
+        func1()
+
+    expected_output = "Opening connection...\nRolling back...\nClosing connection...\n"
+    captured = capsys.readouterr()
+    assert captured.out == expected_output
+    assert current_scope.get() is None
+
+
+def test_savepoint(db_connection):
+    emails = ["savepoint@email.com", "savepoint_2@email.com"]
+
+    def create(email):
+        return create_user("John", None, "Doe", email, "password", "USER")
+
+    @db_savepoint
+    def create_duplicate(db_conn=None):
+        create(emails[1])
+        create(emails[0].upper())
+
+    @db_transaction
+    def outer(db_conn=None):
+        create(emails[0])
+        with pytest.raises(DatabaseError):
+            create_duplicate()
+        # the savepoint rolled back the inserts of create_duplicate only, the
+        # transaction goes on
+        return get_users(email=emails[0])["email"]
+
+    try:
+        assert outer() == emails[0]
+        rows = db_connection.execute(
+            select(users.c.email).where(users.c.email.in_(emails))
+        ).all()
+        assert rows == [(emails[0],)]
+    finally:
+        db_connection.execute(users.delete().where(users.c.email.in_(emails)))
+        db_connection.commit()
+
+
+def test_transaction_scope_per_thread():
+    barrier = threading.Barrier(4)
+    connections = []
+
+    @db_transaction
+    def nested(db_conn=None):
+        return db_conn
+
+    @db_transaction
+    def outer(db_conn=None):
+        # all of the threads are inside a transaction at once
+        barrier.wait(timeout=5)
+        assert nested() is db_conn
+        connections.append(db_conn)
+
+    threads = [threading.Thread(target=outer) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(map(id, connections))) == 4
+    assert current_scope.get() is None
+
+
+def test_transaction_commits_once(users_data):
+    commits = []
+
+    def count_commit(conn):
+        commits.append(conn)
+
+    engine = db.get_engine()
+    event.listen(engine, "commit", count_commit)
+    try:
+        with users_db.transaction() as tx:
+            for user in users_data[:20]:
+                update_user(user["id"], middle_name="unit of work")
+            assert get_user(users_data[0]["id"])["middle_name"] == "unit of work"
+            assert current_scope.get() is tx
+    finally:
+        event.remove(engine, "commit", count_commit)
+
+    assert len(commits) == 1
+    assert len(get_users(middle_name="unit of work")) == 20
+
+
+def test_transaction_rolls_back(users_data):
+    with pytest.raises(ValueError):
+        with users_db.transaction():
+            update_user(users_data[0]["id"], middle_name="rolled back")
+            raise ValueError()
+
+    assert get_user(users_data[0]["id"])["middle_name"] == users_data[0]["middle_name"]
+
+
+def test_transaction_savepoint(users_data):
+    user_id = users_data[0]["id"]
+    with users_db.transaction():
+        update_user(user_id, middle_name="kept")
+        with pytest.raises(ValueError):
+            with users_db.transaction(savepoint=True):
+                update_user(user_id, middle_name="rolled back")
+                raise ValueError()
+        assert get_user(user_id)["middle_name"] == "kept"
+
+        with pytest.raises(ValueError):
+            with users_db.transaction(read_only=True):
+                pass
+
+    assert get_user(user_id)["middle_name"] == "kept"
+
+
+def test_transaction_options(users_data):
+    show_isolation = text("SHOW transaction_isolation")
+    with users_db.transaction(isolation_level="SERIALIZABLE", read_only=True) as tx:
+        assert tx.connection.execute(show_isolation).scalar() == "serializable"
+        with pytest.raises(DatabaseError):
+            update_user(users_data[0]["id"], middle_name="read only")
+
+    # the options do not outlive the transaction
+    with users_db.transaction() as tx:
+        assert tx.connection.execute(show_isolation).scalar() == "read committed"
+
+
+def test_configure_engine():
+    default_engine = db.engine
+    try:
+        engine = db.configure_engine(pool_size=2, max_overflow=1, pool_use_lifo=True)
+        assert db.engine is engine
+        assert engine.pool.size() == 2
+        assert engine.pool._max_overflow == 1
+
+        get_users(user_ids=[-1])
+        metrics = db.get_pool_metrics()
+        assert metrics["checkouts"] == 1
+        assert metrics["checkout_wait_max"] >= metrics["checkout_wait_avg"] > 0
+        assert metrics["size"] == 2
+        assert metrics["checked_out"] == 0
+        assert metrics["checked_in"] == 1
+    finally:
+        db.configure_engine()
+
+    assert db.engine is not default_engine
+    assert db.engine.pool.size() == 5
+
+
+def test_configure_engine_poolclass(users_data):
+    try:
+        # the QueuePool defaults of config.get_engine_options() are not passed
+        engine = db.configure_engine(poolclass=NullPool)
+        assert isinstance(engine.pool, NullPool)
+        assert get_user(users_data[0]["id"])["id"] == users_data[0]["id"]
+    finally:
+        db.configure_engine()
+
+
+def test_configure_engine_keeps_the_engine_on_error():
+    engine = db.configure_engine(pool_size=2)
+    try:
+        with pytest.raises(TypeError):
+            db.configure_engine(pool_size=3, no_such_option=True)
+        assert db.engine is engine
+        assert db.get_engine().pool.size() == 2
+        get_users(user_ids=[-1])
+    finally:
+        db.configure_engine()
+
+
+def test_engine_is_created_lazily():
+    code = (
+        "import sys, users_db.users, users_db.db as db;"
+        "print(db._engine is None, 'psycopg2' in sys.modules)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    ).stdout
+    assert output.split() == ["True", "False"]
+
+
+def test_import_does_not_load_the_dialect():
+    # the postgresql dialect and the driver are loaded by the engine creation
+    code = (
+        "import sys, users_db.users, users_db.role_permissions, users_db.bench;"
+        "print(any(name.startswith('sqlalchemy.dialects.postgresql')"
+        " or name.startswith('psycopg') for name in sys.modules));"
+        "users_db.transaction;"
+        "import users_db.db as db; print(db._engine is None)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    ).stdout
+    assert output.split() == ["False", "True"]
+
+    code = "import sys, users_db.config; print('sqlalchemy' in sys.modules)"
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    ).stdout
+    assert output.split() == ["False"]
+
+
+def test_engine_is_recreated_after_fork(monkeypatch):
+    parent_engine = db.get_engine()
+    assert db.get_engine() is parent_engine
+
+    # pretend the engine was created by a parent process
+    monkeypatch.setattr(db, "_engine_pid", -1)
+    child_engine = db.get_engine()
+
+    assert child_engine is not parent_engine
+    assert db._engine_pid == os.getpid()
+    assert get_users(user_ids=[-1]) is None
+
+
+def test_transform_rows(users_data, db_connection):
+    stmt = select(users.c.id, users.c.password, users.c.role.label("user_role"))
+    stmt = stmt.where(users.c.id == users_data[0]["id"])
+
+    rows = db.transform_rows(stmt, db_connection.execute(stmt))
+    assert rows == [{"id": users_data[0]["id"], "user_role": "USER"}]
+
+    # without column metadata every value is checked
+    text_stmt = text("select id, password, role from users where id = :id")
+    result = db_connection.execute(text_stmt, {"id": users_data[0]["id"]})
+    assert db.transform_rows(text_stmt, result) == [
+        {"id": users_data[0]["id"], "role": "USER"}
+    ]
+
+    assert db.compile_row_transformer(
+        db.result_signature(stmt, ("id", "password", "user_role"))
+    ) is db.compile_row_transformer(
+        (("id", db.COLUMN_PLAIN), ("password", db.COLUMN_PLAIN), ("user_role", "enum"))
+    )
+
+
+def test_pool_metrics_of_replicas_and_streams(users_data):
+    user_ids = [user["id"] for user in users_data]
+    db.configure_replicas(uris=[config.get_postgres_uri()])
+    try:
+        db.pool_metrics.reset()
+        stream = db_stream(select(users.c.id).where(users.c.id.in_(user_ids)), 7)
+        next(stream)
+        # the stream holds a replica connection until it is closed
+        assert db.get_pool_metrics()["in_use"] == 1
+        stream.close()
+        get_user(users_data[0]["id"])
+        metrics = db.get_pool_metrics()
+        assert metrics["checkouts"] == 2
+        assert metrics["in_use"] == 0
+    finally:
+        db.configure_replicas()
+
+
+@db_read_transaction
+def read_engine(db_conn=None):
+    return db_conn.engine
+
+
+def test_read_transaction_routing(users_data):
+    uri = config.get_postgres_uri()
+    replicas = db.configure_replicas(uris=[uri, uri], read_your_writes_window=60)
+    # the read-your-writes window of this test must not outlive it
+    token = routing.last_write_commit.set(float("-inf"))
+    try:
+        # round-robin over the replicas
+        first, second = read_engine(), read_engine()
+        assert {first, second} == set(replicas.engines)
+        assert read_engine() is first
+        assert get_user(users_data[0]["id"])["id"] == users_data[0]["id"]
+
+        # a transaction that wrote nothing starts no read-your-writes window
+        with users_db.transaction():
+            assert get_user(users_data[0]["id"])["id"] == users_data[0]["id"]
+        assert read_engine() in replicas.engines
+
+        # a read inside a write transaction stays on the primary
+        with users_db.transaction():
+            update_user(users_data[0]["id"], middle_name="primary")
+            assert read_engine() is db.get_engine()
+
+        # the write was committed: the reads of this thread go to the primary
+        # during the read-your-writes window, the other threads are not affected
+        assert read_engine() is db.get_engine()
+        engines = []
+        thread = threading.Thread(target=lambda: engines.append(read_engine()))
+        thread.start()
+        thread.join()
+        assert engines[0] in replicas.engines
+
+        replicas = db.configure_replicas(uris=[uri, uri], balancing="least_connections")
+        with replicas.engines[0].connect():
+            assert read_engine() is replicas.engines[1]
+            assert read_engine() is replicas.engines[1]
+    finally:
+        routing.last_write_commit.reset(token)
+        db.configure_replicas()
+
+    assert db.get_replicas() is None
+    assert read_engine() is db.get_engine()
+
+    with pytest.raises(ValueError):
+        ReplicaSet([db.get_engine()], balancing="random")
+
+
+def test_writes_are_tracked_with_replicas_only():
+    def tracking():
+        return event.contains(db.get_engine(), "after_cursor_execute", mark_write)
+
+    assert db.get_replicas() is None
+    assert not tracking()
+    db.configure_replicas(uris=[config.get_postgres_uri()])
+    try:
+        assert tracking()
+        # the replicas are created again with the options of the new engine
+        db.configure_engine(pool_size=2)
+        assert tracking()
+        assert [e.pool.size() for e in db.get_replicas().engines] == [2]
+    finally:
+        db.configure_replicas()
+        db.configure_engine()
+    assert not tracking()
+
+
+@pytest.mark.skipif(
+    not os.environ.get("DB_TEST_REPLICA_URI"),
+    reason="needs a streaming replica of the database at DB_TEST_REPLICA_URI",
+)
+def test_read_replica():
+    in_recovery = text("SELECT pg_is_in_recovery()")
+
+    @db_read_transaction
+    def on_replica(db_conn=None):
+        return db_conn.execute(in_recovery).scalar()
+
+    db.configure_replicas(uris=[os.environ["DB_TEST_REPLICA_URI"]])
+    try:
+        assert on_replica() is True
+        with users_db.transaction() as tx:
+            assert on_replica() is False
+            assert tx.connection.execute(in_recovery).scalar() is False
+        # the replica rejects writes
+        with pytest.raises(DatabaseError):
+            db_read_transaction(update_user.func)(-1, middle_name="replica")
+    finally:
+        db.configure_replicas()
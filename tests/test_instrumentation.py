@@ -0,0 +1,118 @@
+import pytest
+
+from users_db import instrumentation
+from users_db.errors import DatabaseError
+from users_db.instrumentation import (
+    COMMIT_SECONDS,
+    CONNECTION_ACQUIRE_SECONDS,
+    FUNCTION_SECONDS,
+    STATEMENT_ROWS,
+    STATEMENT_SECONDS,
+    Histogram,
+    OpenTelemetrySink,
+    PrometheusSink,
+)
+from users_db.users import create_user, get_user, get_users
+
+
+@pytest.fixture
+def sink():
+    sink = PrometheusSink()
+    instrumentation.enable(sink)
+    yield sink
+    instrumentation.disable()
+
+
+def test_prometheus_sink(sink, users_data):
+    user_ids = [user["id"] for user in users_data]
+    get_user(user_ids[0])
+    get_users(user_ids=user_ids)
+
+    get_user_seconds = sink.get(
+        FUNCTION_SECONDS, function="users_db.users.get_user", status="ok"
+    )
+    assert get_user_seconds.count == 1
+    assert get_user_seconds.sum > 0
+
+    rows = sink.get(STATEMENT_ROWS, statement="select")
+    assert rows.count == 2
+    assert rows.sum == 1 + len(user_ids)
+    assert sink.get(STATEMENT_SECONDS, statement="select").count == 2
+    assert sink.get(CONNECTION_ACQUIRE_SECONDS, engine="primary").count == 2
+    assert sink.get(COMMIT_SECONDS).count == 2
+
+    text = sink.render()
+    assert "# TYPE users_db_function_seconds histogram" in text
+    assert 'users_db_statement_rows_bucket{statement="select",le="+Inf"} 2' in text
+    assert "users_db_commit_seconds_count 2" in text
+
+
+def test_function_error_status(sink, users_data):
+    with pytest.raises(DatabaseError):
+        create_user("John", None, "Doe", users_data[0]["email"], "password", "USER")
+
+    histogram = sink.get(
+        FUNCTION_SECONDS, function="users_db.users.create_user", status="error"
+    )
+    assert histogram.count == 1
+    assert sink.get(COMMIT_SECONDS) is None
+
+
+def test_disabled(users_data):
+    calls = []
+    instrumentation.enable(lambda *args: calls.append(args))
+    instrumentation.disable()
+
+    get_user(users_data[0]["id"])
+    assert calls == []
+
+
+def test_broken_sink_does_not_fail_calls(users_data):
+    def sink(metric, value, labels):
+        raise RuntimeError()
+
+    instrumentation.enable(sink)
+    try:
+        assert get_user(users_data[0]["id"])["id"] == users_data[0]["id"]
+    finally:
+        instrumentation.disable()
+
+
+def test_histogram_buckets():
+    histogram = Histogram((1, 10))
+    for value in (0, 1, 5, 10, 11):
+        histogram.observe(value)
+    assert histogram.cumulative_counts() == [(1, 2), (10, 4), (float("inf"), 5)]
+
+
+def test_open_telemetry_sink(users_data):
+    spans = []
+
+    class Span:
+        def __init__(self, name, start_time, attributes):
+            self.name = name
+            self.start_time = start_time
+            self.attributes = attributes
+
+        def end(self, end_time):
+            self.end_time = end_time
+            spans.append(self)
+
+    class Tracer:
+        def start_span(self, name, start_time, attributes):
+            return Span(name, start_time, attributes)
+
+    instrumentation.enable(OpenTelemetrySink(Tracer()))
+    try:
+        get_user(users_data[0]["id"])
+    finally:
+        instrumentation.disable()
+
+    assert [span.name for span in spans] == [
+        CONNECTION_ACQUIRE_SECONDS,
+        "users_db select",
+        COMMIT_SECONDS,
+        "users_db.users.get_user",
+    ]
+    assert all(span.end_time >= span.start_time for span in spans)
+    assert spans[-1].attributes["status"] == "ok"
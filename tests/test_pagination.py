@@ -1,5 +1,8 @@
 import pytest
 import math
+from sqlalchemy import delete
+from users_db.pagination import count_cache
+from users_db.schema import users as users_table
 from users_db.users import get_users
 
 
@@ -23,3 +26,214 @@ def test_pagination_miss_arguments():
         get_users(is_paginated=True, page=1)
     with pytest.raises(ValueError):
         get_users(is_paginated=True, page_size=10)
+
+
+def test_keyset_pagination(users_data):
+    user_ids = [user["id"] for user in users_data]
+    PAGE_SIZE = 10
+
+    # walk forward through all of the pages
+    pages = []
+    cursor = None
+    while True:
+        users = get_users(
+            user_ids=user_ids,
+            is_paginated=True,
+            pagination="keyset",
+            page_size=PAGE_SIZE,
+            cursor=cursor,
+        )
+        assert len(users["items"]) <= PAGE_SIZE
+        assert all("password" not in item for item in users["items"])
+        pages.append([item["id"] for item in users["items"]])
+        cursor = users["next_cursor"]
+        if cursor is None:
+            break
+
+    assert [user_id for page in pages for user_id in page] == sorted(user_ids)
+    assert len(pages) == math.ceil(len(user_ids) / PAGE_SIZE)
+
+    # walk back from the last page
+    cursor = users["prev_cursor"]
+    for expected in reversed(pages[:-1]):
+        users = get_users(
+            user_ids=user_ids,
+            is_paginated=True,
+            pagination="keyset",
+            page_size=PAGE_SIZE,
+            cursor=cursor,
+        )
+        assert [item["id"] for item in users["items"]] == expected
+        cursor = users["prev_cursor"]
+    assert cursor is None
+
+
+def test_keyset_pagination_order_by(users_data):
+    user_ids = [user["id"] for user in users_data]
+    expected = [
+        user["id"]
+        for user in sorted(users_data, key=lambda u: (u["last_name"], u["id"]))
+    ]
+
+    result = []
+    cursor = None
+    while True:
+        users = get_users(
+            user_ids=user_ids,
+            is_paginated=True,
+            pagination="keyset",
+            page_size=7,
+            cursor=cursor,
+            order_by="last_name",
+        )
+        result.extend(item["id"] for item in users["items"])
+        cursor = users["next_cursor"]
+        if cursor is None:
+            break
+
+    assert result == expected
+
+
+def test_keyset_pagination_typed(users_data):
+    user_ids = [user["id"] for user in users_data]
+
+    users = get_users(
+        user_ids=user_ids,
+        is_paginated=True,
+        pagination="keyset",
+        page_size=60,
+        order_by="last_name",
+        typed=True,
+    )
+    assert [item.last_name for item in users["items"]] == sorted(
+        user["last_name"] for user in users_data
+    )[:60]
+    assert not hasattr(users["items"][0], "password")
+
+    users = get_users(
+        user_ids=user_ids,
+        is_paginated=True,
+        pagination="keyset",
+        page_size=60,
+        order_by="last_name",
+        cursor=users["next_cursor"],
+        typed=True,
+    )
+    assert len(users["items"]) == len(user_ids) - 60
+
+    with pytest.raises(ValueError):
+        get_users(is_paginated=True, page=1, page_size=10, typed=True)
+
+
+def test_keyset_pagination_bad_arguments():
+    with pytest.raises(ValueError):
+        get_users(is_paginated=True, pagination="keyset")
+    with pytest.raises(ValueError):
+        get_users(
+            is_paginated=True, pagination="keyset", page_size=10, cursor="garbage"
+        )
+    with pytest.raises(ValueError):
+        get_users(
+            is_paginated=True,
+            pagination="keyset",
+            page_size=10,
+            order_by="middle_name",
+        )
+
+
+def test_pagination_count_mode_none(users_data):
+    user_ids = [user["id"] for user in users_data]
+    PAGE_SIZE = 10
+    PAGES = math.ceil(len(user_ids) / PAGE_SIZE)
+
+    for page in range(1, PAGES + 1):
+        users = get_users(
+            user_ids=user_ids,
+            is_paginated=True,
+            page=page,
+            page_size=PAGE_SIZE,
+            count_mode="none",
+        )
+        assert users["items_count"] is None
+        assert users["pages"] is None
+        assert len(users["items"]) <= PAGE_SIZE
+        assert users["has_next"] == (page < PAGES)
+
+
+def test_pagination_count_mode_estimated(users_data):
+    users = get_users(is_paginated=True, page=1, page_size=10, count_mode="estimated")
+    assert isinstance(users["items_count"], int)
+    assert users["pages"] == math.ceil(users["items_count"] / 10)
+
+
+def test_pagination_count_mode_cached(users_data, db_connection):
+    user_ids = [user["id"] for user in users_data]
+    count_cache.clear()
+
+    users = get_users(
+        user_ids=user_ids, is_paginated=True, page=1, page_size=10, count_mode="cached"
+    )
+    assert users["items_count"] == len(user_ids)
+
+    # the count for the same filter set is served from the cache
+    db_connection.execute(delete(users_table).where(users_table.c.id == user_ids[0]))
+    db_connection.commit()
+    users = get_users(
+        user_ids=user_ids, is_paginated=True, page=1, page_size=10, count_mode="cached"
+    )
+    assert users["items_count"] == len(user_ids)
+
+    # a different filter set is counted again
+    users = get_users(
+        user_ids=user_ids[:50],
+        is_paginated=True,
+        page=1,
+        page_size=10,
+        count_mode="cached",
+    )
+    assert users["items_count"] == 49
+    count_cache.clear()
+
+
+def test_keyset_pagination_items_count(users_data):
+    user_ids = [user["id"] for user in users_data]
+    users = get_users(
+        user_ids=user_ids,
+        is_paginated=True,
+        pagination="keyset",
+        page_size=10,
+        count_mode="exact",
+    )
+    assert users["items_count"] == len(user_ids)
+
+
+def test_pagination_bad_count_mode():
+    with pytest.raises(ValueError):
+        get_users(is_paginated=True, page=1, page_size=10, count_mode="maybe")
+
+
+def test_pagination_count_mode_window(users_data):
+    user_ids = [user["id"] for user in users_data]
+    PAGE_SIZE = 10
+    PAGES = math.ceil(len(user_ids) / PAGE_SIZE)
+
+    for page in range(1, PAGES + 2):
+        expected = get_users(
+            user_ids=user_ids, is_paginated=True, page=page, page_size=PAGE_SIZE
+        )
+        users = get_users(
+            user_ids=user_ids,
+            is_paginated=True,
+            page=page,
+            page_size=PAGE_SIZE,
+            count_mode="window",
+        )
+        assert list(users.keys()) == list(expected.keys())
+        assert users == expected
+
+    users = get_users(
+        user_ids=[-1], is_paginated=True, page=1, page_size=10, count_mode="window"
+    )
+    assert users["items_count"] == 0
+    assert users["pages"] == 0
+    assert users["items"] is None
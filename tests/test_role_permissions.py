@@ -1,10 +1,14 @@
 import pytest
 import csv
+import threading
+import time
 from io import StringIO
 
-from sqlalchemy import delete, select
+from sqlalchemy import delete, event, select
 
-from users_db.db import serialize_enums, dict_or_list
+import users_db
+from users_db import statements
+from users_db.db import get_engine, serialize_enums, dict_or_list
 from users_db.schema import Role, role_permission
 
 
@@ -17,6 +21,13 @@ from users_db.role_permissions import (
     delete_role_permissions,
     update_permissions_for_role,
     update_role_permission_table_with_csv,
+    PERMISSIONS_CHANNEL,
+    get_permission_set,
+    has_permission,
+    has_permissions,
+    permissions_cache,
+    start_permissions_listener,
+    stop_permissions_listener,
 )
 
 from users_db.role_permissions import (
@@ -52,6 +63,19 @@ def role_permission_dataset(db_connection):
     db_connection.commit()
 
 
+@pytest.fixture
+def statement_log():
+    executed = []
+
+    def log_statement(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    engine = get_engine()
+    event.listen(engine, "before_cursor_execute", log_statement)
+    yield executed
+    event.remove(engine, "before_cursor_execute", log_statement)
+
+
 def test_create_permission_for_role(db_connection):
     permission = "read_test"
     permission_id = create_permission_for_role(ROLE_ADMIN, permission)
@@ -267,3 +291,161 @@ SUPER_ADMIN,write_test_new
         )
     )
     db_connection.commit()
+
+
+def test_update_role_permission_table_with_csv_is_set_based(
+    db_connection, statement_log
+):
+    csv_list = [
+        {"role": role.name, "permission": f"permission_{i}"}
+        for role in Role
+        for i in range(1000)
+    ]
+
+    result = update_role_permission_table_with_csv(csv_list)
+    assert len(statement_log) == 2
+    assert len(result["to_create_role_permissions"]) == len(csv_list)
+    assert result["to_delete_role_permissions"] == []
+    assert result["unchanged_role_permissions"] == []
+
+    # the second sync is a no-op
+    statement_log.clear()
+    result = update_role_permission_table_with_csv(csv_list + csv_list[:10])
+    assert len(statement_log) == 2
+    assert result["to_create_role_permissions"] == []
+    assert result["to_delete_role_permissions"] == []
+    assert len(result["unchanged_role_permissions"]) == len(csv_list)
+
+    # an empty csv empties the table
+    result = update_role_permission_table_with_csv([])
+    assert len(result["to_delete_role_permissions"]) == len(csv_list)
+    rows = db_connection.execute(select(role_permission)).all()
+    assert rows == []
+
+
+def test_permissions_cache_listeners_per_transaction(role_permission_dataset):
+    with users_db.transaction() as tx:
+        permission_ids = [
+            create_permission_for_role(ROLE_ADMIN, f"listener_test_{n}")
+            for n in range(5)
+        ]
+        # the end of transaction listeners are registered once
+        assert len(tx.connection.dispatch.commit) == 1
+        assert len(tx.connection.dispatch.rollback) == 1
+
+        # the transaction sees its uncommitted rows, which are not cached
+        assert "listener_test_0" in get_permission_set(ROLE_ADMIN)
+        assert permissions_cache.get(ROLE_ADMIN) is None
+
+        # nor seen by the other threads
+        other_thread = []
+        thread = threading.Thread(
+            target=lambda: other_thread.append(get_permission_set(ROLE_ADMIN))
+        )
+        thread.start()
+        thread.join()
+        assert other_thread == [{"read_test", "write_test"}]
+
+    assert permissions_cache.get(ROLE_ADMIN) is None
+    assert "listener_test_0" in get_permission_set(ROLE_ADMIN)
+    delete_role_permissions(ids=permission_ids)
+
+
+def test_get_permission_set_cache(role_permission_dataset, statement_log):
+    permissions_cache.clear()
+
+    assert get_permission_set(ROLE_ADMIN) == {"read_test", "write_test"}
+    assert get_permission_set(Role.ADMIN) == {"read_test", "write_test"}
+    # the second call is served from the cache
+    assert len(statement_log) == 1
+
+    permission_id = create_permission_for_role(ROLE_ADMIN, "cached_test")
+    assert "cached_test" in get_permission_set(ROLE_ADMIN)
+
+    update_permissions_for_role(permission_id, permission="cached_test_2")
+    assert get_permission_set(ROLE_ADMIN) == {
+        "read_test",
+        "write_test",
+        "cached_test_2",
+    }
+
+    delete_role_permissions(id=permission_id)
+    assert get_permission_set(ROLE_ADMIN) == {"read_test", "write_test"}
+
+    create_permissions_for_role(ROLE_USER, ["cached_test"])
+    assert "cached_test" in get_permission_set(ROLE_USER)
+
+    update_role_permission_table_with_csv(
+        [{"role": ROLE_ADMIN, "permission": "read_test"}]
+    )
+    assert get_permission_set(ROLE_ADMIN) == {"read_test"}
+    assert get_permission_set(ROLE_USER) == frozenset()
+    permissions_cache.clear()
+
+
+def test_has_permission(role_permission_dataset, statement_log):
+    permissions_cache.clear()
+
+    assert has_permission(ROLE_ADMIN, "read_test") is True
+    assert has_permission(Role.ADMIN, "delete_test") is False
+    assert has_permissions(ROLE_ADMIN, ["write_test", "delete_test"]) == [True, False]
+    # one load of the permission set, the other checks hit the cache
+    assert len(statement_log) == 1
+
+    assert has_permission(ROLE_ADMIN, "read_test", use_cache=False) is True
+    assert has_permission(ROLE_ADMIN, "delete_test", use_cache=False) is False
+    assert has_permissions(
+        Role.ADMIN, ["write_test", "delete_test", "read_test"], use_cache=False
+    ) == [True, False, True]
+    assert has_permissions(ROLE_ADMIN, [], use_cache=False) == []
+    assert len(statement_log) == 5
+    permissions_cache.clear()
+
+
+def test_get_permission_set_ttl(role_permission_dataset, statement_log, monkeypatch):
+    permissions_cache.clear()
+    monkeypatch.setattr(permissions_cache, "ttl", 0)
+
+    get_permission_set(ROLE_USER)
+    get_permission_set(ROLE_USER)
+    assert len(statement_log) == 2
+
+
+def test_permissions_notify(db_connection, monkeypatch):
+    monkeypatch.setenv("DB_PERMISSIONS_NOTIFY", "true")
+
+    listen_connection = get_engine().raw_connection()
+    try:
+        cursor = listen_connection.cursor()
+        cursor.execute(f"LISTEN {PERMISSIONS_CHANNEL}")
+        listen_connection.commit()
+
+        permission_id = create_permission_for_role(ROLE_USER, "notify_test")
+        delete_role_permissions(id=permission_id)
+
+        cursor.execute("SELECT 1")
+        notifies = listen_connection.driver_connection.notifies
+        assert [n.channel for n in notifies] == [PERMISSIONS_CHANNEL] * 2
+        cursor.execute(f"UNLISTEN {PERMISSIONS_CHANNEL}")
+        listen_connection.commit()
+    finally:
+        listen_connection.close()
+
+
+def test_permissions_listener(db_connection):
+    listener = start_permissions_listener(poll_interval=0.05)
+    try:
+        assert listener.listening.wait(5)
+
+        # a stale entry, changed by another process
+        permissions_cache.set(ROLE_USER, frozenset(["stale"]))
+        db_connection.execute(statements.notify_stmt(PERMISSIONS_CHANNEL))
+        db_connection.commit()
+
+        for _ in range(100):
+            if not len(permissions_cache):
+                break
+            time.sleep(0.05)
+        assert not len(permissions_cache)
+    finally:
+        stop_permissions_listener()
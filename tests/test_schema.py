@@ -0,0 +1,51 @@
+import pytest
+from sqlalchemy import text
+
+from users_db import statements
+from users_db.utils import explain
+
+
+def plan_index_names(plan):
+    """the names of the indexes scanned by an EXPLAIN (FORMAT JSON) plan"""
+    names = set()
+    if isinstance(plan, dict):
+        if "Index Name" in plan:
+            names.add(plan["Index Name"])
+        for value in plan.values():
+            names |= plan_index_names(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            names |= plan_index_names(value)
+    return names
+
+
+@pytest.fixture
+def index_names(db_connection):
+    # the test tables are small, without enable_seqscan a sequential scan is
+    # cheaper than any index; this checks that an index can serve the query
+    db_connection.execute(text("SET LOCAL enable_seqscan = off"))
+
+    def index_names(stmt):
+        return plan_index_names(db_connection.execute(explain(stmt)).scalar())
+
+    yield index_names
+    db_connection.rollback()
+
+
+@pytest.mark.parametrize(
+    "filters, index",
+    [
+        ({"last_name": "Doe"}, "ix_users_last_name_first_name"),
+        ({"last_name": "Doe", "first_name": "John"}, "ix_users_last_name_first_name"),
+        ({"role": "SUPER_ADMIN"}, "ix_users_role"),
+        ({"user_ids": [1, 2, 3]}, "users_pkey"),
+        ({"email": "John@Example.com"}, "uq_users_lower_email"),
+    ],
+)
+def test_get_users_filters_use_indexes(index_names, filters, index):
+    assert index in index_names(statements.get_users_stmt(**filters))
+
+
+def test_login_lookup_uses_lower_email_index(index_names):
+    stmt = statements.GET_HASHED_PASSWORD_BY_EMAIL_STMT.params(email="John@Example.com")
+    assert index_names(stmt) == {"uq_users_lower_email"}
@@ -0,0 +1,127 @@
+import logging
+
+import pytest
+
+from users_db import slow_queries, statements
+from users_db.db import db_execute, db_transaction, get_engine
+from users_db.slow_queries import REDACTED, redact_parameters, redact_plan
+from users_db.users import bulk_create_users, bulk_delete_users, get_users
+
+
+@pytest.fixture
+def slow_query_log(caplog):
+    caplog.set_level(logging.WARNING, logger="users_db.slow_queries")
+    yield caplog
+    slow_queries.disable()
+
+
+def slow_query_entries(caplog):
+    return [record.slow_query for record in caplog.records if record.slow_query]
+
+
+def test_slow_query_log(slow_query_log, users_data):
+    # every statement is slow with a threshold of 0
+    slow_queries.enable(threshold=0, explain_sample=1)
+    get_users(last_name=users_data[0]["last_name"])
+
+    (entry,) = slow_query_entries(slow_query_log)
+    assert entry["function"] == "users_db.users.get_users"
+    assert "FROM users" in entry["statement"]
+    assert entry["parameters"] == {"last_name_1": "?"}
+    assert "actual time" in entry["plan"]
+    assert "(last_name)::text = '?'::text" in entry["plan"]
+    assert users_data[0]["last_name"] not in slow_query_log.text
+
+
+def test_slow_query_log_redacts_passwords(slow_query_log):
+    slow_queries.enable(threshold=0, explain_sample=1, show_values=True)
+    rows = [
+        {
+            "first_name": "John",
+            "middle_name": None,
+            "last_name": "Doe",
+            "email": f"slow{i}@example.com",
+            "password": "secret-password",
+            "role": "USER",
+        }
+        for i in range(2)
+    ]
+    user_ids = bulk_create_users(rows)
+    bulk_delete_users(user_ids)
+
+    entries = slow_query_entries(slow_query_log)
+    assert [entry["function"] for entry in entries] == [
+        "users_db.users.bulk_create_users",
+        "users_db.users.bulk_delete_users",
+    ]
+    # writes are never run again under EXPLAIN ANALYZE
+    assert [entry["plan"] for entry in entries] == [None, None]
+    assert entries[0]["parameters"]["password_m0"] == REDACTED
+    assert entries[0]["parameters"]["email_m1"] == "slow1@example.com"
+    assert "secret-password" not in slow_query_log.text
+
+
+def test_slow_query_log_does_not_explain_side_effects(slow_query_log):
+    slow_queries.enable(threshold=0, explain_sample=1)
+
+    @db_transaction
+    def notify(db_conn=None):
+        db_execute(statements.notify_stmt("slow_query_test"), db_conn=db_conn)
+
+    with get_engine().connect() as listener:
+        listener = listener.execution_options(isolation_level="AUTOCOMMIT")
+        listener.exec_driver_sql("LISTEN slow_query_test")
+        notify()
+        driver_connection = listener.connection.driver_connection
+        driver_connection.poll()
+        notifies = [
+            message
+            for message in driver_connection.notifies
+            if message.channel == "slow_query_test"
+        ]
+        driver_connection.notifies.clear()
+        listener.exec_driver_sql("UNLISTEN slow_query_test")
+
+    # SELECT pg_notify(...) is not run again under EXPLAIN ANALYZE
+    assert len(notifies) == 1
+    (entry,) = [
+        e for e in slow_query_entries(slow_query_log) if "pg_notify" in e["statement"]
+    ]
+    assert entry["plan"] is None
+
+
+def test_slow_query_threshold(slow_query_log, users_data):
+    slow_queries.enable(threshold=60)
+    get_users(user_id=users_data[0]["id"])
+    slow_queries.disable()
+    slow_queries.enable(threshold=0)
+    slow_queries.disable()
+    get_users(user_id=users_data[0]["id"])
+
+    assert slow_query_entries(slow_query_log) == []
+
+
+def test_redact_parameters():
+    parameters = {"password": "p", "password_1": "p", "email": "e", "id": 1}
+    assert redact_parameters(parameters) == {
+        "password": REDACTED,
+        "password_1": REDACTED,
+        "email": "?",
+        "id": "?",
+    }
+    assert redact_parameters([parameters, parameters], show_values=True) == [
+        {"password": REDACTED, "password_1": REDACTED, "email": "e", "id": 1},
+        2,
+    ]
+    assert redact_parameters(("secret", 1)) == ["?", "?"]
+
+
+def test_redact_plan():
+    plan = "Filter: ((password)::text = 'it''s'::text) AND (email = 'e'::text)"
+    parameters = {"password_1": "it's", "email_1": "e"}
+    assert redact_plan(plan, parameters) == (
+        "Filter: ((password)::text = '?'::text) AND (email = '?'::text)"
+    )
+    assert redact_plan(plan, parameters, show_values=True) == (
+        "Filter: ((password)::text = '<redacted>'::text) AND (email = 'e'::text)"
+    )
@@ -1,5 +1,9 @@
 import pytest
-from sqlalchemy import select, delete
+from contextlib import closing
+from sqlalchemy import select, delete, text
+from sqlalchemy.dialects import postgresql
+from users_db import statements
+from users_db.db import db_transaction, get_engine, returning_statement
 from users_db.errors import DatabaseError
 from users_db.schema import users
 from users_db.users import (
@@ -10,6 +14,9 @@ from users_db.users import (
     update_user,
     delete_user,
     bulk_delete_users,
+    bulk_create_users,
+    iter_users,
+    search_users,
 )
 
 
@@ -97,6 +104,37 @@ def test_get_hashed_password_by_email(db_connection):
     db_connection.commit()
 
 
+def test_email_is_case_insensitive(db_connection):
+    user_data = {
+        "first_name": "John",
+        "middle_name": None,
+        "last_name": "Doe",
+        "email": "John.Doe@Email.com",
+        "role": "USER",
+        "password": "hashed",
+    }
+    user_id = create_user(**user_data)
+
+    data = get_hashed_password_by_email("john.doe@EMAIL.COM")
+    assert data["id"] == user_id
+    # the email is stored as given
+    assert data["email"] == user_data["email"]
+    assert get_users(email="JOHN.DOE@email.com")["id"] == user_id
+
+    with pytest.raises(DatabaseError):
+        create_user(**{**user_data, "email": "john.doe@email.com"})
+
+    rows = [{**user_data, "first_name": "Jane", "email": "JOHN.DOE@EMAIL.COM"}]
+    assert bulk_create_users(rows, on_conflict="ignore") == [None]
+    assert bulk_create_users(rows, on_conflict="update") == [user_id]
+    assert get_user(user_id)["first_name"] == "Jane"
+    assert get_user(user_id)["email"] == user_data["email"]
+
+    # clean up
+    db_connection.execute(delete(users).where(users.c.id == user_id))
+    db_connection.commit()
+
+
 def test_get_users(db_connection):
     users_data = [
         {
@@ -164,6 +202,183 @@ def test_update_users(db_connection):
     db_connection.commit()
 
 
+def test_get_users_typed(users_data):
+    user = users_data[0]
+
+    rows = get_user(user["id"], typed=True)
+    assert len(rows) == 1
+    assert rows[0].id == user["id"]
+    assert rows[0].email == user["email"]
+    assert rows[0].role == "USER"
+    assert rows[0]._fields == (
+        "id",
+        "first_name",
+        "middle_name",
+        "last_name",
+        "email",
+        "role",
+    )
+
+    user_ids = [user["id"] for user in users_data]
+    rows = get_users(user_ids=user_ids, typed=True)
+    assert sorted(row.id for row in rows) == sorted(user_ids)
+    # one named tuple type per column signature
+    assert isinstance(get_user(user["id"], typed=True)[0], type(rows[0]))
+
+    assert get_users(user_ids=[-1], typed=True) == []
+    assert get_user(-1) is None
+
+
+def test_iter_users(users_data):
+    user_ids = [user["id"] for user in users_data]
+
+    rows = list(iter_users(user_ids=user_ids, chunk_size=7))
+    assert sorted(row["id"] for row in rows) == sorted(user_ids)
+    assert all("password" not in row for row in rows)
+
+    batches = list(iter_users(user_ids=user_ids, chunk_size=7, batches=True))
+    assert [len(batch) for batch in batches[:-1]] == [7] * (len(batches) - 1)
+    assert sum(len(batch) for batch in batches) == len(user_ids)
+
+    rows = list(iter_users(user_ids=user_ids, chunk_size=7, typed=True))
+    assert sorted(row.id for row in rows) == sorted(user_ids)
+    assert get_engine().pool.checkedout() == 0
+
+
+def test_iter_users_stops_early(users_data):
+    user_ids = [user["id"] for user in users_data]
+
+    with closing(iter_users(user_ids=user_ids, chunk_size=7)) as rows:
+        assert len([row for _, row in zip(range(3), rows)]) == 3
+        assert get_engine().pool.checkedout() == 1
+    # the server-side cursor and the connection are released
+    assert get_engine().pool.checkedout() == 0
+
+
+def test_iter_users_in_transaction(users_data):
+    user_ids = [user["id"] for user in users_data]
+
+    @db_transaction
+    def count_users(db_conn=None):
+        count = sum(1 for _ in iter_users(user_ids=user_ids, chunk_size=10))
+        # the rows are read through the transaction connection
+        assert get_engine().pool.checkedout() == 1
+        return count
+
+    assert count_users() == len(user_ids)
+    assert get_engine().pool.checkedout() == 0
+
+
+@pytest.fixture
+def search_data(db_connection):
+    installed = db_connection.execute(
+        text("select 1 from pg_extension where extname = 'pg_trgm'")
+    ).scalar()
+    db_connection.rollback()
+    if not installed:
+        pytest.skip("the pg_trgm extension is not installed")
+
+    rows = [
+        ("Quokkaline", "Smith", "qsmith@example.com"),
+        ("Mary", "Quokkason", "mary@example.com"),
+        ("Bob", "Bigquokka", "bob@example.com"),
+        ("Alice", "Brown", "alice@example.com"),
+    ]
+    user_ids = bulk_create_users(
+        {
+            "first_name": first_name,
+            "last_name": last_name,
+            "email": email,
+            "password": "password",
+            "role": "USER",
+        }
+        for first_name, last_name, email in rows
+    )
+    yield user_ids
+
+    db_connection.execute(delete(users).where(users.c.id.in_(user_ids)))
+    db_connection.commit()
+
+
+def test_search_users(search_data):
+    quokkaline, quokkason, bigquokka, _ = search_data
+
+    result = search_users("QUOKKA")
+    assert result["next_cursor"] is None
+    items = result["items"]
+    assert {item["id"] for item in items} == {quokkaline, quokkason, bigquokka}
+    # prefix matches rank first
+    assert items[-1]["id"] == bigquokka
+    assert all("password" not in item for item in items)
+    ranks = [item["search_rank"] for item in items]
+    assert ranks == sorted(ranks, reverse=True)
+
+    # walk the same results one page at a time
+    pages, cursor = [], None
+    while True:
+        result = search_users("quokka", limit=1, cursor=cursor)
+        pages.extend(item["id"] for item in result["items"])
+        cursor = result["next_cursor"]
+        if cursor is None:
+            break
+    assert pages == [item["id"] for item in items]
+
+    # LIKE wildcards in the query are matched literally
+    assert search_users("quokk%")["items"] == []
+    assert search_users("quokk_")["items"] == []
+
+
+def test_search_users_bad_arguments():
+    with pytest.raises(ValueError):
+        search_users("  ")
+    with pytest.raises(ValueError):
+        search_users("quokka", cursor="not a cursor")
+    with pytest.raises(ValueError):
+        search_users("quokka", limit=0)
+    with pytest.raises(ValueError):
+        search_users("quokka", limit=-1)
+
+
+def test_search_users_stmt_escapes_wildcards():
+    assert statements.like_escape("50%_off\\") == "50\\%\\_off\\\\"
+
+
+def test_search_users_stmt():
+    stmt = statements.search_users_stmt("50%_off", after=(500, 7))
+    compiled = stmt.compile(dialect=postgresql.dialect())
+    sql = " ".join(str(compiled).split())
+    params = compiled.params
+
+    # the query is matched literally, as a substring and as a prefix
+    assert "users.email ILIKE %(email_2)s ESCAPE" in sql
+    assert params["email_2"] == "%50\\%\\_off%"
+    assert params["email_1"] == "50\\%\\_off%"
+    assert params["word_similarity_1"] == "50%_off"
+    # the page after (search_rank, id) = (500, 7), best matches first
+    assert (
+        "WHERE matches.search_rank < %(search_rank_1)s OR "
+        "matches.search_rank = %(search_rank_2)s AND matches.id > %(id_1)s "
+        "ORDER BY matches.search_rank DESC, matches.id"
+    ) in sql
+    keys = ["search_rank_1", "search_rank_2", "id_1"]
+    assert [params[key] for key in keys] == [500, 500, 7]
+    assert "password" not in sql
+
+    # the first page has no after predicate
+    first_page = str(statements.search_users_stmt("50%_off"))
+    assert "matches.search_rank <" not in first_page
+
+
+def test_user_statements_leave_out_password():
+    assert "password" not in str(statements.GET_USER_STMT)
+    assert "password" not in str(statements.get_users_stmt(email="a@b.c"))
+    update_stmt = returning_statement(statements.update_user_stmt(1, role="USER"))
+    assert "password" not in str(update_stmt)
+
+    # the password has to be selected explicitly
+    assert "users.password" in str(statements.GET_HASHED_PASSWORD_BY_EMAIL_STMT)
+
+
 def test_delete_users(db_connection):
     user_id = create_user(
         **{
@@ -229,3 +444,68 @@ def test_bad_create_user(db_connection):
             password=None,
             role=None,
         )
+
+
+def bulk_users_data(count, prefix="bulk"):
+    return [
+        {
+            "first_name": f"John{i}",
+            "middle_name": None if i % 2 else f"E.{i}",
+            "last_name": "Doe\ttab\\slash" if i == 0 else f"Doe{i}",
+            "role": "USER",
+            "email": f"{prefix}{i}@email.com",
+            "password": "password",
+        }
+        for i in range(count)
+    ]
+
+
+@pytest.mark.parametrize("copy", [False, True])
+def test_bulk_create_users(db_connection, copy):
+    users_data = bulk_users_data(25)
+    user_ids = bulk_create_users(users_data, batch_size=10, copy=copy)
+
+    assert len(user_ids) == len(users_data)
+    rows = {
+        row["id"]: row
+        for row in db_connection.execute(select(users).where(users.c.id.in_(user_ids)))
+        .mappings()
+        .all()
+    }
+    for user_id, user_data in zip(user_ids, users_data):
+        row = rows[user_id]
+        for key, value in user_data.items():
+            if key == "role":
+                assert row[key].name == value
+                continue
+            assert row[key] == value
+
+    # clean up
+    db_connection.execute(delete(users).where(users.c.id.in_(user_ids)))
+    db_connection.commit()
+
+
+@pytest.mark.parametrize("copy", [False, True])
+def test_bulk_create_users_on_conflict(db_connection, copy):
+    existing_ids = bulk_create_users(bulk_users_data(3))
+    users_data = bulk_users_data(5)
+    for user_data in users_data:
+        user_data["first_name"] = "Jane"
+
+    with pytest.raises(DatabaseError):
+        bulk_create_users(users_data, copy=copy)
+
+    user_ids = bulk_create_users(users_data, on_conflict="ignore", copy=copy)
+    assert user_ids[:3] == [None, None, None]
+    assert all(user_ids[3:])
+    assert get_user(existing_ids[0])["first_name"] == "John0"
+
+    user_ids = bulk_create_users(users_data, on_conflict="update", copy=copy)
+    assert user_ids[:3] == existing_ids
+    assert get_user(existing_ids[0])["first_name"] == "Jane"
+
+    # clean up
+    db_connection.execute(
+        delete(users).where(users.c.email.in_([u["email"] for u in users_data]))
+    )
+    db_connection.commit()
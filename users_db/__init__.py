@@ -0,0 +1,11 @@
+__all__ = ["transaction"]
+
+
+def __getattr__(name):
+    # users_db.transaction is imported on first use, importing a submodule
+    # such as users_db.config must not load users_db.db and SQLAlchemy
+    if name == "transaction":
+        from users_db.db import transaction
+
+        return transaction
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
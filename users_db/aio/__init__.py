@@ -0,0 +1,9 @@
+"""
+asyncio twin of users_db, built on SQLAlchemy's create_async_engine and
+asyncpg: users_db.aio.users and users_db.aio.role_permissions mirror the
+sync modules and share their statement builders (users_db.statements).
+"""
+
+from users_db.aio.db import transaction
+
+__all__ = ["transaction"]
@@ -0,0 +1,378 @@
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
+
+from users_db import config, instrumentation, routing
+from users_db.db import (
+    TransactionScope,
+    create_replica_set,
+    engine_options,
+    new_engine,
+    process_result,
+    record_checkout_wait,
+    returning_statement,
+    row_transformer,
+)
+from users_db.errors import SqlAlchemyDatabaseError
+
+# the connection of the outermost db_transaction of the current task, nested
+# calls find it here; tasks started inside a transaction inherit it, so they
+# must not run statements concurrently (one connection runs one statement)
+current_connection: ContextVar[Optional[AsyncConnection]] = ContextVar(
+    "users_db_aio_connection", default=None
+)
+
+_engine = None
+_engine_pid = None
+_engine_options = {}
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    get_engine returns the async engine, creating it on first use and again
+    in a forked child process
+    """
+    global _engine, _engine_pid
+
+    if _engine is not None and _engine_pid == os.getpid():
+        return _engine
+
+    with _engine_lock:
+        created = _engine is None or _engine_pid != os.getpid()
+        if created:
+            if _engine is not None:
+                _engine.sync_engine.dispose(close=False)
+            _engine = new_engine(
+                create_async_engine,
+                config.get_postgres_async_uri(),
+                engine_options(_engine_options),
+            )
+            _engine_pid = os.getpid()
+        engine = _engine
+    if created:
+        routing.track_writes(engine, get_replicas() is not None)
+    return engine
+
+
+async def configure_engine(**options):
+    """
+    async users_db.db.configure_engine, options override
+    config.get_engine_options() for the async engine
+    """
+    global _engine, _engine_pid, _engine_options, _replicas, _replicas_pid
+
+    engine = new_engine(
+        create_async_engine, config.get_postgres_async_uri(), engine_options(options)
+    )
+
+    with _engine_lock:
+        old_engine, old_pid = _engine, _engine_pid
+        old_replicas, old_replicas_pid = _replicas, _replicas_pid
+        _engine, _engine_pid, _engine_options = engine, os.getpid(), options
+        _replicas, _replicas_pid = None, None
+    if old_engine is not None:
+        await old_engine.dispose(close=old_pid == os.getpid())
+    if old_replicas is not None:
+        for old in old_replicas.engines:
+            await old.dispose(close=old_replicas_pid == os.getpid())
+    routing.track_writes(engine, get_replicas() is not None)
+    return engine
+
+
+_replicas = None
+_replicas_pid = None
+_replica_options = {}
+
+
+def get_replicas():
+    """
+    async users_db.db.get_replicas, asyncpg engines of the replicas of
+    config.get_postgres_replica_uris()
+    """
+    global _replicas, _replicas_pid
+
+    if _replicas_pid == os.getpid():
+        return _replicas
+
+    with _engine_lock:
+        created = _replicas_pid != os.getpid()
+        if created:
+            if _replicas is not None:
+                _replicas.dispose(close=False)
+            _replicas = create_replicas(**_replica_options)
+            _replicas_pid = os.getpid()
+        replicas = _replicas
+    if created:
+        routing.track_writes(get_engine(), replicas is not None)
+    return replicas
+
+
+def create_replicas(uris=None, balancing=None, read_your_writes_window=None):
+    if uris is None:
+        uris = config.get_postgres_replica_uris(driver="asyncpg")
+    return create_replica_set(
+        create_async_engine,
+        uris,
+        engine_options(_engine_options),
+        balancing=balancing,
+        read_your_writes_window=read_your_writes_window,
+    )
+
+
+async def configure_replicas(**options):
+    """
+    async users_db.db.configure_replicas, the uris are asyncpg URIs
+    (postgresql+asyncpg://...)
+    """
+    global _replicas, _replicas_pid, _replica_options
+
+    with _engine_lock:
+        old_replicas, _replicas, _replicas_pid = _replicas, None, None
+        _replica_options = options
+    if old_replicas is not None:
+        for engine in old_replicas.engines:
+            await engine.dispose()
+    return get_replicas()
+
+
+def get_read_engine():
+    """async users_db.db.get_read_engine"""
+    replicas = get_replicas()
+    if replicas is None or replicas.reads_own_writes():
+        return get_engine()
+    return replicas.pick()
+
+
+async def dispose_engine():
+    """
+    dispose_engine closes the pooled connections of the primary and the
+    replicas, asyncpg connections are bound to the event loop they were
+    opened in
+    """
+    global _engine, _replicas, _replicas_pid
+
+    engine, _engine = _engine, None
+    if engine is not None:
+        await engine.dispose()
+
+    replicas, _replicas, _replicas_pid = _replicas, None, None
+    if replicas is not None:
+        for engine in replicas.engines:
+            await engine.dispose()
+
+
+class db_transaction:
+    """
+    async db_transaction, the outermost call opens a connection, commits and
+    closes it, nested calls reuse the connection found in current_connection
+    """
+
+    savepoint = False
+    replica = False
+
+    def __init__(self, func):
+        self.func = func
+        self.name = instrumentation.function_name(func)
+
+    async def __call__(self, *args, **kwargs):
+        connection = current_connection.get()
+        if instrumentation.sink is not None:
+            return await self.timed_call(connection, args, kwargs)
+        if connection is not None and not self.savepoint:
+            return await self.func(*args, **kwargs, db_conn=connection)
+
+        async with transaction_scope(
+            replica=self.replica, savepoint=self.savepoint
+        ) as scope:
+            return await self.func(*args, **kwargs, db_conn=scope.connection)
+
+    async def timed_call(self, connection, args, kwargs):
+        """__call__ recording the FUNCTION_SECONDS of the call"""
+        status = instrumentation.STATUS_ERROR
+        started = time.perf_counter()
+        try:
+            if connection is not None and not self.savepoint:
+                result = await self.func(*args, **kwargs, db_conn=connection)
+            else:
+                async with transaction_scope(
+                    replica=self.replica, savepoint=self.savepoint
+                ) as scope:
+                    result = await self.func(*args, **kwargs, db_conn=scope.connection)
+            status = instrumentation.STATUS_OK
+            return result
+        finally:
+            instrumentation.record(
+                instrumentation.FUNCTION_SECONDS,
+                time.perf_counter() - started,
+                function=self.name,
+                status=status,
+            )
+
+
+def transaction(
+    isolation_level=None, read_only=False, deferrable=False, savepoint=False
+):
+    """
+    async users_db.db.transaction:
+
+        async with users_db.aio.transaction() as tx:
+            ...
+    """
+    options = {}
+    if isolation_level:
+        options["isolation_level"] = isolation_level
+    if read_only:
+        options["postgresql_readonly"] = True
+    if deferrable:
+        options["postgresql_deferrable"] = True
+    return transaction_scope(savepoint=savepoint, **options)
+
+
+@asynccontextmanager
+async def transaction_scope(replica=False, savepoint=False, **options):
+    """
+    async users_db.db.base_transaction.scope, options are the execution
+    options of the outermost connection, which is a replica one with replica
+    """
+    connection = current_connection.get()
+    if connection is not None:
+        if options:
+            raise ValueError(
+                "transaction options apply to the outermost transaction only"
+            )
+        if not savepoint:
+            yield TransactionScope(connection)
+            return
+        try:
+            async with connection.begin_nested():
+                yield TransactionScope(connection)
+        except SQLAlchemyError as err:
+            raise SqlAlchemyDatabaseError(err)
+        return
+
+    try:
+        started = time.perf_counter()
+        engine = get_read_engine() if replica else get_engine()
+        connection = await engine.connect()
+        if not replica:
+            # a mark left by a statement run outside of db_transaction
+            routing.wrote(connection)
+        record_checkout_wait(time.perf_counter() - started, engine is get_engine())
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+    if options:
+        try:
+            await connection.execution_options(**options)
+        except SQLAlchemyError as err:
+            await connection.close()
+            raise SqlAlchemyDatabaseError(err)
+
+    token = current_connection.set(connection)
+    try:
+        try:
+            yield TransactionScope(connection)
+        except BaseException:
+            await connection.rollback()
+            raise
+        started = time.perf_counter()
+        try:
+            await connection.commit()
+        except SQLAlchemyError as err:
+            raise SqlAlchemyDatabaseError(err)
+        if instrumentation.sink is not None:
+            instrumentation.record(
+                instrumentation.COMMIT_SECONDS, time.perf_counter() - started
+            )
+        if not replica and routing.wrote(connection):
+            replicas = get_replicas()
+            if replicas is not None:
+                replicas.record_write()
+    finally:
+        current_connection.reset(token)
+        await connection.close()
+
+
+class db_savepoint(db_transaction):
+    """async users_db.db.db_savepoint"""
+
+    savepoint = True
+
+
+class db_read_transaction(db_transaction):
+    """async users_db.db.db_read_transaction"""
+
+    replica = True
+
+
+async def db_execute(
+    statement, db_conn: AsyncConnection, typed: bool = False, parameters=None
+):
+    """async db_execute, returns the same values as users_db.db.db_execute"""
+    try:
+        statement = returning_statement(statement)
+        if instrumentation.sink is None:
+            cursor_result = await db_conn.execute(statement, parameters)
+            return process_result(statement, cursor_result, typed)
+
+        started = time.perf_counter()
+        cursor_result = await db_conn.execute(statement, parameters)
+        result = process_result(statement, cursor_result, typed)
+        instrumentation.record_statement(
+            statement, time.perf_counter() - started, result
+        )
+        return result
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+
+
+async def db_run_sync(func, db_conn: AsyncConnection, *args, **kwargs):
+    """
+    db_run_sync calls a sync function taking db_conn (e.g. a paginate
+    wrapped statement builder) with the sync facade of db_conn
+    """
+    try:
+        return await db_conn.run_sync(
+            lambda sync_conn: func(*args, **kwargs, db_conn=sync_conn)
+        )
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+
+
+async def db_stream(statement, chunk_size: int, typed: bool = False):
+    """
+    async users_db.db.db_stream, an async generator using the connection of
+    the current db_transaction or a connection of its own, closed by aclose()
+    """
+    db_conn = current_connection.get()
+    owned = db_conn is None
+    if owned:
+        try:
+            started = time.perf_counter()
+            engine = get_read_engine()
+            db_conn = await engine.connect()
+            record_checkout_wait(time.perf_counter() - started, engine is get_engine())
+        except SQLAlchemyError as err:
+            raise SqlAlchemyDatabaseError(err)
+
+    stream_result = None
+    try:
+        stream_result = await db_conn.stream(
+            statement, execution_options={"yield_per": chunk_size}
+        )
+        transform_row = row_transformer(statement, stream_result, typed)
+        async for partition in stream_result.partitions():
+            yield [transform_row(row) for row in partition]
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+    finally:
+        if stream_result is not None:
+            await stream_result.close()
+        if owned:
+            await db_conn.close()
@@ -0,0 +1,193 @@
+import logging
+from typing import List
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from users_db import config, statements
+from users_db.aio.db import (
+    current_connection,
+    db_execute,
+    db_read_transaction,
+    db_transaction,
+)
+from users_db.errors import SqlAlchemyDatabaseError
+from users_db.role_permissions import (
+    PERMISSIONS_CHANNEL,
+    csv_role_permission_pairs,
+    drop_permissions_cache,
+    permissions_cache,
+    role_name,
+    role_permissions_sync_result,
+    wrote_permissions,
+)
+
+log = logging.getLogger(__name__)
+
+
+async def permissions_changed(db_conn):
+    """async users_db.role_permissions.permissions_changed"""
+    drop_permissions_cache(db_conn.sync_connection)
+    if config.get_permissions_notify():
+        await db_execute(statements.notify_stmt(PERMISSIONS_CHANNEL), db_conn=db_conn)
+
+
+async def get_permission_set(role) -> frozenset:
+    """
+    async users_db.role_permissions.get_permission_set, both share
+    permissions_cache
+    """
+    role = role_name(role)
+    if wrote_permissions(current_connection.get()):
+        return await load_permission_set(role)
+
+    permissions = permissions_cache.get(role)
+    if permissions is None:
+        generation = permissions_cache.generation
+        permissions = await load_permission_set(role)
+        permissions_cache.set(role, permissions, generation=generation)
+    return permissions
+
+
+# the permission checks read the primary: a set loaded from a lagging replica
+# would stay cached for the TTL after the invalidation of a write
+@db_transaction
+async def load_permission_set(role: str, db_conn=None) -> frozenset:
+    stmt = statements.GET_PERMISSION_NAMES_FOR_ROLE_STMT
+    try:
+        return frozenset((await db_conn.execute(stmt, {"role": role})).scalars())
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+
+
+async def has_permission(role, permission: str, use_cache: bool = True) -> bool:
+    """async users_db.role_permissions.has_permission"""
+    if use_cache:
+        return permission in await get_permission_set(role)
+    return await query_has_permission(role_name(role), permission)
+
+
+async def has_permissions(role, permissions: List[str], use_cache: bool = True):
+    """async users_db.role_permissions.has_permissions"""
+    if use_cache:
+        granted = await get_permission_set(role)
+    else:
+        granted = await query_granted_permissions(role_name(role), permissions)
+    return [permission in granted for permission in permissions]
+
+
+@db_transaction
+async def query_has_permission(role: str, permission: str, db_conn=None) -> bool:
+    stmt = statements.HAS_PERMISSION_STMT
+    parameters = {"role": role, "permission": permission}
+    try:
+        return (await db_conn.execute(stmt, parameters)).scalar()
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+
+
+@db_transaction
+async def query_granted_permissions(role: str, permissions: List[str], db_conn=None):
+    stmt = statements.get_granted_permissions_stmt(role, permissions)
+    try:
+        return frozenset((await db_conn.execute(stmt)).scalars())
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+
+
+@db_transaction
+async def create_permission_for_role(role: str, permission: str, db_conn=None):
+    stmt = statements.create_permission_for_role_stmt(role, permission)
+    result = await db_execute(stmt, db_conn=db_conn)
+    await permissions_changed(db_conn)
+    return result
+
+
+@db_transaction
+async def create_permissions_for_role(role: str, permissions: List[str], db_conn=None):
+    stmt = statements.create_permissions_for_role_stmt(role, permissions)
+    result = await db_execute(stmt, db_conn=db_conn)
+    await permissions_changed(db_conn)
+    return result
+
+
+@db_read_transaction
+async def get_role_permission(role_permission_id, typed=False, db_conn=None):
+    select_stmt = statements.GET_ROLE_PERMISSION_STMT
+    parameters = {"role_permission_id": role_permission_id}
+    return await db_execute(
+        select_stmt, db_conn=db_conn, typed=typed, parameters=parameters
+    )
+
+
+@db_read_transaction
+async def get_role_permissions(
+    role_permission_ids=None, role=None, permission=None, typed=False, db_conn=None
+):
+    select_stmt = statements.get_role_permissions_stmt(
+        role_permission_ids=role_permission_ids, role=role, permission=permission
+    )
+    return await db_execute(select_stmt, db_conn=db_conn, typed=typed)
+
+
+@db_read_transaction
+async def get_permissions_for_role(role: str, typed=False, db_conn=None):
+    select_stmt = statements.GET_PERMISSIONS_FOR_ROLE_STMT
+    parameters = {"role": role}
+    return await db_execute(
+        select_stmt, db_conn=db_conn, typed=typed, parameters=parameters
+    )
+
+
+@db_transaction
+async def update_permissions_for_role(role_permission_id, db_conn=None, **values):
+    update_stmt = statements.update_permissions_for_role_stmt(
+        role_permission_id, **values
+    )
+    result = await db_execute(update_stmt, db_conn=db_conn)
+    await permissions_changed(db_conn)
+    return result
+
+
+@db_transaction
+async def delete_role_permissions(
+    id=None, ids=None, role=None, permission=None, db_conn=None
+):
+    delete_stmt = statements.delete_role_permissions_stmt(
+        id=id, ids=ids, role=role, permission=permission
+    )
+    result = await db_execute(delete_stmt, db_conn=db_conn)
+    await permissions_changed(db_conn)
+    return result
+
+
+@db_transaction
+async def update_role_permission_table_with_csv(
+    role_permission_list_csv: list[dict], logged: bool = False, db_conn=None
+):
+    """
+    async users_db.role_permissions.update_role_permission_table_with_csv
+    """
+    pairs = csv_role_permission_pairs(role_permission_list_csv)
+
+    try:
+        deleted_rows = (
+            await db_conn.execute(statements.delete_role_permissions_not_in_stmt(pairs))
+        ).all()
+        created_rows = (
+            await db_conn.execute(
+                statements.create_missing_role_permissions_stmt(pairs)
+            )
+        ).all()
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+    await permissions_changed(db_conn)
+
+    result = role_permissions_sync_result(pairs, created_rows, deleted_rows)
+    if logged:
+        log.info(
+            "role_permissions synced with csv: %d created, %d deleted, %d unchanged",
+            len(result["to_create_role_permissions"]),
+            len(result["to_delete_role_permissions"]),
+            len(result["unchanged_role_permissions"]),
+        )
+    return result
@@ -0,0 +1,169 @@
+from sqlalchemy.exc import SQLAlchemyError
+
+from users_db import statements
+from users_db.aio.db import (
+    db_execute,
+    db_read_transaction,
+    db_run_sync,
+    db_stream,
+    db_transaction,
+)
+from users_db.errors import SqlAlchemyDatabaseError
+from users_db.pagination import paginate
+from users_db.users import (
+    BULK_BATCH_SIZE,
+    ITER_CHUNK_SIZE,
+    SEARCH_LIMIT,
+    ids_in_input_order,
+    search_page,
+)
+
+paginated_users = paginate(statements.get_users_stmt)
+
+
+@db_transaction
+async def create_user(
+    first_name, middle_name, last_name, email, password, role, db_conn=None
+):
+    return await db_execute(
+        statements.create_user_stmt(
+            first_name=first_name,
+            middle_name=middle_name,
+            last_name=last_name,
+            email=email,
+            password=password,
+            role=role,
+        ),
+        db_conn=db_conn,
+    )
+
+
+@db_read_transaction
+async def get_user(user_id, typed=False, db_conn=None):
+    return await db_execute(
+        statements.GET_USER_STMT,
+        db_conn=db_conn,
+        typed=typed,
+        parameters={"user_id": user_id},
+    )
+
+
+# credentials are read from the primary, never from a lagging replica
+@db_transaction
+async def get_hashed_password_by_email(email, db_conn=None):
+    stmt = statements.GET_HASHED_PASSWORD_BY_EMAIL_STMT
+    return await db_execute(stmt, db_conn=db_conn, parameters={"email": email})
+
+
+@db_read_transaction
+async def get_users(
+    user_id=None,
+    user_ids=None,
+    first_name=None,
+    middle_name=None,
+    last_name=None,
+    email=None,
+    role=None,
+    typed=False,
+    db_conn=None,
+    is_paginated=False,
+    **pagination,
+):
+    """
+    get_users takes the pagination keyword arguments of users_db.users.get_users
+    """
+    filters = dict(
+        user_id=user_id,
+        user_ids=user_ids,
+        first_name=first_name,
+        middle_name=middle_name,
+        last_name=last_name,
+        email=email,
+        role=role,
+    )
+    if not is_paginated:
+        stmt = statements.get_users_stmt(**filters)
+        return await db_execute(stmt, db_conn=db_conn, typed=typed)
+
+    # pagination runs several statements, it is shared with the sync API
+    # through the sync facade of the async connection
+    return await db_run_sync(
+        paginated_users,
+        db_conn,
+        is_paginated=True,
+        typed=typed,
+        **filters,
+        **pagination,
+    )
+
+
+@db_read_transaction
+async def search_users(query: str, limit=SEARCH_LIMIT, cursor=None, db_conn=None):
+    """async users_db.users.search_users"""
+    return await db_run_sync(search_page, db_conn, query, limit, cursor)
+
+
+async def iter_users(chunk_size=ITER_CHUNK_SIZE, batches=False, typed=False, **filters):
+    """async users_db.users.iter_users, stop early with aclose()"""
+    chunks = db_stream(statements.get_users_stmt(**filters), chunk_size, typed)
+    try:
+        async for chunk in chunks:
+            if batches:
+                yield chunk
+            else:
+                for row in chunk:
+                    yield row
+    finally:
+        await chunks.aclose()
+
+
+@db_transaction
+async def update_user(
+    user_id,
+    db_conn=None,
+    **values,
+):
+    stmt = statements.update_user_stmt(user_id, **values)
+    return await db_execute(stmt, db_conn=db_conn)
+
+
+@db_transaction
+async def delete_user(
+    user_id,
+    db_conn=None,
+):
+    stmt = statements.DELETE_USER_STMT
+    return await db_execute(stmt, db_conn=db_conn, parameters={"user_id": user_id})
+
+
+@db_transaction
+async def bulk_delete_users(
+    user_ids,
+    db_conn=None,
+):
+    stmt = statements.bulk_delete_users_stmt(user_ids)
+    return await db_execute(stmt, db_conn=db_conn)
+
+
+@db_transaction
+async def bulk_create_users(
+    rows,
+    batch_size=BULK_BATCH_SIZE,
+    on_conflict=statements.ON_CONFLICT_RAISE,
+    db_conn=None,
+):
+    """
+    async users_db.users.bulk_create_users, without the COPY path
+    """
+    rows = list(rows)
+    returned = []
+    try:
+        for start in range(0, len(rows), batch_size):
+            stmt = statements.bulk_create_users_stmt(
+                rows[start : start + batch_size], on_conflict
+            )
+            returned.extend((await db_conn.execute(stmt)).all())
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+
+    return ids_in_input_order(rows, returned)
@@ -0,0 +1,768 @@
+"""
+users_db-bench, performance baselines of the public API against a scratch
+database (the one of config.get_postgres_uri(), e.g. the docker-compose
+Postgres with DB_NAME=bench):
+
+    users_db-bench run --sizes 10000,100000,1000000 --output 0.0.39.json
+    users_db-bench compare 0.0.38.json 0.0.39.json
+    users_db-bench load --threads 16 --processes 4 --mix 80:20
+
+run seeds the users table with bench users up to each size and measures the
+users and role_permissions functions, the results are written as JSON;
+compare reports the p50 changes between two result files. load calls the
+API from many threads and processes at once, reports the throughput and
+latencies, and checks that no connection or transaction leaks across threads.
+The bench users are deleted at the end and the role_permissions rows restored.
+"""
+import functools
+import importlib.metadata
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import click
+from sqlalchemy import delete, func, select, text
+
+from users_db.db import (
+    current_connection,
+    current_scope,
+    db_transaction,
+    get_engine,
+    get_pool_metrics,
+)
+from users_db.errors import DatabaseError
+from users_db.pagination import CURSOR_NEXT, encode_cursor
+from users_db.role_permissions import (
+    get_role_permissions,
+    update_role_permission_table_with_csv,
+)
+from users_db.schema import Role, users
+from users_db.statements import email_equals
+from users_db.users import (
+    bulk_create_users,
+    bulk_delete_users,
+    create_user,
+    get_hashed_password_by_email,
+    get_user,
+    get_users,
+    update_user,
+)
+
+DEFAULT_SIZES = "10000,100000,1000000"
+BENCH_EMAIL_DOMAIN = "users-db.bench"
+# the bench users are bench<n>@users-db.bench, see seed_users_stmt
+BENCH_USERS = users.c.email.like(f"bench%@{BENCH_EMAIL_DOMAIN}")
+# the size of a bcrypt hash
+BENCH_PASSWORD = "$2b$12$" + "x" * 53
+
+# distinct values of the seeded columns, the filters select size / value rows
+FIRST_NAMES = 1000
+MIDDLE_NAMES = 10000
+LAST_NAMES = 50000
+
+PAGE_SIZE = 50
+USER_IDS = 100
+BULK_DELETE_SIZE = 100
+CSV_PERMISSIONS = 200
+
+
+def seed_users_stmt():
+    """
+    inserts the bench users start to stop - 1 in one statement, one in 100
+    is an ADMIN and one in 1000 a SUPER_ADMIN
+    """
+    return text(
+        "INSERT INTO users "
+        "(first_name, middle_name, last_name, email, password, role) "
+        "SELECT 'First' || (i % :first_names), 'Middle' || (i % :middle_names), "
+        "'Last' || (i % :last_names), 'bench' || i || :domain, :password, "
+        "(CASE WHEN i % 1000 = 0 THEN 'SUPER_ADMIN' "
+        "WHEN i % 100 = 0 THEN 'ADMIN' ELSE 'USER' END)::role_enum "
+        "FROM generate_series(:start, :stop - 1) AS i"
+    ).bindparams(
+        first_names=FIRST_NAMES,
+        middle_names=MIDDLE_NAMES,
+        last_names=LAST_NAMES,
+        domain=f"@{BENCH_EMAIL_DOMAIN}",
+        password=BENCH_PASSWORD,
+    )
+
+
+def seed_users(start, stop):
+    """seed_users inserts the bench users start to stop - 1, then ANALYZEs"""
+    with get_engine().begin() as conn:
+        conn.execute(seed_users_stmt(), {"start": start, "stop": stop})
+    with get_engine().connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(
+            text("ANALYZE users")
+        )
+
+
+def delete_bench_users():
+    with get_engine().begin() as conn:
+        conn.execute(delete(users).where(BENCH_USERS))
+
+
+def other_users_count():
+    with get_engine().connect() as conn:
+        return conn.execute(
+            select(func.count()).select_from(users).where(~BENCH_USERS)
+        ).scalar()
+
+
+def first_bench_id():
+    with get_engine().connect() as conn:
+        return conn.execute(select(func.min(users.c.id)).where(BENCH_USERS)).scalar()
+
+
+def percentile(timings, q):
+    """the q quantile (0 to 1) of sorted timings"""
+    return timings[min(len(timings) - 1, int(len(timings) * q))]
+
+
+def summary(timings):
+    """the latency statistics of timings in seconds, in milliseconds"""
+    timings = sorted(timings)
+    return {
+        "calls": len(timings),
+        "mean_ms": statistics.fmean(timings) * 1e3,
+        "p50_ms": percentile(timings, 0.5) * 1e3,
+        "p99_ms": percentile(timings, 0.99) * 1e3,
+        "max_ms": timings[-1] * 1e3,
+    }
+
+
+def measure(func, setup, calls, max_seconds):
+    """
+    measure times func(*setup()) calls times, or until max_seconds have
+    elapsed, after one warm-up call; setup is not timed
+    """
+    func(*setup())
+    timings = []
+    deadline = time.perf_counter() + max_seconds
+    for _ in range(calls):
+        args = setup()
+        started = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - started)
+        if time.perf_counter() > deadline:
+            break
+    return summary(timings)
+
+
+def bench_cases(size, first_id, rng):
+    """
+    bench_cases returns the (name, func, setup) of the measured calls over
+    size seeded users, the first one with first_id
+    """
+
+    def any_user():
+        return rng.randrange(size)
+
+    def email(n):
+        return f"bench{n}@{BENCH_EMAIL_DOMAIN}"
+
+    def filter_args(name, values, prefix):
+        return lambda: ({name: f"{prefix}{rng.randrange(min(values, size))}"},)
+
+    def filtered(kwargs):
+        return get_users(**kwargs)
+
+    deep_page = max(1, int(size * 0.95) // PAGE_SIZE)
+    deep_cursor = encode_cursor("id", CURSOR_NEXT, [first_id + int(size * 0.95)])
+
+    deleted = itertools.count()
+
+    def bulk_delete_setup():
+        rows = [
+            {
+                "first_name": "Bulk",
+                "middle_name": None,
+                "last_name": "Delete",
+                "email": f"bench-delete{next(deleted)}@{BENCH_EMAIL_DOMAIN}",
+                "password": BENCH_PASSWORD,
+                "role": Role.USER.name,
+            }
+            for _ in range(BULK_DELETE_SIZE)
+        ]
+        return (bulk_create_users(rows),)
+
+    # every sync keeps half of the pairs and replaces the other half
+    csv_versions = [
+        [
+            {"role": Role.USER.name, "permission": f"bench_{version}_{n}"}
+            if n % 2
+            else {"role": Role.ADMIN.name, "permission": f"bench_{n}"}
+            for n in range(CSV_PERMISSIONS)
+        ]
+        for version in range(2)
+    ]
+    csv_version = itertools.count()
+
+    return [
+        ("get_user", get_user, lambda: (first_id + any_user(),)),
+        (
+            "get_hashed_password_by_email",
+            get_hashed_password_by_email,
+            lambda: (email(any_user()),),
+        ),
+        (
+            "get_users[user_id]",
+            filtered,
+            lambda: ({"user_id": first_id + any_user()},),
+        ),
+        (
+            "get_users[user_ids]",
+            filtered,
+            lambda: ({"user_ids": [first_id + any_user() for _ in range(USER_IDS)]},),
+        ),
+        (
+            "get_users[first_name]",
+            filtered,
+            filter_args("first_name", FIRST_NAMES, "First"),
+        ),
+        (
+            "get_users[middle_name]",
+            filtered,
+            filter_args("middle_name", MIDDLE_NAMES, "Middle"),
+        ),
+        (
+            "get_users[last_name]",
+            filtered,
+            filter_args("last_name", LAST_NAMES, "Last"),
+        ),
+        ("get_users[email]", filtered, lambda: ({"email": email(any_user())},)),
+        ("get_users[role]", filtered, lambda: ({"role": Role.ADMIN.name},)),
+        (
+            "get_users[offset, first page]",
+            filtered,
+            lambda: (
+                {
+                    "role": Role.USER.name,
+                    "is_paginated": True,
+                    "page": 1,
+                    "page_size": PAGE_SIZE,
+                },
+            ),
+        ),
+        (
+            "get_users[offset, deep page]",
+            filtered,
+            lambda: (
+                {
+                    "role": Role.USER.name,
+                    "is_paginated": True,
+                    "page": deep_page,
+                    "page_size": PAGE_SIZE,
+                },
+            ),
+        ),
+        (
+            "get_users[keyset, first page]",
+            filtered,
+            lambda: (
+                {
+                    "role": Role.USER.name,
+                    "is_paginated": True,
+                    "pagination": "keyset",
+                    "page_size": PAGE_SIZE,
+                },
+            ),
+        ),
+        (
+            "get_users[keyset, deep page]",
+            filtered,
+            lambda: (
+                {
+                    "role": Role.USER.name,
+                    "is_paginated": True,
+                    "pagination": "keyset",
+                    "page_size": PAGE_SIZE,
+                    "cursor": deep_cursor,
+                },
+            ),
+        ),
+        ("bulk_delete_users", bulk_delete_users, bulk_delete_setup),
+        (
+            "update_role_permission_table_with_csv",
+            update_role_permission_table_with_csv,
+            lambda: (csv_versions[next(csv_version) % 2],),
+        ),
+    ]
+
+
+def package_version():
+    try:
+        return importlib.metadata.version("users-db")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def server_version():
+    with get_engine().connect() as conn:
+        return conn.execute(text("SHOW server_version")).scalar()
+
+
+@db_transaction
+def snapshot_role_permissions(db_conn=None):
+    """
+    the role_permissions rows restored after the run, nested in a
+    db_transaction the read runs on the primary: a lagging replica would
+    return stale rows
+    """
+    role_permissions = get_role_permissions() or []
+    if isinstance(role_permissions, dict):
+        role_permissions = [role_permissions]
+    return role_permissions
+
+
+def run_suite(sizes, calls, max_seconds, cases=None, seed=0, log=click.echo):
+    """
+    run_suite seeds the bench users up to every size in turn and measures
+    the bench_cases, or those whose name is in cases; it returns the results
+    as a JSON-serializable dict
+    """
+    rng = random.Random(seed)
+    results = {}
+    role_permissions = snapshot_role_permissions()
+
+    delete_bench_users()
+    try:
+        seeded = 0
+        for size in sorted(sizes):
+            log(f"seeding {size} users")
+            seed_users(seeded, size)
+            seeded = size
+            first_id = first_bench_id()
+
+            results[str(size)] = size_results = {}
+            for name, call, setup in bench_cases(size, first_id, rng):
+                if cases and name not in cases:
+                    continue
+                size_results[name] = stats = measure(call, setup, calls, max_seconds)
+                log(
+                    f"{size:>8} {name:40} "
+                    f"p50 {stats['p50_ms']:8.3f} ms  p99 {stats['p99_ms']:8.3f} ms"
+                )
+    finally:
+        delete_bench_users()
+        update_role_permission_table_with_csv(role_permissions)
+
+    return {
+        "version": package_version(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "postgres": server_version(),
+        "calls": calls,
+        "results": results,
+    }
+
+
+def compare_results(baseline, current, threshold):
+    """
+    compare_results returns a (size, case, baseline p50, current p50, ratio,
+    regressed) row per case measured in both, regressed when the p50 grew by
+    more than threshold (0.1 is 10%)
+    """
+    rows = []
+    for size, cases in current["results"].items():
+        for name, stats in cases.items():
+            before = baseline["results"].get(size, {}).get(name)
+            if before is None:
+                continue
+            ratio = stats["p50_ms"] / before["p50_ms"] if before["p50_ms"] else 1.0
+            rows.append(
+                (
+                    size,
+                    name,
+                    before["p50_ms"],
+                    stats["p50_ms"],
+                    ratio,
+                    ratio > 1 + threshold,
+                )
+            )
+    return rows
+
+
+LOAD_USERS = 10000
+LOAD_READS = ("get_user", "get_users[last_name]", "get_hashed_password_by_email")
+LOAD_WRITES = ("write_commit", "write_rollback")
+
+BACKEND_PID = text("SELECT pg_backend_pid()")
+
+
+class LoadAnomaly(Exception):
+    """a connection or transaction leak found by the load test"""
+
+
+class LoadRollback(Exception):
+    """rolls back the transaction of a write_rollback"""
+
+
+class ConnectionOwners:
+    """
+    ConnectionOwners maps the DBAPI connections of the running load
+    transactions to their thread, a connection claimed by two threads at once
+    leaks across threads
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._owners = {}
+
+    def claim(self, connection):
+        ident = threading.get_ident()
+        with self._lock:
+            owner = self._owners.setdefault(id(connection), ident)
+        if owner != ident:
+            raise LoadAnomaly(f"a connection is used by threads {owner} and {ident}")
+
+    def release(self, connection):
+        with self._lock:
+            self._owners.pop(id(connection), None)
+
+
+@db_transaction
+def load_write(email, owners, rollback=False, db_conn=None):
+    """
+    load_write creates and updates a user in one transaction, checking that
+    the nested calls run on its connection, in its server session, and see
+    its own writes; with rollback it raises LoadRollback at the end
+    """
+    dbapi_connection = db_conn.connection.dbapi_connection
+    owners.claim(dbapi_connection)
+    try:
+        backend_pid = db_conn.execute(BACKEND_PID).scalar()
+        user_id = create_user(
+            "Load", None, "Write", email, BENCH_PASSWORD, Role.USER.name
+        )
+        update_user(user_id, middle_name="Updated")
+        user = get_user(user_id)
+
+        if current_connection() is not db_conn:
+            raise LoadAnomaly("a nested call left the transaction connection")
+        if user is None or user["middle_name"] != "Updated":
+            raise LoadAnomaly("a nested read missed the transaction's own write")
+        if db_conn.execute(BACKEND_PID).scalar() != backend_pid:
+            raise LoadAnomaly("the transaction moved to another server session")
+    finally:
+        owners.release(dbapi_connection)
+    if rollback:
+        raise LoadRollback()
+    return user_id
+
+
+def user_exists(email):
+    """whether a user with email is committed, read on a connection of its own"""
+    with get_engine().connect() as conn:
+        stmt = select(users.c.id).where(email_equals(email))
+        return conn.execute(stmt).first() is not None
+
+
+def load_call(name, rng, first_id, users_count, email, owners):
+    """
+    load_call runs the operation name and returns its duration; the writes
+    are checked afterwards, untimed
+    """
+    if name == "get_user":
+        call = functools.partial(get_user, first_id + rng.randrange(users_count))
+    elif name == "get_users[last_name]":
+        last_name = f"Last{rng.randrange(min(LAST_NAMES, users_count))}"
+        call = functools.partial(get_users, last_name=last_name)
+    elif name == "get_hashed_password_by_email":
+        call = functools.partial(
+            get_hashed_password_by_email,
+            f"bench{rng.randrange(users_count)}@{BENCH_EMAIL_DOMAIN}",
+        )
+    else:
+        rollback = name == "write_rollback"
+        started = time.perf_counter()
+        try:
+            load_write(email, owners, rollback=rollback)
+        except LoadRollback:
+            pass
+        duration = time.perf_counter() - started
+
+        if user_exists(email) == rollback:
+            raise LoadAnomaly(
+                "a rolled back write was committed"
+                if rollback
+                else "a committed write is missing"
+            )
+        return duration
+
+    started = time.perf_counter()
+    call()
+    return time.perf_counter() - started
+
+
+def load_thread(index, ops, weights, deadline, first_id, users_count, seed, state):
+    """
+    load_thread calls random operations until deadline, then merges its
+    latencies, errors and anomalies into the state shared by the threads
+    """
+    rng = random.Random(seed)
+    emails = (
+        f"bench-load-{os.getpid()}-{index}-{n}@{BENCH_EMAIL_DOMAIN}"
+        for n in itertools.count()
+    )
+    latencies = {name: [] for name in ops}
+    errors = dict.fromkeys(ops, 0)
+    anomalies = []
+
+    state["barrier"].wait()
+    while time.perf_counter() < deadline:
+        name = rng.choices(ops, weights)[0]
+        try:
+            latencies[name].append(
+                load_call(
+                    name, rng, first_id, users_count, next(emails), state["owners"]
+                )
+            )
+        except LoadAnomaly as err:
+            anomalies.append(f"{name}: {err}")
+        except DatabaseError:
+            errors[name] += 1
+
+    if current_scope.get() is not None:
+        anomalies.append("a transaction scope outlived its transaction")
+    with state["lock"]:
+        for name in ops:
+            state["latencies"][name].extend(latencies[name])
+            state["errors"][name] += errors[name]
+        state["anomalies"].extend(anomalies)
+
+
+def run_load(threads, duration, mix, first_id, users_count, seed=0):
+    """
+    run_load runs threads load threads in this process for duration seconds,
+    mix is the (read, write) weights; it returns the latencies and errors per
+    operation and the anomalies found
+    """
+    read_weight, write_weight = mix
+    ops = [*LOAD_READS, *LOAD_WRITES]
+    weights = [read_weight / len(LOAD_READS)] * len(LOAD_READS) + [
+        write_weight / len(LOAD_WRITES)
+    ] * len(LOAD_WRITES)
+
+    state = {
+        "barrier": threading.Barrier(threads + 1),
+        "lock": threading.Lock(),
+        "owners": ConnectionOwners(),
+        "latencies": {name: [] for name in ops},
+        "errors": dict.fromkeys(ops, 0),
+        "anomalies": [],
+    }
+    deadline = time.perf_counter() + duration
+    workers = [
+        threading.Thread(
+            target=load_thread,
+            args=(i, ops, weights, deadline, first_id, users_count, seed + i, state),
+        )
+        for i in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    started = time.perf_counter()
+    state["barrier"].wait()
+    for worker in workers:
+        worker.join()
+    seconds = time.perf_counter() - started
+
+    in_use = get_pool_metrics()["in_use"]
+    if in_use:
+        state["anomalies"].append(f"{in_use} connection(s) not returned")
+    return {
+        "seconds": seconds,
+        "latencies": state["latencies"],
+        "errors": state["errors"],
+        "anomalies": state["anomalies"],
+    }
+
+
+def load_report(results):
+    """merges the run_load results of the processes into the load report"""
+    seconds = max(result["seconds"] for result in results)
+    ops = {}
+    for name in [*LOAD_READS, *LOAD_WRITES]:
+        latencies = [t for result in results for t in result["latencies"][name]]
+        stats = summary(latencies) if latencies else {"calls": 0}
+        stats["ops_per_second"] = len(latencies) / seconds
+        stats["errors"] = sum(result["errors"][name] for result in results)
+        ops[name] = stats
+
+    return {
+        "seconds": seconds,
+        "ops_per_second": sum(stats["ops_per_second"] for stats in ops.values()),
+        "ops": ops,
+        "anomalies": [anomaly for result in results for anomaly in result["anomalies"]],
+    }
+
+
+def parse_mix(ctx, param, value):
+    try:
+        read_weight, write_weight = (float(weight) for weight in value.split(":"))
+    except ValueError:
+        raise click.BadParameter("mix is read:write, e.g. 80:20")
+    if read_weight < 0 or write_weight < 0 or not read_weight + write_weight:
+        raise click.BadParameter("mix weights must be positive")
+    return read_weight, write_weight
+
+
+def parse_sizes(ctx, param, value):
+    try:
+        sizes = [int(size) for size in value.split(",")]
+    except ValueError:
+        raise click.BadParameter("sizes is a comma separated list of integers")
+    if any(size <= 0 for size in sizes):
+        raise click.BadParameter("sizes must be positive")
+    return sizes
+
+
+@click.group()
+def bench_cmd():
+    """users_db performance benchmarks"""
+
+
+@bench_cmd.command("run")
+@click.option(
+    "--sizes",
+    default=DEFAULT_SIZES,
+    callback=parse_sizes,
+    show_default=True,
+    help="Comma separated numbers of seeded users",
+)
+@click.option("--calls", default=200, show_default=True, help="Calls per case")
+@click.option(
+    "--max-seconds",
+    default=10.0,
+    show_default=True,
+    help="Time budget of a case, fewer calls are made past it",
+)
+@click.option("--case", "cases", multiple=True, help="Only run this case")
+@click.option("-o", "--output", type=click.Path(dir_okay=False), help="JSON file")
+@click.option(
+    "--force",
+    is_flag=True,
+    default=False,
+    help="Run even if the users table has users of its own",
+)
+def bench_run_cmd(sizes, calls, max_seconds, cases, output, force):
+    """Seed users and measure the public API"""
+    if other_users_count() and not force:
+        raise click.ClickException(
+            "the users table is not empty, run the benchmarks against a scratch "
+            "database or pass --force"
+        )
+
+    results = run_suite(sizes, calls, max_seconds, cases=cases)
+    if output:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+        click.echo(f"results written to {output}")
+
+
+@bench_cmd.command("compare")
+@click.argument("baseline", type=click.File())
+@click.argument("current", type=click.File())
+@click.option(
+    "--threshold",
+    default=0.1,
+    show_default=True,
+    help="p50 increase reported as a regression, 0.1 is 10%",
+)
+def bench_compare_cmd(baseline, current, threshold):
+    """Compare the p50 latencies of two result files"""
+    rows = compare_results(json.load(baseline), json.load(current), threshold)
+    regressions = 0
+    for size, name, before, after, ratio, regressed in rows:
+        regressions += regressed
+        flag = "REGRESSION" if regressed else ""
+        click.echo(
+            f"{size:>8} {name:40} {before:8.3f} -> {after:8.3f} ms "
+            f"{(ratio - 1) * 100:+7.1f}% {flag}"
+        )
+    if regressions:
+        raise click.ClickException(f"{regressions} regression(s)")
+
+
+@bench_cmd.command("load")
+@click.option("--threads", default=8, show_default=True, help="Threads per process")
+@click.option("--processes", default=1, show_default=True, help="Processes")
+@click.option(
+    "--mix",
+    default="80:20",
+    callback=parse_mix,
+    show_default=True,
+    help="read:write weights of the operations",
+)
+@click.option("--duration", default=10.0, show_default=True, help="Seconds")
+@click.option(
+    "--users", default=LOAD_USERS, show_default=True, help="Seeded users to read"
+)
+@click.option("-o", "--output", type=click.Path(dir_okay=False), help="JSON file")
+@click.option(
+    "--force",
+    is_flag=True,
+    default=False,
+    help="Run even if the users table has users of its own",
+)
+def bench_load_cmd(threads, processes, mix, duration, users, output, force):
+    """Call the API from many threads and processes at once"""
+    if other_users_count() and not force:
+        raise click.ClickException(
+            "the users table is not empty, run the load test against a scratch "
+            "database or pass --force"
+        )
+
+    delete_bench_users()
+    try:
+        seed_users(0, users)
+        first_id = first_bench_id()
+        if processes == 1:
+            results = [run_load(threads, duration, mix, first_id, users)]
+        else:
+            # spawned processes create their own engine and pool
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(processes, mp_context=context) as executor:
+                futures = [
+                    executor.submit(
+                        run_load, threads, duration, mix, first_id, users, n * threads
+                    )
+                    for n in range(processes)
+                ]
+                results = [future.result() for future in futures]
+    finally:
+        delete_bench_users()
+
+    report = load_report(results)
+    click.echo(
+        f"{'operation':32} {'calls':>8} {'ops/s':>9} "
+        f"{'p50 ms':>8} {'p99 ms':>8} {'errors':>7}"
+    )
+    for name, stats in report["ops"].items():
+        click.echo(
+            f"{name:32} {stats['calls']:8} {stats['ops_per_second']:9.1f} "
+            f"{stats.get('p50_ms', 0):8.3f} {stats.get('p99_ms', 0):8.3f} "
+            f"{stats['errors']:7}"
+        )
+    click.echo(f"{'total':32} {'':8} {report['ops_per_second']:9.1f}")
+
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+        click.echo(f"report written to {output}")
+
+    if report["anomalies"]:
+        for anomaly in sorted(set(report["anomalies"])):
+            click.echo(f"anomaly: {anomaly}", err=True)
+        raise click.ClickException(f"{len(report['anomalies'])} anomalies")
+    click.echo("no connection or transaction leak detected")
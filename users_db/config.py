@@ -1,7 +1,7 @@
 import os
 
 
-def get_postgres_uri():
+def get_postgres_uri(driver=None):
     DB_HOST = os.environ.get("DB_HOST", "localhost")
     DB_PASSWORD = os.environ.get("DB_PASSWORD", "postgres123")
     DB_USER = os.environ.get("DB_USER", "users_db")
@@ -13,4 +13,89 @@ def get_postgres_uri():
     db_name = DB_NAME
     port = 54321 if host == "localhost" else 5432
 
-    return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
+    scheme = f"postgresql+{driver}" if driver else "postgresql"
+
+    return f"{scheme}://{user}:{password}@{host}:{port}/{db_name}"
+
+
+def get_postgres_async_uri():
+    return get_postgres_uri(driver="asyncpg")
+
+
+def get_count_cache_ttl():
+    """Seconds a paginated count stays memoized with count_mode="cached" """
+    return float(os.environ.get("DB_COUNT_CACHE_TTL", 60))
+
+
+def _env_flag(name, default):
+    return os.environ.get(name, str(default)).lower() in ("1", "true", "yes", "on")
+
+
+def get_engine_options():
+    """
+    QueuePool settings of the module-level engine, users_db.db.configure_engine
+    overrides them programmatically
+    """
+    return {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("DB_POOL_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", -1)),
+        "pool_pre_ping": _env_flag("DB_POOL_PRE_PING", False),
+        "pool_use_lifo": _env_flag("DB_POOL_USE_LIFO", False),
+    }
+
+
+def get_permissions_cache_ttl():
+    """Seconds a role's permission set stays in the in-process cache"""
+    return float(os.environ.get("DB_PERMISSIONS_CACHE_TTL", 60))
+
+
+def get_permissions_notify():
+    """
+    Whether role_permissions writes send a NOTIFY, so that the processes
+    running role_permissions.start_permissions_listener() drop their cache
+    """
+    return _env_flag("DB_PERMISSIONS_NOTIFY", False)
+
+
+def get_postgres_replica_uris(driver=None):
+    """
+    URIs of the read replicas, comma separated in DB_REPLICA_URIS; the
+    select-only functions are balanced over them (see users_db.routing)
+    """
+    uris = os.environ.get("DB_REPLICA_URIS", "")
+    uris = [uri.strip() for uri in uris.split(",") if uri.strip()]
+    if driver:
+        uris = [f"postgresql+{driver}://{uri.split('://', 1)[1]}" for uri in uris]
+    return uris
+
+
+def get_replica_balancing():
+    """round_robin or least_connections"""
+    return os.environ.get("DB_REPLICA_BALANCING", "round_robin")
+
+
+def get_read_your_writes_window():
+    """
+    Seconds after a commit on the primary during which the reads of the same
+    thread or asyncio task stay on the primary, 0 disables it
+    """
+    return float(os.environ.get("DB_READ_YOUR_WRITES_WINDOW", 0))
+
+
+def get_slow_query_threshold():
+    """
+    Seconds above which a statement is logged by users_db.slow_queries, unset
+    (the default) disables the slow-query log
+    """
+    threshold = os.environ.get("DB_SLOW_QUERY_THRESHOLD")
+    return float(threshold) if threshold else None
+
+
+def get_slow_query_explain_sample():
+    """
+    Share (0 to 1) of the slow selects logged with their
+    EXPLAIN (ANALYZE, BUFFERS) plan, which runs the select once more
+    """
+    return float(os.environ.get("DB_SLOW_QUERY_EXPLAIN_SAMPLE", 0))
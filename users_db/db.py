@@ -1,24 +1,317 @@
 import abc
+import functools
+import io
 import logging
+import os
 import threading
+import time
 
-from typing import Union
+from collections import namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Union
 from enum import Enum
 
-from sqlalchemy import Connection, create_engine
+from sqlalchemy import Connection, QueuePool, create_engine, event
+from sqlalchemy import Enum as EnumType
 from sqlalchemy.sql.dml import Insert, Update, Delete
 from sqlalchemy.sql.selectable import Select
 from sqlalchemy.exc import SQLAlchemyError
 
-from users_db import config
-from users_db.errors import DatabaseError, SqlAlchemyDatabaseError
+from users_db import config, instrumentation, routing, slow_queries
+from users_db.errors import SqlAlchemyDatabaseError
+from users_db.routing import ReplicaSet
+from users_db.schema import public_columns
 
 log = logging.getLogger(__name__)
 
-engine = create_engine(url=config.get_postgres_uri())
+# the engine is created on first use by get_engine(), importing users_db does
+# not load the dialect and the DBAPI driver
+_engine = None
+_engine_pid = None
+_engine_options = {}
+_engine_lock = threading.Lock()
 
-thread_local = threading.local()
 
+def get_engine():
+    """
+    get_engine returns the module-level engine, creating it on first use and
+    again in a forked child process, which must not share the parent's pool
+    """
+    global _engine, _engine_pid
+
+    if _engine is not None and _engine_pid == os.getpid():
+        return _engine
+
+    with _engine_lock:
+        created = _engine is None or _engine_pid != os.getpid()
+        if created:
+            if _engine is not None:
+                # the pooled connections belong to the parent process, drop
+                # them without closing the parent's sockets
+                _engine.dispose(close=False)
+                pool_metrics.reset(in_use=True)
+            _engine = new_engine(
+                create_engine,
+                config.get_postgres_uri(),
+                engine_options(_engine_options),
+            )
+            _engine_pid = os.getpid()
+        engine = _engine
+    if created:
+        # the writes are tracked when there are replicas
+        routing.track_writes(engine, get_replicas() is not None)
+    return engine
+
+
+# shared with users_db.aio.db, which passes create_async_engine as factory
+
+
+# the options of config.get_engine_options() that only QueuePool accepts
+QUEUE_POOL_OPTIONS = ("pool_size", "max_overflow", "pool_timeout", "pool_use_lifo")
+
+
+def engine_options(overrides):
+    """
+    engine_options returns the engine options of config.get_engine_options()
+    with the overrides of configure_engine, without the QueuePool defaults
+    when the overrides pick another poolclass (e.g. NullPool)
+    """
+    options = config.get_engine_options()
+    poolclass = overrides.get("poolclass")
+    if poolclass is not None and not issubclass(poolclass, QueuePool):
+        for name in QUEUE_POOL_OPTIONS:
+            options.pop(name, None)
+    return {**options, **overrides}
+
+
+def new_engine(factory, url, options):
+    """new_engine creates an engine with factory and registers it"""
+    engine = factory(url=url, **options)
+    slow_queries.register(engine)
+    pool_metrics.track(engine)
+    return engine
+
+
+def create_replica_set(
+    factory, uris, options, balancing=None, read_your_writes_window=None
+):
+    """
+    create_replica_set returns the ReplicaSet of the engines of the uris,
+    created with factory and the options, or None without uris; balancing and
+    read_your_writes_window default to the config
+    """
+    if not uris:
+        return None
+    if read_your_writes_window is None:
+        read_your_writes_window = config.get_read_your_writes_window()
+    return ReplicaSet(
+        [new_engine(factory, uri, options) for uri in uris],
+        balancing=balancing or config.get_replica_balancing(),
+        read_your_writes_window=read_your_writes_window,
+    )
+
+
+def __getattr__(name):
+    # keeps users_db.db.engine working while the engine is created lazily
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def configure_engine(**options):
+    """
+    configure_engine replaces the module-level engine with a new one, options
+    are create_engine() keyword arguments and override
+    config.get_engine_options(), e.g. configure_engine(pool_size=20)
+    """
+    global _engine, _engine_pid, _engine_options, _replicas, _replicas_pid
+
+    # a bad configuration raises here and keeps the current engine
+    engine = new_engine(
+        create_engine, config.get_postgres_uri(), engine_options(options)
+    )
+
+    with _engine_lock:
+        old_engine, old_pid = _engine, _engine_pid
+        old_replicas, old_replicas_pid = _replicas, _replicas_pid
+        _engine, _engine_pid, _engine_options = engine, os.getpid(), options
+        # the replicas are created again with the new options
+        _replicas, _replicas_pid = None, None
+        pool_metrics.reset()
+    if old_engine is not None:
+        old_engine.dispose(close=old_pid == os.getpid())
+    if old_replicas is not None:
+        old_replicas.dispose(close=old_replicas_pid == os.getpid())
+    routing.track_writes(engine, get_replicas() is not None)
+    return engine
+
+
+# the ReplicaSet of the read replicas, None without replicas
+_replicas = None
+_replicas_pid = None
+_replica_options = {}
+
+
+def get_replicas():
+    """
+    get_replicas returns the ReplicaSet of config.get_postgres_replica_uris(),
+    or None when there are no replicas; like the engine it is created on first
+    use and again in a forked child process
+    """
+    global _replicas, _replicas_pid
+
+    if _replicas_pid == os.getpid():
+        return _replicas
+
+    with _engine_lock:
+        created = _replicas_pid != os.getpid()
+        if created:
+            if _replicas is not None:
+                _replicas.dispose(close=False)
+            _replicas = create_replicas(**_replica_options)
+            _replicas_pid = os.getpid()
+        replicas = _replicas
+    if created:
+        routing.track_writes(get_engine(), replicas is not None)
+    return replicas
+
+
+def create_replicas(uris=None, balancing=None, read_your_writes_window=None):
+    if uris is None:
+        uris = config.get_postgres_replica_uris()
+    return create_replica_set(
+        create_engine,
+        uris,
+        engine_options(_engine_options),
+        balancing=balancing,
+        read_your_writes_window=read_your_writes_window,
+    )
+
+
+def configure_replicas(**options):
+    """
+    configure_replicas replaces the replicas, options override the config:
+    uris, balancing and read_your_writes_window, e.g.
+    configure_replicas(uris=[...], balancing="least_connections");
+    configure_replicas(uris=[]) routes every read to the primary
+    """
+    global _replicas, _replicas_pid, _replica_options
+
+    with _engine_lock:
+        old_replicas, _replicas, _replicas_pid = _replicas, None, None
+        _replica_options = options
+        if old_replicas is not None:
+            old_replicas.dispose()
+    return get_replicas()
+
+
+def get_read_engine():
+    """
+    get_read_engine returns the engine of a select-only transaction: one of
+    the replicas, or the primary when there are none or during the
+    read-your-writes window of this thread or task
+    """
+    replicas = get_replicas()
+    if replicas is None or replicas.reads_own_writes():
+        return get_engine()
+    return replicas.pick()
+
+
+class PoolMetrics:
+    """
+    PoolMetrics counts the checkouts and checkins of the pools of every engine
+    (primary and replicas, sync and async) and accumulates the time callers
+    wait for a checkout
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset(in_use=True)
+
+    def reset(self, in_use=False):
+        # the connections in use are only forgotten in a forked child, their
+        # checkins would never come
+        with self._lock:
+            self.checkouts = 0
+            self.checkout_waits = 0
+            self.checkout_wait_total = 0.0
+            self.checkout_wait_max = 0.0
+            if in_use:
+                self.in_use = 0
+
+    def track(self, engine):
+        """track listens to the checkouts and checkins of the pool of engine"""
+        pool = getattr(engine, "sync_engine", engine).pool
+        event.listen(pool, "checkout", self.checkout)
+        event.listen(pool, "checkin", self.checkin)
+
+    def checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+
+    def checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.in_use -= 1
+
+    def record_wait(self, wait: float):
+        with self._lock:
+            self.checkout_waits += 1
+            self.checkout_wait_total += wait
+            self.checkout_wait_max = max(self.checkout_wait_max, wait)
+
+
+pool_metrics = PoolMetrics()
+
+
+def get_pool_metrics():
+    """
+    get_pool_metrics returns the checkouts and the connections in use of all
+    the engines, the checkout wait-time statistics in seconds and the usage
+    (connections in use, idle and overflow) of the primary pool
+    """
+    metrics = {
+        "checkouts": pool_metrics.checkouts,
+        "in_use": pool_metrics.in_use,
+        "checkout_wait_total": pool_metrics.checkout_wait_total,
+        "checkout_wait_max": pool_metrics.checkout_wait_max,
+        "checkout_wait_avg": (
+            pool_metrics.checkout_wait_total / pool_metrics.checkout_waits
+            if pool_metrics.checkout_waits
+            else 0.0
+        ),
+    }
+
+    pool = get_engine().pool
+    if isinstance(pool, QueuePool):
+        metrics.update(
+            {
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+            }
+        )
+    return metrics
+
+
+def record_checkout_wait(waited, primary):
+    """
+    record_checkout_wait records the seconds a transaction or a stream waited
+    for its connection, primary tells the engine it came from
+    """
+    pool_metrics.record_wait(waited)
+    if instrumentation.sink is not None:
+        instrumentation.record(
+            instrumentation.CONNECTION_ACQUIRE_SECONDS,
+            waited,
+            engine="primary" if primary else "replica",
+        )
+
+
+# the sensitive columns are not selected (see schema.public_columns), this
+# catches them in results of statements built elsewhere
 REMOVE_KEYS = ["password"]
 
 
@@ -62,136 +355,507 @@ def dict_or_list(result):
     )
 
 
+COLUMN_PLAIN = "plain"
+COLUMN_ENUM = "enum"
+# a column without type information, its values are checked one by one
+COLUMN_UNKNOWN = "unknown"
+
+
+def enum_name(value):
+    return value.name if isinstance(value, Enum) else value
+
+
+def column_kind(column):
+    if isinstance(column.type, EnumType) and column.type.enum_class is not None:
+        return COLUMN_ENUM
+    return COLUMN_PLAIN
+
+
+def result_signature(statement, keys):
+    """
+    result_signature describes the result columns of a statement as a tuple
+    of (key, kind), kind tells how the column values are converted
+    """
+    columns = list(getattr(statement, "exported_columns", ()))
+    if len(columns) != len(keys):
+        return tuple((key, COLUMN_UNKNOWN) for key in keys)
+    return tuple((key, column_kind(column)) for key, column in zip(keys, columns))
+
+
+@functools.lru_cache(maxsize=512)
+def row_type(fields):
+    """
+    row_type returns the named tuple type of typed rows with these fields,
+    one type per field names, shared by all the statements returning them
+    """
+    return namedtuple("Row", fields, rename=True)
+
+
+@functools.lru_cache(maxsize=512)
+def compile_row_transformer(signature, typed=False):
+    """
+    compile_row_transformer builds the function turning a row into the dict
+    db_execute returns, without REMOVE_KEYS and with enums as names, or into a
+    row_type named tuple when typed. The function is generated once per
+    signature, so a row costs a dict display or a tuple display.
+    """
+    keys, values = [], []
+    for index, (key, kind) in enumerate(signature):
+        if key in REMOVE_KEYS:
+            continue
+        value = f"row[{index}]"
+        if kind == COLUMN_ENUM:
+            value = f"(None if {value} is None else {value}.name)"
+        elif kind == COLUMN_UNKNOWN:
+            value = f"enum_name({value})"
+        keys.append(key)
+        values.append(value)
+
+    if typed:
+        # tuple.__new__ skips the argument handling of the named tuple __new__
+        body = f"new(row_type, ({''.join(value + ', ' for value in values)}))"
+    else:
+        body = f"{{{', '.join(f'{k!r}: {v}' for k, v in zip(keys, values))}}}"
+    source = f"def transform_row(row):\n    return {body}\n"
+    namespace = {
+        "enum_name": enum_name,
+        "new": tuple.__new__,
+        "row_type": row_type(tuple(keys)),
+    }
+    exec(source, namespace)
+    return namespace["transform_row"]
+
+
+def transform_rows(statement, cursor_result, typed=False):
+    """
+    transform_rows returns the rows of cursor_result as transformed dicts, or
+    named tuples when typed
+    """
+    transform_row = row_transformer(statement, cursor_result, typed)
+    return [transform_row(row) for row in cursor_result]
+
+
+def row_transformer(statement, cursor_result, typed=False):
+    signature = result_signature(statement, tuple(cursor_result.keys()))
+    return compile_row_transformer(signature, typed)
+
+
+def one_or_list(rows):
+    """the single dict of a one-row result, the list of dicts otherwise"""
+    return rows[0] if len(rows) == 1 else rows
+
+
 def id_or_ids_list(result):
     return result[0][0] if len(result) == 1 else [r[0] for r in result]
 
 
+class TransactionScope:
+    """
+    TransactionScope is the state of a running transaction, created by the
+    outermost db_transaction call and found by the nested ones through
+    current_scope
+    """
+
+    __slots__ = ("connection",)
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
+# the transaction of the current thread or asyncio task; every thread has its
+# own context, so concurrent threads never see each other's scope
+current_scope: ContextVar[Optional[TransactionScope]] = ContextVar(
+    "users_db_transaction_scope", default=None
+)
+
+
 class base_transaction(abc.ABC):
-    def __init__(self, func):
+    """
+    base_transaction decorates a function taking db_conn. The outermost call
+    opens a connection, commits when the function returns and rolls back when
+    it raises; nested calls get the same connection. The decorator keeps no
+    per-call state, so one decorated function is safe to call from many
+    threads.
+
+    With savepoint = True a nested call runs in a SAVEPOINT: when it raises,
+    its changes are rolled back and the enclosing transaction can go on.
+    With replica = True the outermost call runs on a read replica.
+    """
+
+    savepoint = False
+    replica = False
+
+    def __init__(self, func=None):
         self.func = func
+        self.name = instrumentation.function_name(func)
 
     def __call__(self, *args, **kwargs):
+        scope = current_scope.get()
+        if instrumentation.sink is not None:
+            return self.timed_call(scope, args, kwargs)
+        if scope is not None and not self.savepoint:
+            # the hot path of nested calls
+            return self.func(*args, **kwargs, db_conn=scope.connection)
+
+        with self.scope(savepoint=self.savepoint) as scope:
+            return self.func(*args, **kwargs, db_conn=scope.connection)
+
+    def timed_call(self, scope, args, kwargs):
+        """__call__ recording the FUNCTION_SECONDS of the call"""
+        status = instrumentation.STATUS_ERROR
+        started = time.perf_counter()
+        try:
+            if scope is not None and not self.savepoint:
+                result = self.func(*args, **kwargs, db_conn=scope.connection)
+            else:
+                with self.scope(savepoint=self.savepoint) as scope:
+                    result = self.func(*args, **kwargs, db_conn=scope.connection)
+            status = instrumentation.STATUS_OK
+            return result
+        finally:
+            instrumentation.record(
+                instrumentation.FUNCTION_SECONDS,
+                time.perf_counter() - started,
+                function=self.name,
+                status=status,
+            )
+
+    @contextmanager
+    def scope(self, savepoint=False, **options):
+        """
+        scope runs its block in the transaction of the current scope, in a
+        SAVEPOINT of it with savepoint, or else in a new transaction started
+        with the options (see configure) and committed at the end of the block
+        """
+        scope = current_scope.get()
+        if scope is not None:
+            if any(options.values()):
+                raise ValueError(
+                    "transaction options apply to the outermost transaction only"
+                )
+            if not savepoint:
+                yield scope
+                return
+            nested = self.begin_savepoint(scope.connection)
+            try:
+                yield scope
+            except BaseException:
+                self.rollback_savepoint(nested)
+                raise
+            self.release_savepoint(nested)
+            return
+
+        connection = self.open_connection()
+        token = current_scope.set(TransactionScope(connection))
         try:
-            if not hasattr(thread_local, "transaction_stack"):
-                thread_local.transaction_stack = []
-
-            self.connection = self.get_connection()
-            if not self.connection:
-                self.open_connection()
-
-            thread_local.transaction_stack.append(self)
-            # execute a function and return a result
-            return self.func(*args, **kwargs, db_conn=self.connection)
-
-        except DatabaseError as err:
-            # rollback a transaction if an exception occurred and clear the stack by
-            # setting it to an empty list
-
-            if thread_local.transaction_stack:
-                self.rollback()
-                self.close_connection()
-                thread_local.transaction_stack = []
-            raise err
+            self.configure(connection, **options)
+            yield current_scope.get()
+        except BaseException:
+            self.rollback(connection)
+            raise
+        else:
+            self.commit(connection)
         finally:
-            if thread_local.transaction_stack:
-                if thread_local.transaction_stack[0] == self:
-                    self.commit()
-                    self.close_connection()
-                thread_local.transaction_stack.pop()
+            current_scope.reset(token)
+            self.close_connection(connection)
 
     @abc.abstractmethod
-    def get_connection(self):
+    def open_connection(self):
         pass
 
     @abc.abstractmethod
-    def open_connection(self):
+    def configure(self, connection, **options):
+        pass
+
+    @abc.abstractmethod
+    def close_connection(self, connection):
+        pass
+
+    @abc.abstractmethod
+    def rollback(self, connection):
         pass
 
     @abc.abstractmethod
-    def close_connection(self):
+    def commit(self, connection):
         pass
 
     @abc.abstractmethod
-    def rollback(self):
+    def begin_savepoint(self, connection):
         pass
 
     @abc.abstractmethod
-    def commit(self):
+    def rollback_savepoint(self, savepoint):
+        pass
+
+    @abc.abstractmethod
+    def release_savepoint(self, savepoint):
         pass
 
 
 class db_transaction(base_transaction):
-    def __init__(self, func):
-        super().__init__(func)
-        self.connection = None
-
-    def get_connection(self):
-        transaction = (
-            thread_local.transaction_stack[-1]
-            if thread_local.transaction_stack
-            else None
-        )
-        return transaction.connection if transaction else None
+    def configure(
+        self, connection, isolation_level=None, read_only=False, deferrable=False
+    ):
+        # applied before the transaction begins, reset when the connection
+        # goes back to the pool
+        options = {}
+        if isolation_level:
+            options["isolation_level"] = isolation_level
+        if read_only:
+            options["postgresql_readonly"] = True
+        if deferrable:
+            options["postgresql_deferrable"] = True
+        if options:
+            try:
+                connection.execution_options(**options)
+            except SQLAlchemyError as err:
+                raise SqlAlchemyDatabaseError(err)
 
     def open_connection(self):
         try:
-            # checks whether there is a transaction in the stack
-            transaction = (
-                thread_local.transaction_stack[-1]
-                if thread_local.transaction_stack
-                else None
+            started = time.perf_counter()
+            engine = get_read_engine() if self.replica else get_engine()
+            connection = engine.connect()
+            if not self.replica:
+                # a mark left by a statement run outside of db_transaction
+                routing.wrote(connection)
+            record_checkout_wait(time.perf_counter() - started, engine is get_engine())
+            return connection
+        except SQLAlchemyError as err:
+            raise SqlAlchemyDatabaseError(err)
+
+    def close_connection(self, connection):
+        if not connection.closed:
+            connection.close()
+
+    def rollback(self, connection):
+        if not connection.closed:
+            connection.rollback()
+
+    def commit(self, connection):
+        started = time.perf_counter()
+        try:
+            connection.commit()
+        except SQLAlchemyError as err:
+            raise SqlAlchemyDatabaseError(err)
+        if instrumentation.sink is not None:
+            instrumentation.record(
+                instrumentation.COMMIT_SECONDS, time.perf_counter() - started
             )
-            if transaction:
-                self.connection = transaction.connection
+        if not self.replica and routing.wrote(connection):
+            replicas = get_replicas()
+            if replicas is not None:
+                replicas.record_write()
 
-            if self.connection is None:
-                self.connection = engine.connect()
+    def begin_savepoint(self, connection):
+        try:
+            return connection.begin_nested()
         except SQLAlchemyError as err:
             raise SqlAlchemyDatabaseError(err)
 
-    def close_connection(self):
-        if self.connection and not self.connection.closed:
-            self.connection.close()
+    def rollback_savepoint(self, savepoint):
+        if savepoint.is_active:
+            savepoint.rollback()
 
-    def rollback(self):
-        if self.connection and not self.connection.closed:
-            self.connection.rollback()
+    def release_savepoint(self, savepoint):
+        try:
+            savepoint.commit()
+        except SQLAlchemyError as err:
+            raise SqlAlchemyDatabaseError(err)
+
+
+class db_savepoint(db_transaction):
+    """
+    db_savepoint is a db_transaction whose nested calls run in a SAVEPOINT,
+    for functions whose failure the caller may catch and recover from
+    """
+
+    savepoint = True
+
+
+class db_read_transaction(db_transaction):
+    """
+    db_read_transaction is a db_transaction for select-only functions: the
+    outermost call runs on a read replica (see get_read_engine), a nested
+    call joins the enclosing transaction, on the primary for a write
+    transaction. Writes fail on the replicas, which are read-only.
+    """
 
-    def commit(self):
-        if self.connection:
-            self.connection.commit()
+    replica = True
 
 
-def db_execute(statement, db_conn: Connection):
+def transaction(
+    isolation_level=None, read_only=False, deferrable=False, savepoint=False
+):
+    """
+    transaction is a unit of work: every users_db call in its block shares one
+    connection, and the block commits once at its end or rolls back if it
+    raises.
+
+        with users_db.transaction() as tx:
+            for user_id in user_ids:
+                users.update_user(user_id, role="ADMIN")
+            tx.connection.execute(...)
+
+    isolation_level ("READ COMMITTED", "REPEATABLE READ", "SERIALIZABLE"),
+    read_only and deferrable (with SERIALIZABLE and read_only) set up a new
+    transaction. Inside another transaction the block joins it, or with
+    savepoint runs in a SAVEPOINT rolled back alone if the block raises.
+    """
+    return db_transaction().scope(
+        savepoint=savepoint,
+        isolation_level=isolation_level,
+        read_only=read_only,
+        deferrable=deferrable,
+    )
+
+
+def returning_statement(statement):
+    """
+    returning_statement adds the RETURNING clause db_execute relies on:
+    ids for inserts and the public columns of the rows for updates
+    """
+    if isinstance(statement, Insert):
+        return statement.returning(statement.table.c.id)
+    if isinstance(statement, Update):
+        return statement.returning(*public_columns(statement.table))
+    return statement
+
+
+def process_result(statement, cursor_result, typed=False):
+    """
+    process_result turns the result of a statement prepared by
+    returning_statement into the value db_execute returns
+    """
+    if typed and isinstance(statement, (Select, Update)):
+        # always a list, of named tuples
+        return transform_rows(statement, cursor_result, typed=True)
+
+    if isinstance(statement, Select):
+        # sensitive columns are left out and enums converted by the transformer
+        result = one_or_list(transform_rows(statement, cursor_result)) or None
+
+    elif isinstance(statement, Insert):
+        # return the id of the inserted row or a list of ids
+        result = id_or_ids_list(cursor_result.all())
+
+    elif isinstance(statement, Update):
+        # update returns the whole object or a list of objects
+        result = one_or_list(transform_rows(statement, cursor_result))
+
+    elif isinstance(statement, Delete):
+        # return the number of deleted rows
+        result = cursor_result.rowcount
+
+    return result
+
+
+def copy_value(value):
+    """copy_value renders a value in the COPY text format"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, Enum):
+        value = value.name
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def db_copy(table_name: str, columns, rows, db_conn: Connection):
+    """
+    db_copy streams rows (tuples in the order of columns) into a table with
+    COPY FROM STDIN, it needs a psycopg2 connection
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    try:
+        with db_conn.connection.dbapi_connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {table_name} ({', '.join(columns)}) FROM STDIN", buffer
+            )
+            return cursor.rowcount
+    except db_conn.dialect.dbapi.Error as err:
+        raise SqlAlchemyDatabaseError(err)
+
+
+def db_execute(statement, db_conn: Connection, typed: bool = False, parameters=None):
     """
     db_connection function supports executing select, insert, update, delete
-    queries and post-process result data in a user friendly manner
+    queries and post-process result data in a user friendly manner. With typed,
+    selects and updates return a list of named tuples (see row_type) whatever
+    the number of rows, instead of a dict, a list of dicts or None. parameters
+    are the values of the bindparams of a prebuilt statement.
     """
     try:
-        if isinstance(statement, Select):
-            # post-process data here, for example excluding sensitive rows
-            result = db_conn.execute(statement).all()
-            result = dict_or_list(result) or None
-
-        elif isinstance(statement, Insert):
-            # return the id of the inserted row or a list of ids
-            result = db_conn.execute(statement.returning(statement.table.c.id)).all()
-            result = id_or_ids_list(result)
-
-        elif isinstance(statement, Update):
-            # update returns the whole object or a list of objects
-            result = db_conn.execute(statement.returning(statement.table)).all()
-            result = dict_or_list(result)
-
-        elif isinstance(statement, Delete):
-            # return the number of deleted rows
-            result = db_conn.execute(statement)
-            result = result.rowcount
-
-        # post-process data here, for example excluding sensitive rows
-        result = secure_result(serialize_enums(result))
+        statement = returning_statement(statement)
+        if instrumentation.sink is None:
+            cursor_result = db_conn.execute(statement, parameters)
+            return process_result(statement, cursor_result, typed)
+
+        started = time.perf_counter()
+        cursor_result = db_conn.execute(statement, parameters)
+        result = process_result(statement, cursor_result, typed)
+        instrumentation.record_statement(
+            statement, time.perf_counter() - started, result
+        )
         return result
     except SQLAlchemyError as err:
         # wrap SQLAlchemyError into a custom exception (DatabaseError) to handle it
         # later base_transaction
         raise SqlAlchemyDatabaseError(err)
+
+
+def current_connection():
+    """the connection of the db_transaction running in this thread, if any"""
+    scope = current_scope.get()
+    return scope.connection if scope is not None else None
+
+
+def db_stream(statement, chunk_size: int, typed: bool = False):
+    """
+    db_stream is a generator of the rows of a select, in lists of up to
+    chunk_size transformed rows, fetched through a server-side cursor so only
+    one chunk is held in memory.
+
+    Inside a db_transaction it uses the transaction connection and has to be
+    consumed before the transaction ends. Otherwise it opens a connection of
+    its own, to a replica if any (see get_read_engine), closed when the
+    generator is exhausted, closed (e.g. by contextlib.closing or a break out
+    of a for loop followed by garbage collection) or fails.
+    """
+    db_conn = current_connection()
+    owned = db_conn is None
+    if owned:
+        try:
+            started = time.perf_counter()
+            engine = get_read_engine()
+            db_conn = engine.connect()
+            record_checkout_wait(time.perf_counter() - started, engine is get_engine())
+        except SQLAlchemyError as err:
+            raise SqlAlchemyDatabaseError(err)
+
+    cursor_result = None
+    try:
+        # yield_per implies stream_results, a named cursor with psycopg2
+        cursor_result = db_conn.execute(
+            statement, execution_options={"yield_per": chunk_size}
+        )
+        transform_row = row_transformer(statement, cursor_result, typed)
+        for partition in cursor_result.partitions():
+            yield [transform_row(row) for row in partition]
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+    finally:
+        if cursor_result is not None:
+            cursor_result.close()
+        if owned:
+            # a read only transaction, closing the connection rolls it back
+            db_conn.close()
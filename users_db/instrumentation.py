@@ -0,0 +1,244 @@
+"""
+Timings of the users_db functions, statements, connection checkouts and
+commits, sent to a sink once enabled:
+
+    sink = instrumentation.PrometheusSink()
+    instrumentation.enable(sink)
+    ...
+    sink.render()  # the Prometheus text exposition format
+
+A sink is any callable taking (metric, value, labels): a PrometheusSink, an
+OpenTelemetrySink or a function. While disabled, the instrumented code
+checks sink is None and takes no timing.
+"""
+import bisect
+import logging
+import threading
+import time
+
+from sqlalchemy.sql.dml import Delete, Insert, Update
+from sqlalchemy.sql.selectable import Select
+
+log = logging.getLogger(__name__)
+
+# seconds a decorated function (db_transaction, ...) took, labels function
+# (module.qualname) and status (ok or error)
+FUNCTION_SECONDS = "users_db_function_seconds"
+# seconds of a db_execute statement, label statement (select, insert, ...)
+STATEMENT_SECONDS = "users_db_statement_seconds"
+# rows returned (or deleted) by a db_execute statement, label statement
+STATEMENT_ROWS = "users_db_statement_rows"
+# seconds waiting for a connection of the pool, label engine (primary or
+# replica)
+CONNECTION_ACQUIRE_SECONDS = "users_db_connection_acquire_seconds"
+# seconds of the COMMIT of an outermost transaction
+COMMIT_SECONDS = "users_db_commit_seconds"
+
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+
+SECONDS_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+sink = None
+
+
+def enable(new_sink):
+    """enable sends the measurements to new_sink, replacing the current one"""
+    global sink
+
+    sink = new_sink
+
+
+def disable():
+    enable(None)
+
+
+def record(metric, value, **labels):
+    current = sink
+    if current is None:
+        return
+    try:
+        current(metric, value, labels)
+    except Exception:
+        # a broken sink must not fail the database call
+        log.exception("instrumentation sink failed on %s", metric)
+
+
+def statement_type(statement):
+    if isinstance(statement, Select):
+        return "select"
+    if isinstance(statement, Insert):
+        return "insert"
+    if isinstance(statement, Update):
+        return "update"
+    if isinstance(statement, Delete):
+        return "delete"
+    return "other"
+
+
+def result_rows(statement, result):
+    """the number of rows of a db_execute result"""
+    if isinstance(statement, Delete):
+        return result
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+
+def record_statement(statement, seconds, result):
+    kind = statement_type(statement)
+    record(STATEMENT_SECONDS, seconds, statement=kind)
+    record(STATEMENT_ROWS, result_rows(statement, result), statement=kind)
+
+
+def function_name(func):
+    if func is None:
+        return None
+    return f"{func.__module__}.{func.__qualname__}"
+
+
+class Histogram:
+    """Histogram counts the observed values per bucket upper bound"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # one count per bucket, the last one for the values above them all
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """(upper bound, count of the values <= upper bound), +Inf last"""
+        total = 0
+        bounds = [*self.buckets, float("inf")]
+        cumulative = []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    return ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+
+
+class PrometheusSink:
+    """
+    PrometheusSink keeps a Histogram per metric and labels, render() returns
+    them in the Prometheus text exposition format, to be served on /metrics
+    """
+
+    def __init__(self, seconds_buckets=SECONDS_BUCKETS, rows_buckets=ROWS_BUCKETS):
+        self.seconds_buckets = seconds_buckets
+        self.rows_buckets = rows_buckets
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, metric, value, labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                buckets = (
+                    self.rows_buckets
+                    if metric == STATEMENT_ROWS
+                    else self.seconds_buckets
+                )
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def get(self, metric, **labels):
+        """the Histogram of metric with exactly these labels, if any"""
+        return self.histograms.get((metric, tuple(sorted(labels.items()))))
+
+    def clear(self):
+        with self._lock:
+            self.histograms.clear()
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = {}
+            for (metric, labels), histogram in sorted(self.histograms.items()):
+                metrics.setdefault(metric, []).append((labels, histogram))
+
+            for metric, histograms in metrics.items():
+                lines.append(f"# TYPE {metric} histogram")
+                for labels, histogram in histograms:
+                    for bound, count in histogram.cumulative_counts():
+                        bucket_labels = format_labels(
+                            [*labels, ("le", format_value(bound))]
+                        )
+                        lines.append(f"{metric}_bucket{{{bucket_labels}}} {count}")
+                    series = f"{{{format_labels(labels)}}}" if labels else ""
+                    lines.append(f"{metric}_sum{series} {format_value(histogram.sum)}")
+                    lines.append(f"{metric}_count{series} {histogram.count}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+class OpenTelemetrySink:
+    """
+    OpenTelemetrySink turns the timings into spans of an OpenTelemetry tracer,
+    started back in time by their duration, with the labels as attributes;
+    the row counts are left out. It needs opentelemetry-api installed.
+    """
+
+    def __init__(self, tracer=None):
+        if tracer is None:
+            try:
+                from opentelemetry import trace
+            except ImportError as err:
+                raise ImportError(
+                    "OpenTelemetrySink needs the opentelemetry-api package"
+                ) from err
+            tracer = trace.get_tracer("users_db")
+        self.tracer = tracer
+
+    def __call__(self, metric, value, labels):
+        if metric == STATEMENT_ROWS:
+            return
+        end_time = time.time_ns()
+        if "function" in labels:
+            name = labels["function"]
+        elif "statement" in labels:
+            name = f"users_db {labels['statement']}"
+        else:
+            name = metric
+        span = self.tracer.start_span(
+            name,
+            start_time=end_time - int(value * 1e9),
+            attributes={"users_db.metric": metric, **labels},
+        )
+        span.end(end_time=end_time)
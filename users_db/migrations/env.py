@@ -5,7 +5,7 @@ from sqlalchemy import create_engine
 from alembic import context
 
 from users_db import config as app_cfg
-from users_db.schema import Base
+from users_db.schema import Base, declare_trigram_indexes
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -22,6 +22,7 @@ if config.config_file_name is not None:
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
 
+declare_trigram_indexes()
 target_metadata = Base.metadata
 
 # other values from the config, defined by the needs of env.py,
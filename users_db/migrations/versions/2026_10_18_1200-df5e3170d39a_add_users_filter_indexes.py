@@ -0,0 +1,49 @@
+"""add users filter indexes
+
+Revision ID: df5e3170d39a
+Revises: 27133ce191df
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "df5e3170d39a"
+down_revision = "27133ce191df"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # CREATE INDEX CONCURRENTLY does not lock the table against writes, it
+    # can not run inside a transaction
+    with op.get_context().autocommit_block():
+        # last_name and last_name + first_name filters, ordered by last name
+        op.create_index(
+            "ix_users_last_name_first_name",
+            "users",
+            ["last_name", "first_name"],
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_users_role", "users", ["role"], postgresql_concurrently=True
+        )
+        # case-insensitive email lookups, lower(email) = lower(:email)
+        op.create_index(
+            "ix_users_lower_email",
+            "users",
+            [sa.text("lower(email)")],
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name in (
+            "ix_users_lower_email",
+            "ix_users_role",
+            "ix_users_last_name_first_name",
+        ):
+            op.drop_index(name, table_name="users", postgresql_concurrently=True)
@@ -0,0 +1,46 @@
+"""add users search trigram indexes
+
+Revision ID: 0edba4ebb4ac
+Revises: df5e3170d39a
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "0edba4ebb4ac"
+down_revision = "df5e3170d39a"
+branch_labels = None
+depends_on = None
+
+SEARCH_COLUMNS = ("first_name", "last_name", "email")
+
+
+def upgrade() -> None:
+    # pg_trgm ships with the postgres contrib modules, before PostgreSQL 13
+    # creating it needs a superuser
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+    # GIN trigram indexes serve the ILIKE '%query%' matches of search_users
+    with op.get_context().autocommit_block():
+        for column in SEARCH_COLUMNS:
+            op.create_index(
+                f"ix_users_{column}_trgm",
+                "users",
+                [column],
+                postgresql_using="gin",
+                postgresql_ops={column: "gin_trgm_ops"},
+                postgresql_concurrently=True,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for column in SEARCH_COLUMNS:
+            op.drop_index(
+                f"ix_users_{column}_trgm",
+                table_name="users",
+                postgresql_concurrently=True,
+            )
+    # the extension is left installed, other objects may depend on it
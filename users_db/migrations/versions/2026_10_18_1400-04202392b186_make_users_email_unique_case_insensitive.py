@@ -0,0 +1,76 @@
+"""make users email unique case-insensitive
+
+Revision ID: 04202392b186
+Revises: 0edba4ebb4ac
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "04202392b186"
+down_revision = "0edba4ebb4ac"
+branch_labels = None
+depends_on = None
+
+
+# a failed CREATE INDEX CONCURRENTLY leaves an INVALID index behind, which
+# still has to be maintained by every write and keeps the name taken
+DROP_UNIQUE_INDEX = "DROP INDEX CONCURRENTLY IF EXISTS uq_users_lower_email"
+
+
+def upgrade() -> None:
+    # fails early with the duplicates listed; one inserted by a concurrent
+    # transaction after the check fails the index build below instead
+    duplicates = (
+        op.get_bind()
+        .execute(
+            sa.text(
+                "SELECT lower(email) FROM users GROUP BY lower(email) "
+                "HAVING count(*) > 1 LIMIT 10"
+            )
+        )
+        .scalars()
+        .all()
+    )
+    if duplicates:
+        raise RuntimeError(
+            "users differing only by the case of their email must be merged "
+            f"first: {', '.join(duplicates)}"
+        )
+
+    with op.get_context().autocommit_block():
+        # the leftover of an earlier failed run
+        op.execute(DROP_UNIQUE_INDEX)
+        try:
+            op.create_index(
+                "uq_users_lower_email",
+                "users",
+                [sa.text("lower(email)")],
+                unique=True,
+                postgresql_concurrently=True,
+            )
+        except Exception:
+            # e.g. a duplicate created during the build, the migration can be
+            # run again once it is merged
+            op.execute(DROP_UNIQUE_INDEX)
+            raise
+        op.drop_index(
+            "ix_users_lower_email", table_name="users", postgresql_concurrently=True
+        )
+    # lower(email) unique implies email unique
+    op.drop_constraint("users_email_key", "users", type_="unique")
+
+
+def downgrade() -> None:
+    op.create_unique_constraint("users_email_key", "users", ["email"])
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_users_lower_email",
+            "users",
+            [sa.text("lower(email)")],
+            postgresql_concurrently=True,
+        )
+        op.execute(DROP_UNIQUE_INDEX)
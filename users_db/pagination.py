@@ -1,60 +1,336 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from math import ceil
 from functools import wraps
 
-from sqlalchemy import Select, func, select, literal
+from sqlalchemy import Select, func, select, literal, tuple_
+from sqlalchemy.exc import SQLAlchemyError
 
+from users_db import config
+from users_db.cache import TTLCache
+from users_db.db import db_execute, transform_rows
+from users_db.errors import SqlAlchemyDatabaseError
+from users_db.utils import explain, json_build_object_columns
 
-from users_db.db import db_execute
-from users_db.utils import json_build_object_columns
+PAGINATION_OFFSET = "offset"
+PAGINATION_KEYSET = "keyset"
+
+CURSOR_NEXT = "next"
+CURSOR_PREV = "prev"
+
+COUNT_EXACT = "exact"
+COUNT_NONE = "none"
+COUNT_ESTIMATED = "estimated"
+COUNT_CACHED = "cached"
+COUNT_WINDOW = "window"
+COUNT_MODES = (COUNT_EXACT, COUNT_NONE, COUNT_ESTIMATED, COUNT_CACHED, COUNT_WINDOW)
+
+WINDOW_COUNT_KEY = "_items_count"
+
+count_cache = TTLCache(ttl=config.get_count_cache_ttl())
+
+
+def exact_count(query: Select, db_conn) -> int:
+    subq_1 = query.alias("subq_1")
+    return db_conn.execute(
+        select(func.count().label("count")).select_from(subq_1)
+    ).scalar()
+
+
+def estimated_count(query: Select, db_conn) -> int:
+    """
+    estimated_count returns the planner's row estimate for the query, it does
+    not touch the rows, so it is only as accurate as the table statistics
+    """
+    plan = db_conn.execute(explain(query)).scalar()
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def cached_count(query: Select, db_conn) -> int:
+    """
+    cached_count memoizes the exact count per compiled query and its
+    parameters (the filter set) for config.get_count_cache_ttl() seconds
+    """
+    compiled = query.compile(dialect=db_conn.dialect)
+    params = tuple(
+        (key, tuple(value) if isinstance(value, list) else value)
+        for key, value in sorted(compiled.params.items())
+    )
+    key = (str(compiled), params)
+
+    items_count = count_cache.get(key)
+    if items_count is None:
+        items_count = exact_count(query, db_conn)
+        count_cache.set(key, items_count)
+    return items_count
+
+
+def count_items(query: Select, db_conn, count_mode: str):
+    """count_items returns the number of rows of the query or None"""
+    try:
+        if count_mode == COUNT_EXACT:
+            return exact_count(query, db_conn)
+        if count_mode == COUNT_ESTIMATED:
+            return estimated_count(query, db_conn)
+        if count_mode == COUNT_CACHED:
+            return cached_count(query, db_conn)
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+    return None
+
+
+def encode_cursor(order_by: str, direction: str, key: list) -> str:
+    """
+    encode_cursor packs the keyset position into an opaque url-safe string
+    """
+    payload = json.dumps({"o": order_by, "d": direction, "k": key})
+    return urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, order_by: str):
+    """
+    decode_cursor returns (direction, key) of a cursor made by encode_cursor
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(urlsafe_b64decode(padded.encode()))
+        direction, key = payload["d"], payload["k"]
+        cursor_order_by = payload["o"]
+    except (ValueError, TypeError, KeyError) as err:
+        raise ValueError("cursor is malformed") from err
+
+    if cursor_order_by != order_by:
+        raise ValueError(f"cursor was issued for order_by={cursor_order_by!r}")
+    if direction not in (CURSOR_NEXT, CURSOR_PREV) or not isinstance(key, list):
+        raise ValueError("cursor is malformed")
+    return direction, key
+
+
+def row_value(row, name):
+    """the value of a dict or a typed row item"""
+    return row[name] if isinstance(row, dict) else getattr(row, name)
+
+
+def keyset_page(
+    query: Select,
+    db_conn,
+    page_size,
+    cursor=None,
+    order_by="id",
+    count_mode=COUNT_NONE,
+    typed=False,
+):
+    """
+    keyset_page seeks to the cursor position on (order_by, id) instead of
+    skipping rows with OFFSET, so every page costs the same as the first one.
+    With typed the items are named tuples.
+    """
+    subq = query.subquery("subq_1")
+
+    if order_by not in subq.c:
+        raise ValueError(f"order_by column {order_by!r} is not selected")
+    if subq.c[order_by].nullable:
+        raise ValueError(f"order_by column {order_by!r} must not be nullable")
+
+    # id makes the sort key unique when order_by has duplicates
+    key_names = [order_by] if order_by == "id" else [order_by, "id"]
+    key_cols = [subq.c[name] for name in key_names]
+
+    direction = CURSOR_NEXT
+    stmt = select(subq)
+    if cursor:
+        direction, key = decode_cursor(cursor, order_by)
+        if len(key) != len(key_cols):
+            raise ValueError("cursor is malformed")
+        if direction == CURSOR_NEXT:
+            stmt = stmt.where(tuple_(*key_cols) > tuple_(*key))
+        else:
+            stmt = stmt.where(tuple_(*key_cols) < tuple_(*key))
+
+    if direction == CURSOR_NEXT:
+        stmt = stmt.order_by(*[c.asc() for c in key_cols])
+    else:
+        stmt = stmt.order_by(*[c.desc() for c in key_cols])
+
+    # fetch one extra row to know whether there is a page after this one
+    stmt = stmt.limit(page_size + 1)
+    try:
+        rows = transform_rows(stmt, db_conn.execute(stmt), typed)
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+    has_more = len(rows) > page_size
+    items = rows[:page_size]
+
+    if direction == CURSOR_PREV:
+        items.reverse()
+        has_next, has_prev = bool(cursor), has_more
+    else:
+        has_next, has_prev = has_more, bool(cursor)
+
+    next_cursor = prev_cursor = None
+    if items and has_next:
+        key = [row_value(items[-1], name) for name in key_names]
+        next_cursor = encode_cursor(order_by, CURSOR_NEXT, key)
+    if items and has_prev:
+        key = [row_value(items[0], name) for name in key_names]
+        prev_cursor = encode_cursor(order_by, CURSOR_PREV, key)
+
+    page = {
+        "page_size": page_size,
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
+        "items": items,
+    }
+    if count_mode != COUNT_NONE:
+        # keyset pages do not select the whole set, the window count falls
+        # back to an exact one
+        if count_mode == COUNT_WINDOW:
+            count_mode = COUNT_EXACT
+        page["items_count"] = count_items(query, db_conn, count_mode)
+    return page
+
+
+def window_offset_page(query: Select, db_conn, page, page_size):
+    """
+    window_offset_page returns the same page as offset_page in a single
+    statement, the total is computed by count(*) over () before LIMIT applies
+    """
+    limit = page_size
+    offset = (page - 1) * page_size
+
+    subq_2 = (
+        query.add_columns(func.count().over().label(WINDOW_COUNT_KEY))
+        .limit(limit)
+        .offset(offset)
+        .alias("subq_2")
+    )
+    items_count = func.max(subq_2.c[WINDOW_COUNT_KEY])
+
+    select_stmt = select(
+        items_count.label("items_count"),
+        literal(page).label("page"),
+        literal(page_size).label("page_size"),
+        ((items_count + page_size - 1) // page_size).label("pages"),
+        func.json_agg(
+            func.json_build_object(
+                *json_build_object_columns(subq_2, exclude=(WINDOW_COUNT_KEY,))
+            )
+        ).label("items"),
+    ).select_from(subq_2)
+
+    result = db_execute(select_stmt, db_conn=db_conn)
+
+    if result["items_count"] is None:
+        # the page is past the last row, so there was no row to carry the
+        # total; only this case costs a second statement
+        items_count = 0 if page == 1 else count_items(query, db_conn, COUNT_EXACT)
+        result["items_count"] = items_count
+        result["pages"] = ceil(items_count / page_size)
+    return result
+
+
+def offset_page(query: Select, db_conn, page, page_size, count_mode=COUNT_EXACT):
+    """
+    offset_page returns the page-th page of the query with LIMIT/OFFSET.
+    With count_mode=COUNT_NONE the count is skipped, items_count and pages
+    are None and has_next is found by fetching one extra row.
+    """
+    if count_mode == COUNT_WINDOW:
+        return window_offset_page(query, db_conn, page, page_size)
+
+    # calcualate limit and offset
+    limit = page_size
+    offset = (page - 1) * page_size
+
+    # Get full count of items
+    items_count = count_items(query, db_conn, count_mode)
+    if count_mode == COUNT_NONE:
+        limit += 1
+
+    # Get items for the current page
+    subq_2 = query.limit(limit).offset(offset).alias("subq_2")
+
+    select_stmt = select(
+        literal(items_count).label("items_count"),
+        literal(page).label("page"),
+        literal(page_size).label("page_size"),
+        literal(None if items_count is None else ceil(items_count / page_size)).label(
+            "pages"
+        ),
+        func.json_agg(func.json_build_object(*json_build_object_columns(subq_2))).label(
+            "items"
+        ),
+    ).select_from(subq_2)
+
+    result = db_execute(select_stmt, db_conn=db_conn)
+
+    if count_mode == COUNT_NONE:
+        items = result["items"] or []
+        result["has_next"] = len(items) > page_size
+        result["items"] = items[:page_size] or None
+    return result
 
 
 def paginate(f):
-    """wrapper kwargs should contain page and page_size"""
+    """
+    wrapper kwargs should contain page and page_size, or page_size and
+    an optional cursor when pagination=PAGINATION_KEYSET. count_mode is one of
+    COUNT_MODES and defaults to COUNT_EXACT for offset and COUNT_NONE for
+    keyset pagination. typed returns named tuples instead of dicts (see
+    db.db_execute), it is not supported by offset pagination whose items are
+    built as json by the server.
+    """
 
     @wraps(f)
     def wrapper(*args, **kwargs):
         db_conn = kwargs.pop("db_conn", None)
         is_paginated = kwargs.pop("is_paginated", False)
+        pagination = kwargs.pop("pagination", PAGINATION_OFFSET)
         page = kwargs.pop("page", None)
         page_size = kwargs.pop("page_size", None)
+        cursor = kwargs.pop("cursor", None)
+        order_by = kwargs.pop("order_by", "id")
+        count_mode = kwargs.pop("count_mode", None)
+        typed = kwargs.pop("typed", False)
 
         query = f(*args, **kwargs)
 
         if not is_paginated:
-            return db_execute(query, db_conn=db_conn)
-
-        if not page or not page_size:
-            raise ValueError("page and page_size must be provided")
+            return db_execute(query, db_conn=db_conn, typed=typed)
 
         if not isinstance(query, Select):
             raise TypeError("f must return a sqlalchemy.sql.selectable.Select object")
 
-        # calcualate limit and offset
-        limit = page_size
-        offset = (page - 1) * page_size
-
-        # Get full count of items
-        subq_1 = query.alias("subq_1")
-        items_count = db_conn.execute(
-            select(
-                func.count().label("count"),
-                # func.json_agg(func.json_build_object(*key_col_list)).label("items"),
-            ).select_from(subq_1)
-        ).scalar()
-
-        # Get items for the current page
-        subq_2 = query.limit(limit).offset(offset).alias("subq_2")
-
-        select_stmt = select(
-            literal(items_count).label("items_count"),
-            literal(page).label("page"),
-            literal(page_size).label("page_size"),
-            literal(ceil(items_count / page_size)).label("pages"),
-            func.json_agg(
-                func.json_build_object(*json_build_object_columns(subq_2))
-            ).label("items"),
-        ).select_from(subq_2)
-
-        return db_execute(select_stmt, db_conn=db_conn)
+        if count_mode is not None and count_mode not in COUNT_MODES:
+            raise ValueError(f"unknown count mode: {count_mode!r}")
+
+        if pagination == PAGINATION_KEYSET:
+            if not page_size:
+                raise ValueError("page_size must be provided")
+            return keyset_page(
+                query,
+                db_conn=db_conn,
+                page_size=page_size,
+                cursor=cursor,
+                order_by=order_by,
+                count_mode=count_mode or COUNT_NONE,
+                typed=typed,
+            )
+
+        if pagination != PAGINATION_OFFSET:
+            raise ValueError(f"unknown pagination mode: {pagination!r}")
+
+        if not page or not page_size:
+            raise ValueError("page and page_size must be provided")
+        if typed:
+            raise ValueError("typed rows are not supported by offset pagination")
+
+        return offset_page(
+            query,
+            db_conn=db_conn,
+            page=page,
+            page_size=page_size,
+            count_mode=count_mode or COUNT_EXACT,
+        )
 
     return wrapper
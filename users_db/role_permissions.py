@@ -1,107 +1,246 @@
 import logging
+import select
+import threading
 from typing import List
-from sqlalchemy import insert, select, update, delete
 
-# func.json_build_array, func.json_build_object, func.json_agg
-from sqlalchemy.sql.expression import func
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
 
-from users_db.db import db_transaction, db_execute
-from users_db.schema import Role, role_permission
+from users_db import config, statements
+from users_db.cache import TTLCache
+from users_db.db import (
+    current_scope,
+    db_execute,
+    db_read_transaction,
+    db_transaction,
+    get_engine,
+)
+from users_db.errors import SqlAlchemyDatabaseError
+from users_db.schema import Role
 
 ROLE_SUPER_ADMIN = Role.SUPER_ADMIN.name
 ROLE_ADMIN = Role.ADMIN.name
 ROLE_USER = Role.USER.name
 
+PERMISSIONS_CHANNEL = "users_db_role_permissions"
+
 
 log = logging.getLogger(__name__)
 
+# role name -> frozenset of permission names
+permissions_cache = TTLCache(ttl=config.get_permissions_cache_ttl())
+
+
+# set in the info of a connection whose transaction wrote role_permissions
+PERMISSIONS_CHANGED = "users_db_permissions_changed"
+
+
+def transaction_ended(db_conn):
+    if db_conn.info.pop(PERMISSIONS_CHANGED, False):
+        permissions_cache.clear()
+
+
+def drop_permissions_cache(db_conn):
+    """
+    drop_permissions_cache clears permissions_cache now and once more when the
+    transaction of db_conn ends, so that a set loaded meanwhile from
+    uncommitted or outdated rows does not stay cached; the end of transaction
+    listeners are registered once per connection, whatever the writes
+    """
+    permissions_cache.clear()
+    db_conn.info[PERMISSIONS_CHANGED] = True
+    if not event.contains(db_conn, "commit", transaction_ended):
+        event.listen(db_conn, "commit", transaction_ended)
+        event.listen(db_conn, "rollback", transaction_ended)
+
+
+def wrote_permissions(db_conn) -> bool:
+    """
+    whether the transaction of db_conn wrote role_permissions, its reads see
+    its uncommitted rows, which must not reach permissions_cache
+    """
+    return db_conn is not None and db_conn.info.get(PERMISSIONS_CHANGED, False)
+
+
+def permissions_changed(db_conn):
+    """
+    permissions_changed is called by every role_permissions write, with
+    config.get_permissions_notify() the other processes are notified on commit
+    """
+    drop_permissions_cache(db_conn)
+    if config.get_permissions_notify():
+        db_execute(statements.notify_stmt(PERMISSIONS_CHANNEL), db_conn=db_conn)
+
+
+def role_name(role) -> str:
+    return role.name if isinstance(role, Role) else role
+
+
+def get_permission_set(role) -> frozenset:
+    """
+    get_permission_set returns the permission names of a role, read through
+    permissions_cache; the role_permissions write functions invalidate it
+    """
+    role = role_name(role)
+    scope = current_scope.get()
+    if scope is not None and wrote_permissions(scope.connection):
+        return load_permission_set(role)
+
+    permissions = permissions_cache.get(role)
+    if permissions is None:
+        generation = permissions_cache.generation
+        permissions = load_permission_set(role)
+        permissions_cache.set(role, permissions, generation=generation)
+    return permissions
+
+
+# the permission checks read the primary: a set loaded from a lagging replica
+# would stay cached for the TTL after the invalidation of a write
+@db_transaction
+def load_permission_set(role: str, db_conn=None) -> frozenset:
+    stmt = statements.GET_PERMISSION_NAMES_FOR_ROLE_STMT
+    try:
+        return frozenset(db_conn.execute(stmt, {"role": role}).scalars())
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+
+
+def has_permission(role, permission: str, use_cache: bool = True) -> bool:
+    """
+    has_permission tells whether the role has the permission. A cache hit is
+    a dict lookup and a set membership test, with use_cache=False it is one
+    EXISTS query.
+    """
+    if use_cache:
+        return permission in get_permission_set(role)
+    return query_has_permission(role_name(role), permission)
+
+
+def has_permissions(role, permissions: List[str], use_cache: bool = True):
+    """has_permissions returns a bool per permission, in the same order"""
+    if use_cache:
+        granted = get_permission_set(role)
+    else:
+        granted = query_granted_permissions(role_name(role), permissions)
+    return [permission in granted for permission in permissions]
+
+
+@db_transaction
+def query_has_permission(role: str, permission: str, db_conn=None) -> bool:
+    stmt = statements.HAS_PERMISSION_STMT
+    parameters = {"role": role, "permission": permission}
+    try:
+        return db_conn.execute(stmt, parameters).scalar()
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+
+
+@db_transaction
+def query_granted_permissions(role: str, permissions: List[str], db_conn=None):
+    stmt = statements.get_granted_permissions_stmt(role, permissions)
+    try:
+        return frozenset(db_conn.execute(stmt).scalars())
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+
 
 @db_transaction
 def create_permission_for_role(role: str, permission: str, db_conn=None):
-    stmt = insert(role_permission).values(role=role, permission=permission)
-    return db_execute(stmt, db_conn=db_conn)
+    stmt = statements.create_permission_for_role_stmt(role, permission)
+    result = db_execute(stmt, db_conn=db_conn)
+    permissions_changed(db_conn)
+    return result
 
 
 @db_transaction
 def create_permissions_for_role(role: str, permissions: List[str], db_conn=None):
-    stmt = insert(role_permission).values(
-        [{"role": role, "permission": permission} for permission in permissions]
-    )
-    return db_execute(stmt, db_conn=db_conn)
+    stmt = statements.create_permissions_for_role_stmt(role, permissions)
+    result = db_execute(stmt, db_conn=db_conn)
+    permissions_changed(db_conn)
+    return result
 
 
-@db_transaction
-def get_role_permission(role_permission_id, db_conn=None):
-    select_stmt = select(role_permission).where(
-        role_permission.c.id == role_permission_id
-    )
-    row = db_execute(select_stmt, db_conn=db_conn)
+@db_read_transaction
+def get_role_permission(role_permission_id, typed=False, db_conn=None):
+    select_stmt = statements.GET_ROLE_PERMISSION_STMT
+    parameters = {"role_permission_id": role_permission_id}
+    row = db_execute(select_stmt, db_conn=db_conn, typed=typed, parameters=parameters)
     return row
 
 
-@db_transaction
+@db_read_transaction
 def get_role_permissions(
-    role_permission_ids=None, role=None, permission=None, db_conn=None
+    role_permission_ids=None, role=None, permission=None, typed=False, db_conn=None
 ):
-    select_stmt = select(role_permission)
-
-    if role_permission_ids:
-        select_stmt = select_stmt.where(role_permission.c.id.in_(role_permission_ids))
-    if role:
-        select_stmt = select_stmt.where(role_permission.c.role == role)
-    if permission:
-        select_stmt = select_stmt.where(role_permission.c.permission == permission)
-    row = db_execute(select_stmt, db_conn=db_conn)
+    select_stmt = statements.get_role_permissions_stmt(
+        role_permission_ids=role_permission_ids, role=role, permission=permission
+    )
+    row = db_execute(select_stmt, db_conn=db_conn, typed=typed)
     return row
 
 
-@db_transaction
-def get_permissions_for_role(role: str, db_conn=None):
-    select_stmt = (
-        select(
-            role_permission.c.role,
-            func.json_agg(
-                func.json_build_object(
-                    "id",
-                    role_permission.c.id,
-                    "permission",
-                    role_permission.c.permission,
-                )
-            ).label("permissions"),
-        )
-        .where(role_permission.c.role == role)
-        .group_by(role_permission.c.role)
-    )
-    row = db_execute(select_stmt, db_conn=db_conn)
+@db_read_transaction
+def get_permissions_for_role(role: str, typed=False, db_conn=None):
+    select_stmt = statements.GET_PERMISSIONS_FOR_ROLE_STMT
+    parameters = {"role": role}
+    row = db_execute(select_stmt, db_conn=db_conn, typed=typed, parameters=parameters)
     return row
 
 
 @db_transaction
 def update_permissions_for_role(role_permission_id, db_conn=None, **values):
-    update_stmt = (
-        update(role_permission)
-        .where(role_permission.c.id == role_permission_id)
-        .values(**values)
+    update_stmt = statements.update_permissions_for_role_stmt(
+        role_permission_id, **values
     )
-    return db_execute(update_stmt, db_conn=db_conn)
+    result = db_execute(update_stmt, db_conn=db_conn)
+    permissions_changed(db_conn)
+    return result
 
 
 @db_transaction
 def delete_role_permissions(
     id=None, ids=None, role=None, permission=None, db_conn=None
 ):
-    delete_stmt = delete(role_permission)
+    delete_stmt = statements.delete_role_permissions_stmt(
+        id=id, ids=ids, role=role, permission=permission
+    )
+    result = db_execute(delete_stmt, db_conn=db_conn)
+    permissions_changed(db_conn)
+    return result
+
 
-    if id:
-        delete_stmt = delete_stmt.where(role_permission.c.id == id)
-    if ids:
-        delete_stmt = delete_stmt.where(role_permission.c.id.in_(ids))
-    if role:
-        delete_stmt = delete_stmt.where(role_permission.c.role == role)
-    if permission:
-        delete_stmt = delete_stmt.where(role_permission.c.permission == permission)
+def csv_role_permission_pairs(role_permission_list_csv: list[dict]):
+    """csv_role_permission_pairs returns the distinct (role, permission) pairs"""
+    return list(
+        dict.fromkeys(
+            (
+                rpc["role"].name if isinstance(rpc["role"], Role) else rpc["role"],
+                rpc["permission"],
+            )
+            for rpc in role_permission_list_csv
+        )
+    )
 
-    return db_execute(delete_stmt, db_conn=db_conn)
+
+def role_permissions_sync_result(pairs, created_rows, deleted_rows):
+    """
+    role_permissions_sync_result builds the update_role_permission_table_with_csv
+    result from the rows returned by the insert and the delete
+    """
+    to_create_role_permissions = [
+        (role.name, permission) for role, permission in created_rows
+    ]
+    to_delete_role_permissions = [
+        (role.name, permission) for role, permission in deleted_rows
+    ]
+    created = set(to_create_role_permissions)
+    unchanged_role_permissions = [pair for pair in pairs if pair not in created]
+
+    return {
+        "to_create_role_permissions": to_create_role_permissions,
+        "to_delete_role_permissions": to_delete_role_permissions,
+        "unchanged_role_permissions": unchanged_role_permissions,
+    }
 
 
 @db_transaction
@@ -114,40 +253,99 @@ def update_role_permission_table_with_csv(
     and creates the role_permission that are in the role_permission_list_csv but
     not in the role_permission table. Does not touches the role_permission that are
     in both the role_permission_list_csv and the role_permission table.
+
+    The difference is computed server-side: the pairs are sent as two arrays,
+    one DELETE removes the rows missing from them and one
+    INSERT ... ON CONFLICT DO NOTHING adds the new ones.
     """
-    role_permission_db_list = get_role_permissions() or []
+    pairs = csv_role_permission_pairs(role_permission_list_csv)
 
-    actual_role_permission_set = {
-        (rpc["role"], rpc["permission"]) for rpc in role_permission_list_csv
-    }
-    existing_role_permission_set = {
-        (rpd["role"], rpd["permission"]) for rpd in role_permission_db_list
-    }
+    try:
+        deleted_rows = db_conn.execute(
+            statements.delete_role_permissions_not_in_stmt(pairs)
+        ).all()
+        created_rows = db_conn.execute(
+            statements.create_missing_role_permissions_stmt(pairs)
+        ).all()
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+    permissions_changed(db_conn)
 
-    to_create_role_permissions = list(
-        (actual_role_permission_set - existing_role_permission_set)
-    )
-    to_delete_role_permissions = list(
-        (existing_role_permission_set - actual_role_permission_set)
-    )
-    unchanged_role_permissions = list(
-        existing_role_permission_set & actual_role_permission_set
-    )
+    result = role_permissions_sync_result(pairs, created_rows, deleted_rows)
+    if logged:
+        log.info(
+            "role_permissions synced with csv: %d created, %d deleted, %d unchanged",
+            len(result["to_create_role_permissions"]),
+            len(result["to_delete_role_permissions"]),
+            len(result["unchanged_role_permissions"]),
+        )
+    return result
 
-    to_delete_ids = [
-        rp["id"]
-        for rp in role_permission_db_list
-        if (rp["role"], rp["permission"]) in to_delete_role_permissions
-    ]
 
-    if to_delete_ids:
-        delete_role_permissions(ids=to_delete_ids)
-    if to_create_role_permissions:
-        for role, permission in to_create_role_permissions:
-            create_permission_for_role(role, permission)
+class PermissionsCacheListener(threading.Thread):
+    """
+    PermissionsCacheListener LISTENs on PERMISSIONS_CHANNEL on a connection of
+    its own, outside of the pool, and clears permissions_cache whenever
+    another process changes role_permissions (see config.get_permissions_notify)
+    """
 
-    return {
-        "to_create_role_permissions": to_create_role_permissions,
-        "to_delete_role_permissions": to_delete_role_permissions,
-        "unchanged_role_permissions": unchanged_role_permissions,
-    }
+    def __init__(self, poll_interval: float = 1.0):
+        super().__init__(name="users_db-permissions-listener", daemon=True)
+        self.poll_interval = poll_interval
+        self.listening = threading.Event()
+        self._stopped = threading.Event()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self.join(timeout)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.listen()
+            except Exception as err:
+                log.warning("permissions listener disconnected: %s", err)
+                self.listening.clear()
+                self._stopped.wait(self.poll_interval)
+
+    def listen(self):
+        engine = get_engine()
+        cargs, cparams = engine.dialect.create_connect_args(engine.url)
+        connection = engine.dialect.connect(*cargs, **cparams)
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {PERMISSIONS_CHANNEL}")
+            # notifications sent while not listening are lost
+            permissions_cache.clear()
+            self.listening.set()
+
+            while not self._stopped.is_set():
+                if select.select([connection], [], [], self.poll_interval)[0]:
+                    connection.poll()
+                    if connection.notifies:
+                        connection.notifies.clear()
+                        permissions_cache.clear()
+        finally:
+            connection.close()
+
+
+_listener = None
+
+
+def start_permissions_listener(poll_interval: float = 1.0):
+    """starts the process-wide PermissionsCacheListener, if not running"""
+    global _listener
+
+    if _listener is None or not _listener.is_alive():
+        _listener = PermissionsCacheListener(poll_interval=poll_interval)
+        _listener.start()
+    return _listener
+
+
+def stop_permissions_listener(timeout=None):
+    global _listener
+
+    if _listener is not None:
+        _listener.stop(timeout)
+        _listener = None
@@ -0,0 +1,103 @@
+"""
+Read/write splitting: the select-only functions (decorated with
+db_read_transaction) run on a read replica picked by a ReplicaSet, the other
+ones, and the reads nested in their transactions, on the primary.
+"""
+import itertools
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import QueuePool, event
+
+ROUND_ROBIN = "round_robin"
+LEAST_CONNECTIONS = "least_connections"
+BALANCING = (ROUND_ROBIN, LEAST_CONNECTIONS)
+
+# monotonic time of the last commit on the primary in this thread or asyncio
+# task, reads follow it to the primary during the read-your-writes window
+last_write_commit: ContextVar[float] = ContextVar(
+    "users_db_last_write_commit", default=float("-inf")
+)
+
+
+# set in the info of a primary connection by a statement that may write, the
+# commit of its transaction starts the read-your-writes window
+WROTE = "users_db_wrote"
+# the statements that write nothing, the others are taken as writes
+READ_ONLY_STATEMENTS = ("SELECT", "SHOW", "EXPLAIN", "SAVEPOINT", "RELEASE", "ROLLBACK")
+
+
+def mark_write(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and (
+        context.isinsert or context.isupdate or context.isdelete
+    ):
+        conn.info[WROTE] = True
+    elif not statement.lstrip()[:9].upper().startswith(READ_ONLY_STATEMENTS):
+        conn.info[WROTE] = True
+
+
+def track_writes(engine, enabled=True):
+    """
+    track_writes marks the connections of the primary engine that wrote, which
+    only matters with replicas; enabled=False stops it
+    """
+    engine = getattr(engine, "sync_engine", engine)
+    tracking = event.contains(engine, "after_cursor_execute", mark_write)
+    if enabled and not tracking:
+        event.listen(engine, "after_cursor_execute", mark_write)
+    elif tracking and not enabled:
+        event.remove(engine, "after_cursor_execute", mark_write)
+
+
+def wrote(connection) -> bool:
+    """whether the transaction of connection wrote, clearing the mark"""
+    return connection.info.pop(WROTE, False)
+
+
+def checked_out(engine):
+    """the number of connections of the engine pool in use"""
+    pool = getattr(engine, "sync_engine", engine).pool
+    return pool.checkedout() if isinstance(pool, QueuePool) else 0
+
+
+class ReplicaSet:
+    """
+    ReplicaSet balances the reads over the engines of the replicas, with
+    round_robin or least_connections (the replica whose pool has the fewest
+    connections in use, ties broken round-robin).
+
+    read_your_writes_window is the number of seconds after a commit on the
+    primary during which the reads of the same thread or task still go to the
+    primary, so that they see their own writes despite the replication lag.
+    """
+
+    def __init__(self, engines, balancing=ROUND_ROBIN, read_your_writes_window=0):
+        if not engines:
+            raise ValueError("a ReplicaSet needs at least one engine")
+        if balancing not in BALANCING:
+            raise ValueError(f"unknown replica balancing: {balancing!r}")
+        self.engines = list(engines)
+        self.balancing = balancing
+        self.read_your_writes_window = read_your_writes_window
+        # next() on itertools.count is atomic, no lock is needed
+        self._counter = itertools.count()
+
+    def pick(self):
+        start = next(self._counter) % len(self.engines)
+        if self.balancing == ROUND_ROBIN:
+            return self.engines[start]
+        rotated = self.engines[start:] + self.engines[:start]
+        return min(rotated, key=checked_out)
+
+    def record_write(self):
+        if self.read_your_writes_window:
+            last_write_commit.set(time.monotonic())
+
+    def reads_own_writes(self):
+        """whether the reads of this thread or task have to go to the primary"""
+        window = self.read_your_writes_window
+        return bool(window) and time.monotonic() - last_write_commit.get() < window
+
+    def dispose(self, close=True):
+        for engine in self.engines:
+            getattr(engine, "sync_engine", engine).dispose(close=close)
@@ -1,5 +1,6 @@
 import enum
-from sqlalchemy import Table, Enum, Column, Integer, String, UniqueConstraint
+from sqlalchemy import Table, Enum, Column, Index, Integer, String, UniqueConstraint
+from sqlalchemy import func
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
@@ -11,11 +12,14 @@ class Role(enum.Enum):
     USER = 3
 
 
+# the type name matches the one created by the migrations
+role_enum = Enum(Role, name="role_enum")
+
 role_permission = Table(
     "role_permissions",
     Base.metadata,
     Column("id", Integer, primary_key=True),
-    Column("role", Enum(Role), nullable=False),
+    Column("role", role_enum, nullable=False),
     Column("permission", String(100), nullable=False),
     UniqueConstraint("role", "permission", name="role_permission_uq"),
 )
@@ -27,7 +31,40 @@ users = Table(
     Column("first_name", String(64), nullable=False),
     Column("middle_name", String(64), nullable=True),
     Column("last_name", String(64), nullable=False),
-    Column("email", String(64), nullable=False, unique=True),
-    Column("password", String(256), nullable=False),
-    Column("role", Enum(Role), nullable=False),
+    # unique regardless of case, see uq_users_lower_email
+    Column("email", String(64), nullable=False),
+    # sensitive columns are left out of public_columns()
+    Column("password", String(256), nullable=False, info={"sensitive": True}),
+    Column("role", role_enum, nullable=False),
 )
+
+# the indexes of the get_users filters, created by the migrations
+Index("ix_users_last_name_first_name", users.c.last_name, users.c.first_name)
+Index("ix_users_role", users.c.role)
+# emails are compared with lower(), login lookups are a point lookup here
+Index("uq_users_lower_email", func.lower(users.c.email), unique=True)
+
+
+def declare_trigram_indexes():
+    """
+    declare_trigram_indexes adds the trigram indexes of search_users, which
+    need the pg_trgm extension, to the metadata; their postgresql options load
+    the dialect, so they are only declared for the migrations (see env.py)
+    """
+    if "ix_users_first_name_trgm" in {index.name for index in users.indexes}:
+        return
+    for name in ("first_name", "last_name", "email"):
+        Index(
+            f"ix_users_{name}_trgm",
+            users.c[name],
+            postgresql_using="gin",
+            postgresql_ops={name: "gin_trgm_ops"},
+        )
+
+
+def public_columns(table: Table):
+    """
+    public_columns returns the columns of a table that may be returned to
+    callers, selecting a sensitive column has to be explicit
+    """
+    return [c for c in table.c if not c.info.get("sensitive")]
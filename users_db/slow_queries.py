@@ -0,0 +1,315 @@
+"""
+Slow-query log: the statements of the users_db engines taking longer than a
+threshold are logged on the users_db.slow_queries logger with their SQL, their
+parameters redacted, the users_db function running them and, for a sample of
+the selects reading a table, their EXPLAIN (ANALYZE, BUFFERS) plan.
+
+    slow_queries.enable(threshold=0.2, explain_sample=0.01)
+
+or DB_SLOW_QUERY_THRESHOLD and DB_SLOW_QUERY_EXPLAIN_SAMPLE (see config).
+While disabled, no event listener is attached to the engines.
+"""
+import logging
+import random
+import re
+import sys
+import threading
+import time
+import weakref
+
+from sqlalchemy import Select, Table, event
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.sql.visitors import iterate
+
+from users_db import config
+from users_db.schema import Base
+
+log = logging.getLogger(__name__)
+
+REDACTED = "<redacted>"
+HIDDEN = "?"
+
+# the sensitive columns (see schema.public_columns) and the bind parameters
+# named after them: password, password_1, password_m0 (multi-row insert), ...
+SENSITIVE_COLUMNS = sorted(
+    {
+        column.name
+        for table in Base.metadata.tables.values()
+        for column in table.columns
+        if column.info.get("sensitive")
+    }
+)
+SENSITIVE_PARAMETER = re.compile(
+    rf"^({'|'.join(map(re.escape, SENSITIVE_COLUMNS))})(_\w+)?$"
+)
+
+EXPLAIN = "EXPLAIN (ANALYZE, BUFFERS) "
+# the plans show the parameters as constants, e.g. ((email)::text = '...'::text)
+STRING_CONSTANT = re.compile(r"'(?:[^']|'')*'")
+EXPLAIN_SAVEPOINT = "users_db_explain"
+# the functions a select may call and still be run again under EXPLAIN
+# ANALYZE, none of them has side effects (unlike e.g. pg_notify or nextval)
+EXPLAINABLE_FUNCTIONS = {
+    "avg",
+    "coalesce",
+    "count",
+    "greatest",
+    "json_agg",
+    "json_build_array",
+    "json_build_object",
+    "least",
+    "lower",
+    "max",
+    "min",
+    "sum",
+    "unnest",
+    "upper",
+    "word_similarity",
+}
+
+# the engines of users_db, see register
+_engines = weakref.WeakSet()
+_lock = threading.Lock()
+_slow_query_log = None
+# whether enable or disable was called, which overrides the config
+_configured = False
+
+
+def redact_value(name, value, show_values=False):
+    if SENSITIVE_PARAMETER.match(str(name)):
+        return REDACTED
+    return value if show_values else HIDDEN
+
+
+def redact_parameters(parameters, show_values=False):
+    """
+    redact_parameters returns the parameters of a statement with their values
+    replaced by ?, or with show_values only the sensitive ones, by <redacted>
+    """
+    if isinstance(parameters, dict):
+        return {
+            name: redact_value(name, value, show_values)
+            for name, value in parameters.items()
+        }
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            # executemany, the first set of parameters stands for all of them
+            return [redact_parameters(parameters[0], show_values), len(parameters)]
+        # positional parameters, the columns they are bound to are not known
+        return [HIDDEN] * len(parameters)
+    return parameters
+
+
+def redact_plan(plan, parameters, show_values=False):
+    """
+    redact_plan replaces the string constants of a plan by '?', or with
+    show_values only those of the sensitive parameters by '<redacted>'
+    """
+    if not show_values:
+        return STRING_CONSTANT.sub("'?'", plan)
+    if isinstance(parameters, dict):
+        for name, value in parameters.items():
+            if isinstance(value, str) and SENSITIVE_PARAMETER.match(str(name)):
+                constant = "'{}'".format(value.replace("'", "''"))
+                plan = plan.replace(constant, f"'{REDACTED}'")
+    return plan
+
+
+def is_table_read(context):
+    """
+    is_table_read tells whether a statement is a select reading a table and
+    calling only EXPLAINABLE_FUNCTIONS, the statements safe to run again
+    """
+    if context is None or context.executemany:
+        return False
+    statement = getattr(context.compiled, "statement", None)
+    if not isinstance(statement, Select):
+        # textual SQL included, what it calls is not known
+        return False
+    reads_table = False
+    for element in iterate(statement):
+        if isinstance(element, Table):
+            reads_table = True
+        elif isinstance(element, FunctionElement):
+            name = getattr(element, "name", "")
+            if name.lower() not in EXPLAINABLE_FUNCTIONS:
+                return False
+    return reads_table
+
+
+def transaction_codes():
+    """the code objects of the db_transaction calls, see calling_function"""
+    from users_db.db import base_transaction
+
+    codes = {base_transaction.__call__.__code__, base_transaction.timed_call.__code__}
+    aio_db = sys.modules.get("users_db.aio.db")
+    if aio_db is not None:
+        codes.add(aio_db.db_transaction.__call__.__code__)
+        codes.add(aio_db.db_transaction.timed_call.__code__)
+    return codes
+
+
+def calling_function():
+    """
+    calling_function returns the name of the innermost db_transaction
+    decorated function on the stack, found by walking it on a slow query only
+    """
+    codes = transaction_codes()
+    for frame in stack_frames():
+        if frame.f_code in codes:
+            return frame.f_locals["self"].name
+    return None
+
+
+def stack_frames():
+    """
+    the frames of the stack, innermost first; the sync code of users_db.aio
+    runs in a greenlet, the stack goes on with the async code that spawned it
+    """
+    frame = sys._getframe(2)
+    greenlet = sys.modules.get("greenlet")
+    current = greenlet.getcurrent() if greenlet is not None else None
+    while frame is not None:
+        yield frame
+        frame = frame.f_back
+        if frame is None and current is not None and current.parent is not None:
+            current = current.parent
+            frame = current.gr_frame
+
+
+class SlowQueryLog:
+    """
+    SlowQueryLog is a pair of cursor execute listeners timing the statements
+    of the engines it is attached to
+    """
+
+    def __init__(
+        self, threshold: float, explain_sample: float = 0.0, show_values=False
+    ):
+        self.threshold = threshold
+        self.explain_sample = explain_sample
+        self.show_values = show_values
+
+    def attach(self, engine):
+        event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def detach(self, engine):
+        event.remove(engine, "before_cursor_execute", self.before_cursor_execute)
+        event.remove(engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        # on the execution context, a failed statement leaves nothing behind
+        if context is not None:
+            context.users_db_query_started = time.perf_counter()
+
+    def after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        started = getattr(context, "users_db_query_started", None)
+        if started is None:
+            # enabled while the statement was running
+            return
+        duration = time.perf_counter() - started
+        if duration < self.threshold:
+            return
+
+        plan = None
+        if self.explain_sample and random.random() < self.explain_sample:
+            if is_table_read(context):
+                plan = self.explain(conn, statement, parameters)
+                if plan is not None:
+                    plan = redact_plan(plan, parameters, self.show_values)
+
+        entry = {
+            "duration": duration,
+            "function": calling_function(),
+            "statement": statement,
+            "parameters": redact_parameters(parameters, self.show_values),
+            "plan": plan,
+        }
+        message = "slow query: %.3fs in %s\n%s\nparameters: %r"
+        args = [duration, entry["function"], statement, entry["parameters"]]
+        if plan is not None:
+            message += "\n%s"
+            args.append(plan)
+        log.warning(message, *args, extra={"slow_query": entry})
+
+    def explain(self, conn, statement, parameters):
+        """
+        explain runs the select again under EXPLAIN (ANALYZE, BUFFERS), in a
+        SAVEPOINT so that a failure leaves the transaction usable
+        """
+        if not conn.in_transaction():
+            return None
+        cursor = conn.connection.dbapi_connection.cursor()
+        try:
+            cursor.execute(f"SAVEPOINT {EXPLAIN_SAVEPOINT}")
+            try:
+                cursor.execute(EXPLAIN + statement, parameters)
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+            except Exception as err:
+                cursor.execute(f"ROLLBACK TO SAVEPOINT {EXPLAIN_SAVEPOINT}")
+                plan = f"EXPLAIN failed: {err}"
+            cursor.execute(f"RELEASE SAVEPOINT {EXPLAIN_SAVEPOINT}")
+            return plan
+        except Exception as err:
+            log.warning("slow query EXPLAIN failed: %s", err)
+            return None
+        finally:
+            cursor.close()
+
+
+def register(engine):
+    """
+    register is called with every engine users_db creates, the slow-query log
+    attaches to the registered engines; with DB_SLOW_QUERY_THRESHOLD set it is
+    enabled by the first one
+    """
+    engine = getattr(engine, "sync_engine", engine)
+    with _lock:
+        _engines.add(engine)
+        if not _configured and _slow_query_log is None:
+            threshold = config.get_slow_query_threshold()
+            if threshold is not None:
+                _enable(SlowQueryLog(threshold, config.get_slow_query_explain_sample()))
+                return
+        if _slow_query_log is not None:
+            _slow_query_log.attach(engine)
+
+
+def _enable(slow_query_log):
+    global _slow_query_log
+
+    if _slow_query_log is not None:
+        for engine in _engines:
+            _slow_query_log.detach(engine)
+    _slow_query_log = slow_query_log
+    if slow_query_log is not None:
+        for engine in _engines:
+            slow_query_log.attach(engine)
+
+
+def enable(threshold: float, explain_sample: float = 0.0, show_values=False):
+    """
+    enable logs the statements taking threshold seconds or more; explain_sample
+    is the share of them, table reads only, logged with their plan; show_values
+    logs the parameter values, except those of the sensitive columns
+    """
+    global _configured
+
+    slow_query_log = SlowQueryLog(threshold, explain_sample, show_values)
+    with _lock:
+        _configured = True
+        _enable(slow_query_log)
+    return slow_query_log
+
+
+def disable():
+    global _configured
+
+    with _lock:
+        _configured = True
+        _enable(None)
@@ -0,0 +1,355 @@
+"""
+Statement builders shared by the sync (users_db.users,
+users_db.role_permissions) and the async (users_db.aio) APIs
+"""
+from typing import List
+
+from sqlalchemy import (
+    Integer,
+    String,
+    and_,
+    bindparam,
+    case,
+    cast,
+    column,
+    delete,
+    exists,
+    insert,
+    or_,
+    select,
+    table,
+    text,
+    update,
+)
+
+# func.json_build_array, func.json_build_object, func.json_agg
+from sqlalchemy.sql.expression import func
+
+from users_db.schema import public_columns, role_enum, role_permission, users
+
+
+# users
+
+
+def create_user_stmt(first_name, middle_name, last_name, email, password, role):
+    return insert(users).values(
+        first_name=first_name,
+        middle_name=middle_name,
+        last_name=last_name,
+        email=email,
+        password=password,
+        role=role,
+    )
+
+
+USER_COLUMNS = ("first_name", "middle_name", "last_name", "email", "password", "role")
+
+ON_CONFLICT_RAISE = "raise"
+ON_CONFLICT_IGNORE = "ignore"
+ON_CONFLICT_UPDATE = "update"
+
+# emails are unique and compared regardless of case, through this expression
+# and its unique index uq_users_lower_email
+email_key = func.lower(users.c.email)
+
+
+def email_equals(email):
+    return email_key == func.lower(email)
+
+
+def on_conflict_email(stmt, on_conflict=ON_CONFLICT_RAISE):
+    """
+    on_conflict_email applies a conflict policy on lower(users.email) to an
+    insert: raise (IntegrityError), ignore (skip the row) or update (overwrite
+    the existing user, keeping its email)
+    """
+    if on_conflict == ON_CONFLICT_IGNORE:
+        return stmt.on_conflict_do_nothing(index_elements=[email_key])
+    if on_conflict == ON_CONFLICT_UPDATE:
+        return stmt.on_conflict_do_update(
+            index_elements=[email_key],
+            set_={
+                column: stmt.excluded[column]
+                for column in USER_COLUMNS
+                if column != "email"
+            },
+        )
+    if on_conflict != ON_CONFLICT_RAISE:
+        raise ValueError(f"unknown on_conflict policy: {on_conflict!r}")
+    return stmt
+
+
+def bulk_create_users_stmt(rows: List[dict], on_conflict=ON_CONFLICT_RAISE):
+    """
+    a single multi-row INSERT ... RETURNING id, email, the emails map the
+    returned ids back to the rows
+    """
+    # the postgresql dialect is imported by the builders using it, importing
+    # it with this module costs the import of users_db.users tens of ms
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+    values = [{column: row.get(column) for column in USER_COLUMNS} for row in rows]
+    stmt = on_conflict_email(pg_insert(users).values(values), on_conflict)
+    return stmt.returning(users.c.id, users.c.email)
+
+
+def copy_users_table_stmt(name):
+    """
+    a temporary, constraint-less staging table for COPY FROM STDIN, ordinal
+    keeps the input order
+    """
+    columns = ", ".join(USER_COLUMNS)
+    return text(
+        f"CREATE TEMPORARY TABLE {name} ON COMMIT DROP AS "
+        f"SELECT 0 AS ordinal, {columns} FROM users WITH NO DATA"
+    )
+
+
+def insert_users_from_copy_stmt(name, on_conflict=ON_CONFLICT_RAISE):
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+    copy_table = table(name, column("ordinal"), *[column(c) for c in USER_COLUMNS])
+    stmt = pg_insert(users).from_select(
+        USER_COLUMNS,
+        select(*[copy_table.c[c] for c in USER_COLUMNS]).order_by(copy_table.c.ordinal),
+    )
+    stmt = on_conflict_email(stmt, on_conflict)
+    return stmt.returning(users.c.id, users.c.email)
+
+
+# the statements of the hot functions are built once with bind parameters and
+# executed with db_execute(..., parameters={...}): a call skips building the
+# statement and its cache key is memoized, so the compiled form is found at
+# once; asyncpg also keeps them prepared per connection, by their SQL text
+
+GET_USER_STMT = select(*public_columns(users)).where(users.c.id == bindparam("user_id"))
+
+# the only statement selecting the password, which is opted in by name
+GET_HASHED_PASSWORD_BY_EMAIL_STMT = select(
+    users.c.id, users.c.email, users.c.password.label("hashed_password")
+).where(email_equals(bindparam("email")))
+
+DELETE_USER_STMT = delete(users).where(users.c.id == bindparam("user_id"))
+
+
+def get_users_stmt(
+    user_id=None,
+    user_ids=None,
+    first_name=None,
+    middle_name=None,
+    last_name=None,
+    email=None,
+    role=None,
+):
+    stmt = select(*public_columns(users))
+
+    if user_id:
+        stmt = stmt.where(users.c.id == user_id)
+    if user_ids:
+        stmt = stmt.where(users.c.id.in_(user_ids))
+    if first_name:
+        stmt = stmt.where(users.c.first_name == first_name)
+    if middle_name:
+        stmt = stmt.where(users.c.middle_name == middle_name)
+    if last_name:
+        stmt = stmt.where(users.c.last_name == last_name)
+    if email:
+        stmt = stmt.where(email_equals(email))
+    if role:
+        stmt = stmt.where(users.c.role == role)
+    return stmt
+
+
+SEARCH_COLUMNS = (users.c.first_name, users.c.last_name, users.c.email)
+
+# search_rank scale, the rank is an integer so that cursors compare exactly
+SEARCH_RANK_SCALE = 10000
+
+
+def like_escape(value: str):
+    """escapes the LIKE wildcards of value, with backslash as escape character"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def search_users_stmt(query: str, after=None):
+    """
+    users whose first name, last name or email contains query, ranked by
+    search_rank: 1 for a prefix match plus the pg_trgm word_similarity of the
+    closest column, scaled to an integer. The ILIKE '%query%' conditions are
+    served by the trigram GIN indexes. after is the (search_rank, id) of the
+    last row of the previous page.
+    """
+    pattern = like_escape(query)
+    substring = [c.ilike(f"%{pattern}%", escape="\\") for c in SEARCH_COLUMNS]
+    prefix = [c.ilike(f"{pattern}%", escape="\\") for c in SEARCH_COLUMNS]
+
+    similarity = func.greatest(
+        *[func.word_similarity(query, c) for c in SEARCH_COLUMNS]
+    )
+    rank = cast(
+        (case((or_(*prefix), 1.0), else_=0.0) + similarity) * SEARCH_RANK_SCALE,
+        Integer,
+    )
+    matches = (
+        select(*public_columns(users), rank.label("search_rank"))
+        .where(or_(*substring))
+        .subquery("matches")
+    )
+
+    stmt = select(matches)
+    if after is not None:
+        after_rank, after_id = after
+        stmt = stmt.where(
+            or_(
+                matches.c.search_rank < after_rank,
+                and_(matches.c.search_rank == after_rank, matches.c.id > after_id),
+            )
+        )
+    return stmt.order_by(matches.c.search_rank.desc(), matches.c.id)
+
+
+def update_user_stmt(user_id, **values):
+    return update(users).where(users.c.id == user_id).values(**values)
+
+
+def bulk_delete_users_stmt(user_ids):
+    return delete(users).where(users.c.id.in_(user_ids))
+
+
+# role_permissions
+
+
+def create_permission_for_role_stmt(role: str, permission: str):
+    return insert(role_permission).values(role=role, permission=permission)
+
+
+def create_permissions_for_role_stmt(role: str, permissions: List[str]):
+    return insert(role_permission).values(
+        [{"role": role, "permission": permission} for permission in permissions]
+    )
+
+
+GET_ROLE_PERMISSION_STMT = select(role_permission).where(
+    role_permission.c.id == bindparam("role_permission_id")
+)
+
+GET_PERMISSIONS_FOR_ROLE_STMT = (
+    select(
+        role_permission.c.role,
+        func.json_agg(
+            func.json_build_object(
+                "id",
+                role_permission.c.id,
+                "permission",
+                role_permission.c.permission,
+            )
+        ).label("permissions"),
+    )
+    .where(role_permission.c.role == bindparam("role"))
+    .group_by(role_permission.c.role)
+)
+
+GET_PERMISSION_NAMES_FOR_ROLE_STMT = select(role_permission.c.permission).where(
+    role_permission.c.role == bindparam("role")
+)
+
+HAS_PERMISSION_STMT = select(
+    exists().where(
+        role_permission.c.role == bindparam("role"),
+        role_permission.c.permission == bindparam("permission"),
+    )
+)
+
+
+def get_role_permissions_stmt(role_permission_ids=None, role=None, permission=None):
+    select_stmt = select(role_permission)
+
+    if role_permission_ids:
+        select_stmt = select_stmt.where(role_permission.c.id.in_(role_permission_ids))
+    if role:
+        select_stmt = select_stmt.where(role_permission.c.role == role)
+    if permission:
+        select_stmt = select_stmt.where(role_permission.c.permission == permission)
+    return select_stmt
+
+
+def get_granted_permissions_stmt(role: str, permissions: List[str]):
+    return select(role_permission.c.permission).where(
+        role_permission.c.role == role,
+        role_permission.c.permission.in_(permissions),
+    )
+
+
+def notify_stmt(channel: str, payload: str = ""):
+    return select(func.pg_notify(channel, payload))
+
+
+def update_permissions_for_role_stmt(role_permission_id, **values):
+    return (
+        update(role_permission)
+        .where(role_permission.c.id == role_permission_id)
+        .values(**values)
+    )
+
+
+def delete_role_permissions_stmt(id=None, ids=None, role=None, permission=None):
+    delete_stmt = delete(role_permission)
+
+    if id:
+        delete_stmt = delete_stmt.where(role_permission.c.id == id)
+    if ids:
+        delete_stmt = delete_stmt.where(role_permission.c.id.in_(ids))
+    if role:
+        delete_stmt = delete_stmt.where(role_permission.c.role == role)
+    if permission:
+        delete_stmt = delete_stmt.where(role_permission.c.permission == permission)
+    return delete_stmt
+
+
+def role_permission_pairs_table(pairs):
+    """
+    the (role, permission) pairs as a server-side table: two arrays expanded
+    by unnest(), so any number of pairs is sent as two parameters
+    """
+    from sqlalchemy.dialects.postgresql import ARRAY
+
+    roles = [role for role, _ in pairs]
+    permissions = [permission for _, permission in pairs]
+    return (
+        func.unnest(
+            cast(bindparam("roles", roles, ARRAY(String)), ARRAY(role_enum)),
+            bindparam("permissions", permissions, ARRAY(String)),
+        )
+        .table_valued("role", "permission")
+        .render_derived(name="csv_role_permissions")
+    )
+
+
+def delete_role_permissions_not_in_stmt(pairs):
+    """deletes the rows whose (role, permission) is not one of the pairs"""
+    csv_rows = role_permission_pairs_table(pairs)
+    return (
+        delete(role_permission)
+        .where(
+            ~exists().where(
+                csv_rows.c.role == role_permission.c.role,
+                csv_rows.c.permission == role_permission.c.permission,
+            )
+        )
+        .returning(role_permission.c.role, role_permission.c.permission)
+    )
+
+
+def create_missing_role_permissions_stmt(pairs):
+    """inserts the pairs that are not in the table yet"""
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+    csv_rows = role_permission_pairs_table(pairs)
+    return (
+        pg_insert(role_permission)
+        .from_select(
+            ["role", "permission"], select(csv_rows.c.role, csv_rows.c.permission)
+        )
+        .on_conflict_do_nothing(constraint="role_permission_uq")
+        .returning(role_permission.c.role, role_permission.c.permission)
+    )
@@ -1,8 +1,17 @@
-from sqlalchemy import insert, select, update, delete
-
-from users_db.db import db_execute, db_transaction
-from users_db.pagination import paginate
-from users_db.schema import users
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from users_db import statements
+from users_db.db import (
+    db_copy,
+    db_execute,
+    db_read_transaction,
+    db_stream,
+    db_transaction,
+    transform_rows,
+)
+from users_db.errors import SqlAlchemyDatabaseError
+from users_db.pagination import CURSOR_NEXT, decode_cursor, encode_cursor, paginate
 
 
 @db_transaction
@@ -10,7 +19,7 @@ def create_user(
     first_name, middle_name, last_name, email, password, role, db_conn=None
 ):
     return db_execute(
-        insert(users).values(
+        statements.create_user_stmt(
             first_name=first_name,
             middle_name=middle_name,
             last_name=last_name,
@@ -22,20 +31,24 @@ def create_user(
     )
 
 
-@db_transaction
-def get_user(user_id, db_conn=None):
-    return db_execute(select(users).where(users.c.id == user_id), db_conn=db_conn)
+@db_read_transaction
+def get_user(user_id, typed=False, db_conn=None):
+    return db_execute(
+        statements.GET_USER_STMT,
+        db_conn=db_conn,
+        typed=typed,
+        parameters={"user_id": user_id},
+    )
 
 
+# credentials are read from the primary, never from a lagging replica
 @db_transaction
 def get_hashed_password_by_email(email, db_conn=None):
-    stmt = select(
-        users.c.id, users.c.email, users.c.password.label("hashed_password")
-    ).where(users.c.email == email)
-    return db_execute(stmt, db_conn=db_conn)
+    stmt = statements.GET_HASHED_PASSWORD_BY_EMAIL_STMT
+    return db_execute(stmt, db_conn=db_conn, parameters={"email": email})
 
 
-@db_transaction
+@db_read_transaction
 @paginate
 def get_users(
     user_id=None,
@@ -47,26 +60,92 @@ def get_users(
     role=None,
     db_conn=None,
     is_paginated=False,
+    pagination="offset",
     page=None,
     page_size=None,
+    cursor=None,
+    order_by="id",
+    count_mode=None,
+    typed=False,
 ):
-    stmt = select(users)
-
-    if user_id:
-        stmt = stmt.where(users.c.id == user_id)
-    if user_ids:
-        stmt = stmt.where(users.c.id.in_(user_ids))
-    if first_name:
-        stmt = stmt.where(users.c.first_name == first_name)
-    if middle_name:
-        stmt = stmt.where(users.c.middle_name == middle_name)
-    if last_name:
-        stmt = stmt.where(users.c.last_name == last_name)
-    if email:
-        stmt = stmt.where(users.c.email == email)
-    if role:
-        stmt = stmt.where(users.c.role == role)
-    return stmt
+    return statements.get_users_stmt(
+        user_id=user_id,
+        user_ids=user_ids,
+        first_name=first_name,
+        middle_name=middle_name,
+        last_name=last_name,
+        email=email,
+        role=role,
+    )
+
+
+SEARCH_LIMIT = 20
+SEARCH_ORDER_BY = "search_rank"
+
+
+@db_read_transaction
+def search_users(query: str, limit=SEARCH_LIMIT, cursor=None, db_conn=None):
+    """
+    search_users returns the users whose first name, last name or email
+    contains query (case-insensitive), best matches first (see
+    statements.search_users_stmt), limit at a time: the next page is asked
+    for with the next_cursor of the previous one. It needs the pg_trgm
+    extension.
+    """
+    return search_page(query, limit, cursor, db_conn=db_conn)
+
+
+def search_page(query: str, limit, cursor, db_conn):
+    query = query.strip()
+    if not query:
+        raise ValueError("query must not be empty")
+    if limit < 1:
+        raise ValueError("limit must be positive")
+
+    after = None
+    if cursor:
+        direction, key = decode_cursor(cursor, SEARCH_ORDER_BY)
+        if direction != CURSOR_NEXT or len(key) != 2:
+            raise ValueError("cursor is malformed")
+        after = key
+
+    # fetch one extra row to know whether there is a page after this one
+    stmt = statements.search_users_stmt(query, after).limit(limit + 1)
+    try:
+        items = transform_rows(stmt, db_conn.execute(stmt))
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        key = [items[-1][SEARCH_ORDER_BY], items[-1]["id"]]
+        next_cursor = encode_cursor(SEARCH_ORDER_BY, CURSOR_NEXT, key)
+    return {"limit": limit, "next_cursor": next_cursor, "items": items}
+
+
+ITER_CHUNK_SIZE = 1000
+
+
+def iter_users(chunk_size=ITER_CHUNK_SIZE, batches=False, typed=False, **filters):
+    """
+    iter_users lazily yields the users matching the get_users filters, one
+    by one or in lists of chunk_size when batches, reading them chunk_size
+    at a time from a server-side cursor (see db.db_stream for the connection
+    handling). Stopping early releases the cursor and the connection:
+
+        with contextlib.closing(iter_users(role="USER")) as rows:
+            for row in rows: ...
+    """
+    chunks = db_stream(statements.get_users_stmt(**filters), chunk_size, typed)
+    try:
+        for chunk in chunks:
+            if batches:
+                yield chunk
+            else:
+                yield from chunk
+    finally:
+        chunks.close()
 
 
 @db_transaction
@@ -75,7 +154,7 @@ def update_user(
     db_conn=None,
     **values,
 ):
-    stmt = update(users).where(users.c.id == user_id).values(**values)
+    stmt = statements.update_user_stmt(user_id, **values)
     return db_execute(stmt, db_conn=db_conn)
 
 
@@ -84,8 +163,8 @@ def delete_user(
     user_id,
     db_conn=None,
 ):
-    stmt = delete(users).where(users.c.id == user_id)
-    return db_execute(stmt, db_conn=db_conn)
+    stmt = statements.DELETE_USER_STMT
+    return db_execute(stmt, db_conn=db_conn, parameters={"user_id": user_id})
 
 
 @db_transaction
@@ -93,5 +172,64 @@ def bulk_delete_users(
     user_ids,
     db_conn=None,
 ):
-    stmt = delete(users).where(users.c.id.in_(user_ids))
+    stmt = statements.bulk_delete_users_stmt(user_ids)
     return db_execute(stmt, db_conn=db_conn)
+
+
+BULK_BATCH_SIZE = 1000
+COPY_TABLE = "users_copy"
+
+
+def ids_in_input_order(rows, returned):
+    """
+    ids_in_input_order maps the (id, email) pairs returned by a bulk insert
+    back to the rows, a row that was not inserted gets None
+    """
+    # emails are unique regardless of case, and an updated user keeps its email
+    ids_by_email = {email.lower(): user_id for user_id, email in returned}
+    # pop: a duplicated email gets the id only for its first occurrence
+    return [ids_by_email.pop(row["email"].lower(), None) for row in rows]
+
+
+@db_transaction
+def bulk_create_users(
+    rows,
+    batch_size=BULK_BATCH_SIZE,
+    on_conflict=statements.ON_CONFLICT_RAISE,
+    copy=False,
+    db_conn=None,
+):
+    """
+    bulk_create_users creates users from dicts with the create_user keys in
+    one transaction and returns their ids in input order. on_conflict on email
+    is "raise", "ignore" (the id is None) or "update". Rows are sent as
+    multi-row INSERTs of batch_size rows, or with copy=True streamed through
+    COPY FROM STDIN into a staging table, which pays off for very large loads.
+    """
+    rows = list(rows)
+    returned = []
+    try:
+        if copy:
+            db_conn.execute(statements.copy_users_table_stmt(COPY_TABLE))
+            db_copy(
+                COPY_TABLE,
+                ("ordinal", *statements.USER_COLUMNS),
+                (
+                    (ordinal, *[row.get(c) for c in statements.USER_COLUMNS])
+                    for ordinal, row in enumerate(rows)
+                ),
+                db_conn=db_conn,
+            )
+            stmt = statements.insert_users_from_copy_stmt(COPY_TABLE, on_conflict)
+            returned = db_conn.execute(stmt).all()
+            db_conn.execute(text(f"DROP TABLE {COPY_TABLE}"))
+        else:
+            for start in range(0, len(rows), batch_size):
+                stmt = statements.bulk_create_users_stmt(
+                    rows[start : start + batch_size], on_conflict
+                )
+                returned.extend(db_conn.execute(stmt).all())
+    except SQLAlchemyError as err:
+        raise SqlAlchemyDatabaseError(err)
+
+    return ids_in_input_order(rows, returned)
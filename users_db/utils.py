@@ -1,8 +1,34 @@
-def json_build_object_columns(t):
+from sqlalchemy import String, literal
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+
+def json_build_object_columns(t, exclude=()):
     """
     return list of table colums in the format of
     ["col1". t.c.col1, "col2", t.c.col2, ...]
     """
-    key_colum_tups: list[tuple] = [(c.key, c) for c in t.c]
+    # keys are typed binds, asyncpg can not infer the type of an untyped one
+    key_colum_tups: list[tuple] = [
+        (literal(str(c.key), String), c) for c in t.c if c.key not in exclude
+    ]
     key_col: list = [obj for tup_list_obj in key_colum_tups for obj in tup_list_obj]
     return key_col
+
+
+class explain(Executable, ClauseElement):
+    """
+    EXPLAIN construct for a select statement, executes like any other
+    statement: db_conn.execute(explain(stmt)).scalar()
+    """
+
+    inherit_cache = False
+
+    def __init__(self, statement, options="FORMAT JSON"):
+        self.statement = statement
+        self.options = options
+
+
+@compiles(explain, "postgresql")
+def _compile_explain(element, compiler, **kw):
+    return f"EXPLAIN ({element.options}) " + compiler.process(element.statement, **kw)